@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+import clients
+import id_arrays
+import instrumentation
+from rate_limit import throttle
+
+def manc_adjacency(neuron_ids, chunk_size=1000, limiter=None, rois=None):
+    """Fetch every connection among a set of MANC neurons, with one neuprint request per pair of chunks
+    of neuron_ids rather than one per pair of neurons.
+
+    Parameters
+    ----------
+    neuron_ids :        list of int
+                        MANC body IDs
+    chunk_size :        int
+                        maximum number of body IDs sent as the upstream or downstream neurons of a request
+    limiter :           rate_limit.TokenBucket
+                        optional limiter acquired before each neuprint request
+    rois :              list of str
+                        optional ROIs, limiting the connections to neuron pairs that connect in at least one
+                        of them
+
+    Returns
+    -------
+    tuple
+                        (matrix, ids), where matrix is a scipy sparse matrix whose entry [i, j] is the number of
+                        synapses from neuron ids[i] onto neuron ids[j] and ids is the sorted body IDs
+
+    """
+    neuprint, client = clients.neuprint_api(), clients.neuprint_client()
+    ids = np.unique(np.asarray(list(neuron_ids), dtype="int64"))
+    chunks = id_arrays.chunks(ids.tolist(), chunk_size)
+    frames = []
+    for upstream in chunks:
+        for downstream in chunks:
+            upstream_criteria = neuprint.queries.NeuronCriteria(bodyId=upstream, client=client)
+            downstream_criteria = neuprint.queries.NeuronCriteria(bodyId=downstream, client=client)
+            throttle(limiter)
+            with instrumentation.timed("neuprint.fetch_simple_connections", neurons=len(upstream)+len(downstream)) as timer:
+                connections = neuprint.fetch_simple_connections(upstream_criteria, downstream_criteria, rois=rois,
+                                                                client=client)
+                timer.set(connections)
+            frames.append(connections[["bodyId_pre", "bodyId_post", "weight"]])
+    edges = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=["bodyId_pre", "bodyId_post", "weight"])
+    return _matrix(edges["bodyId_pre"], edges["bodyId_post"], edges["weight"], ids), ids
+
+def fanc_adjacency(neuron_ids, client=None, chunk_size=50, region=None):
+    """Count the synapses between every pair of a set of FANC neurons, with synapse queries limited to
+    chunks of the set on both sides, see fanc_synapses.stream_synapse_counts.
+
+    Parameters
+    ----------
+    neuron_ids :        list of int
+                        FANC root IDs
+    client :            caveclient.frameworkclient.CAVEclientFull
+                        CAVEclient to query information from. If not passed to the function the shared client is used.
+    chunk_size :        int
+                        maximum number of root IDs sent as the pre or post neurons of a query
+    region :            dict
+                        optional keyword arguments for fanc_synapses.spatial_filter giving the region of the VNC in
+                        which synapses are counted
+
+    Returns
+    -------
+    tuple
+                        (matrix, ids), see manc_adjacency
+
+    """
+    import fanc_synapses
+    ids = np.unique(np.asarray(list(neuron_ids), dtype="int64"))
+    counts = fanc_synapses.stream_synapse_counts(ids.tolist(), "pre", client, chunk_size, region=region,
+                                                 partner_ids=ids.tolist())
+    return _matrix(counts.index.get_level_values(0), counts.index.get_level_values(1), counts, ids), ids
+
+def adjacency_edges(matrix, ids, min_weight=1):
+    """Return the connections of an adjacency matrix with at least min_weight synapses as a DataFrame with
+    the columns pre, post and weight."""
+    matrix = sparse.coo_matrix(matrix)
+    keep = matrix.data >= min_weight
+    return pd.DataFrame({"pre": ids[matrix.row[keep]], "post": ids[matrix.col[keep]],
+                         "weight": matrix.data[keep].astype("int64")})
+
+def _matrix(pre, post, weight, ids):
+    # sparse matrix of the weights between neurons in ids, ignoring connections to neurons outside it
+    pre = np.asarray(pre, dtype="int64")
+    post = np.asarray(post, dtype="int64")
+    weight = np.asarray(weight, dtype="int64")
+    inside = np.isin(pre, ids) & np.isin(post, ids)
+    matrix = sparse.csr_matrix((weight[inside], (np.searchsorted(ids, pre[inside]), np.searchsorted(ids, post[inside]))),
+                               shape=(len(ids), len(ids)))
+    matrix.sum_duplicates()
+    return matrix
@@ -0,0 +1,23 @@
+import contextlib
+import os
+import tempfile
+
+@contextlib.contextmanager
+def write(path, mode="w"):
+    """Open a temporary file next to path for writing, and move it over path in one step once the block
+    finishes, so that a reader or an interrupted run never sees a half-written file. If the block raises,
+    path is left as it was.
+
+    with atomic_file.write("report.json") as file:
+        json.dump(report, file)
+    """
+    directory, name = os.path.split(path)
+    handle, temporary = tempfile.mkstemp(prefix=name+".", suffix=".tmp", dir=directory or ".")
+    try:
+        with os.fdopen(handle, mode) as file:
+            yield file
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
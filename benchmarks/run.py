@@ -0,0 +1,311 @@
+"""Benchmarks of the public entry points of fanc_synapses, manc_synapses and neuron_graph, run against the
+stand-in services in benchmarks.standins so that no production server is contacted.
+
+Each benchmark records its wall time, the number of requests made to the stand-in services and the peak
+memory allocated by Python while it ran. Run from the repository root with
+
+    python -m benchmarks.run --neurons 2000 --latency 0.01 --output results.json
+
+and pass --baseline with an earlier results file to flag benchmarks that became slower, made more
+requests or used more memory.
+"""
+import argparse
+import importlib.util
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+import pandas as pd
+import adjacency
+import clients
+import edge_store
+import fanc_synapses
+import id_arrays
+import input_table
+import manc_synapses
+import neuron_graph
+from benchmarks.standins import SyntheticConnectome, install
+
+BENCHMARKS = {}
+
+def benchmark(name):
+    # register a benchmark. The decorated function is called with the connectome and does any setup that
+    # should not be measured, then returns the function to measure
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+def _first_layer(connectome, n=20):
+    return connectome.edges.loc[connectome.edges["pre"] == 0, "post"].head(n).to_list()
+
+@benchmark("fanc.fetch_downstream_synapses")
+def _(connectome):
+    return lambda: fanc_synapses.fetch_downstream_synapses(connectome.fanc_id(0))
+
+@benchmark("fanc.count_inputs")
+def _(connectome):
+    ids = [connectome.fanc_id(x) for x in _first_layer(connectome)]
+    return lambda: fanc_synapses.count_inputs(ids)
+
+@benchmark("fanc.get_percent_input")
+def _(connectome):
+    counts = fanc_synapses.downstream_of(connectome.fanc_id(0))["count"]
+    return lambda: fanc_synapses.get_percent_input(counts)
+
+@benchmark("fanc.downstream_of")
+def _(connectome):
+    return lambda: fanc_synapses.downstream_of(connectome.fanc_id(0))
+
+@benchmark("fanc.downstream_of_layer")
+def _(connectome):
+    ids = [connectome.fanc_id(x) for x in _first_layer(connectome)]
+    return lambda: fanc_synapses.downstream_of_layer(ids)
+
+@benchmark("fanc.downstream_of_layer_input_table")
+def _(connectome):
+    ids = [connectome.fanc_id(x) for x in _first_layer(connectome)]
+    table = _fanc_input_table(connectome)
+    return lambda: fanc_synapses.downstream_of_layer(ids, input_table=table)
+
+@benchmark("fanc.cascade_csvs")
+def _(connectome):
+    return lambda: fanc_synapses.cascade_csvs(connectome.fanc_id(0), layers=2, output="both")
+
+@benchmark("fanc.refresh_cascade")
+def _(connectome):
+    # a cascade whose first downstream partner has been replaced by proofreading since it was made
+    fanc_synapses.cascade_csvs(connectome.fanc_id(0), layers=2)
+    partners = id_arrays.read_table(os.path.join(str(connectome.fanc_id(0))+"-1",
+                                                 str(connectome.fanc_id(0))+"_downstreampartners.csv"))
+    clients.cave().chunkedgraph.edit(partners.index[0], connectome.fanc_id(connectome.n_neurons))
+    return lambda: fanc_synapses.refresh_cascade(connectome.fanc_id(0))
+
+@benchmark("fanc.make_csv")
+def _(connectome):
+    return lambda: fanc_synapses.make_csv(connectome.fanc_id(0))
+
+@benchmark("fanc.fetch_upstream_synapses")
+def _(connectome):
+    return lambda: fanc_synapses.fetch_upstream_synapses(connectome.fanc_id(0))
+
+@benchmark("fanc.spatial_filter")
+def _(connectome):
+    synapses = fanc_synapses.fetch_downstream_synapses_batch([connectome.fanc_id(x) for x in _first_layer(connectome)])
+    return lambda: fanc_synapses.spatial_filter(synapses, box=((0, 0, 0), (10**6, 118000, 10**6)), y_slabs=[(0, 60000), (80000, 118000)])
+
+@benchmark("fanc.update_fanc_ids")
+def _(connectome):
+    ids = [connectome.fanc_id(x) for x in range(min(connectome.n_neurons, 500))]
+    return lambda: fanc_synapses.update_fanc_ids(ids)
+
+@benchmark("fanc.mf_match")
+def _(connectome):
+    return lambda: [fanc_synapses.mf_match(connectome.manc_id(x)) for x in range(20)]
+
+@benchmark("fanc.fm_match")
+def _(connectome):
+    return lambda: [fanc_synapses.fm_match(connectome.fanc_id(x)) for x in range(20)]
+
+@benchmark("fanc.rank_matches")
+def _(connectome):
+    fanc = fanc_synapses.get_percent_input(fanc_synapses.downstream_of(connectome.fanc_id(0))["count"])
+    manc = manc_synapses.get_percent_input(connectome.manc_id(0))
+    return lambda: fanc_synapses.rank_matches(fanc.copy(), manc.copy())
+
+@benchmark("manc.fetch_downstream_connections")
+def _(connectome):
+    return lambda: manc_synapses.fetch_downstream_connections(connectome.manc_id(0))
+
+@benchmark("manc.get_percent_input")
+def _(connectome):
+    return lambda: manc_synapses.get_percent_input(connectome.manc_id(0))
+
+@benchmark("manc.get_type")
+def _(connectome):
+    ids = [connectome.manc_id(x) for x in _first_layer(connectome)]
+    return lambda: manc_synapses.get_type(ids)
+
+@benchmark("manc.percent_inputs")
+def _(connectome):
+    ids = [connectome.manc_id(x) for x in _first_layer(connectome)]
+    return lambda: manc_synapses.percent_inputs(ids, workers=4)
+
+@benchmark("manc.percent_inputs_input_table")
+def _(connectome):
+    ids = [connectome.manc_id(x) for x in _first_layer(connectome)]
+    table = input_table.InputTable.from_manc()
+    return lambda: manc_synapses.percent_inputs(ids, workers=4, input_table=table)
+
+@benchmark("manc.layer_percent_inputs")
+def _(connectome):
+    ids = [connectome.manc_id(x) for x in _first_layer(connectome)]
+    return lambda: manc_synapses.layer_percent_inputs(ids)
+
+@benchmark("manc.cascade_csvs_combined")
+def _(connectome):
+    return lambda: manc_synapses.cascade_csvs(connectome.manc_id(0), 1, layers=2, output="both", combined=True)
+
+@benchmark("manc.cascade_csvs")
+def _(connectome):
+    return lambda: manc_synapses.cascade_csvs(connectome.manc_id(0), 1, workers=4, layers=2, output="both")
+
+@benchmark("manc.fetch_upstream_connections")
+def _(connectome):
+    return lambda: manc_synapses.fetch_upstream_connections(connectome.manc_id(0))
+
+@benchmark("manc.downstream_of")
+def _(connectome):
+    return lambda: manc_synapses.downstream_of(connectome.manc_id(0), 1)
+
+@benchmark("manc.synapses_between")
+def _(connectome):
+    pairs = [(connectome.manc_id(0), connectome.manc_id(x)) for x in _first_layer(connectome)]
+    return lambda: [manc_synapses.synapses_between(*pair) for pair in pairs]
+
+@benchmark("neuron_graph.get_manc_types")
+def _(connectome):
+    ids = [connectome.manc_id(x) for x in range(min(connectome.n_neurons, 500))]
+    return lambda: neuron_graph.get_manc_types(ids)
+
+@benchmark("neuron_graph.get_fanc_types")
+def _(connectome):
+    _write_match_csv(connectome)
+    ids = [connectome.fanc_id(x) for x in range(min(connectome.n_neurons, 500))]
+    return lambda: neuron_graph.get_fanc_types(ids)
+
+@benchmark("neuron_graph.operator_function")
+def _(connectome):
+    # everything operator_function does except opening the interactive window
+    manc_synapses.cascade_csvs(connectome.manc_id(0), 1, layers=2, output="csv")
+    folder = str(connectome.manc_id(0))+"-1"
+    def run():
+        G, labels, colors, edge_colours = neuron_graph.display_graph(*neuron_graph.folder_graph_data(folder))
+        return neuron_graph.graph_layout(G, "layered", cache_folder=None)
+    return run
+
+@benchmark("neuron_graph.prepare_store_data")
+def _(connectome):
+    manc_synapses.cascade_csvs(connectome.manc_id(0), 1, layers=2, output="store")
+    store = os.path.join(str(connectome.manc_id(0))+"-1", edge_store.EDGE_STORE)
+    return lambda: neuron_graph.prepare_store_data(edge_store.read_edges(store))
+
+# scatter and show_graph open interactive windows, so their drawing is measured through render_scatter and
+# render_graph, which are only registered when matplotlib and netgraph are installed
+if importlib.util.find_spec("matplotlib"):
+    @benchmark("neuron_graph.render_scatter")
+    def _(connectome):
+        fanc = fanc_synapses.get_percent_input(fanc_synapses.downstream_of(connectome.fanc_id(0))["count"])
+        manc = manc_synapses.get_percent_input(connectome.manc_id(0))
+        table = fanc_synapses.rank_matches(fanc, manc)
+        return lambda: neuron_graph.render_scatter(table, "scatter.png")
+
+if importlib.util.find_spec("matplotlib") and importlib.util.find_spec("netgraph"):
+    @benchmark("neuron_graph.render_graph")
+    def _(connectome):
+        manc_synapses.cascade_csvs(connectome.manc_id(0), 1, layers=2, output="csv")
+        data = neuron_graph.folder_graph_data(str(connectome.manc_id(0))+"-1")
+        return lambda: neuron_graph.render_graph(*data, "graph.svg", layout="layered")
+
+@benchmark("adjacency.manc_adjacency")
+def _(connectome):
+    ids = [connectome.manc_id(x) for x in range(min(connectome.n_neurons, 300))]
+    return lambda: adjacency.manc_adjacency(ids)
+
+@benchmark("adjacency.fanc_adjacency")
+def _(connectome):
+    ids = [connectome.fanc_id(x) for x in range(min(connectome.n_neurons, 300))]
+    return lambda: adjacency.fanc_adjacency(ids)
+
+def _fanc_input_table(connectome):
+    # the input table a FANC synapse table export would give
+    counts = connectome.synapses["post_pt_root_id"].value_counts()
+    ids = pd.Index([connectome.fanc_id(x) for x in range(connectome.n_neurons)], dtype="int64")
+    return input_table.InputTable(pd.DataFrame({"inputs": counts.reindex(ids, fill_value=0)}), "fanc")
+
+def _write_match_csv(connectome):
+    matches = connectome.matches
+    pd.DataFrame({"queryID": matches["queryID"], "match": matches["nBlastMatchID"]}).to_csv(neuron_graph.MATCH_CSV,
+                                                                                            index=False)
+
+def measure(name, connectome, latency=0.0, repeat=3):
+    """Run one benchmark repeat times, each time in a new empty working directory with fresh stand-in
+    services, and return its median wall time, requests made and peak traced memory."""
+    walls, requests, peaks = [], [], []
+    cwd = os.getcwd()
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as folder:
+            os.chdir(folder)
+            # the analysis functions print their progress, which is hidden while benchmarking
+            stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+            try:
+                log = install(connectome, latency)
+                run = BENCHMARKS[name](connectome)
+                log.reset()
+                tracemalloc.start()
+                start = time.perf_counter()
+                try:
+                    run()
+                finally:
+                    walls.append(time.perf_counter()-start)
+                    peaks.append(tracemalloc.get_traced_memory()[1])
+                    tracemalloc.stop()
+                requests.append(dict(log.counts))
+            finally:
+                sys.stdout.close()
+                sys.stdout = stdout
+                os.chdir(cwd)
+    return {"wall_s": statistics.median(walls), "requests": sum(requests[-1].values()),
+            "requests_by_call": requests[-1], "peak_bytes": max(peaks)}
+
+def compare(results, baseline, tolerance=0.2):
+    """Return a list of messages for benchmarks that are slower or use more memory than the baseline by
+    more than tolerance, or that make more requests."""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]
+        if result["requests"] > before["requests"]:
+            regressions.append("%s: %d requests, was %d" % (name, result["requests"], before["requests"]))
+        if result["wall_s"] > before["wall_s"]*(1+tolerance):
+            regressions.append("%s: %.3f s, was %.3f s" % (name, result["wall_s"], before["wall_s"]))
+        if result["peak_bytes"] > before["peak_bytes"]*(1+tolerance):
+            regressions.append("%s: peak %d bytes, was %d" % (name, result["peak_bytes"], before["peak_bytes"]))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--neurons", type=int, default=2000, help="number of neurons in the synthetic connectome")
+    parser.add_argument("--fanout", type=float, default=20, help="mean number of downstream partners per neuron")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds slept on every stand-in request")
+    parser.add_argument("--repeat", type=int, default=3, help="number of runs of each benchmark")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--only", nargs="*", help="names of the benchmarks to run, all if not passed")
+    parser.add_argument("--output", help="filepath to write the results to as JSON")
+    parser.add_argument("--baseline", help="results file of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed fractional increase in time and memory")
+    args = parser.parse_args(argv)
+
+    connectome = SyntheticConnectome(args.neurons, args.fanout, seed=args.seed)
+    results = {}
+    for name in args.only or BENCHMARKS:
+        results[name] = measure(name, connectome, args.latency, args.repeat)
+        print("%-40s %9.3f s %7d requests %9.1f MiB" % (name, results[name]["wall_s"], results[name]["requests"],
+                                                          results[name]["peak_bytes"]/2**20))
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({"settings": vars(args), "results": results}, file, indent=1)
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file)["results"], args.tolerance)
+        for regression in regressions:
+            print("REGRESSION", regression)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
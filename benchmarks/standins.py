@@ -0,0 +1,345 @@
+"""Synthetic connectome and stand-in CAVE, neuprint and SeaTable clients for the benchmarks.
+
+The stand-ins answer the same calls the analysis modules make on the real services, from a synthetic
+connectome held in memory, and count every request. An optional latency is slept on each request to
+mimic a network round trip.
+"""
+import datetime
+import re
+import threading
+import time
+import numpy as np
+import pandas as pd
+import clients
+import input_table
+import lineage
+import neuron_metadata
+
+FANC_OFFSET = 648518346400000000
+MANC_OFFSET = 10000
+# the time of the one materialization version of the stand-in CAVE
+MATERIALIZED = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+NEURONS_TO_AVOID_ROIS = ["ANm", "LegNp(T3)(L)", "LegNp(T3)(R)", "HTct(UTct-T3)(L)", "HTct(UTct-T3)(R)"]
+
+class SyntheticConnectome:
+    """A random connectome with a heavy-tailed fan-out, shared by the FANC and MANC stand-ins.
+
+    Neuron i is FANC root ID FANC_OFFSET+i and MANC body ID MANC_OFFSET+i. Neuron 0 is a hub with
+    several times the mean fan-out, to be used as the start of cascades.
+
+    Parameters
+    ----------
+    n_neurons :         int
+                        number of neurons
+    fanout :            float
+                        mean number of downstream partners per neuron
+    synapses :          float
+                        mean number of synapses per connection
+    seed :              int
+                        random seed, so that every run benchmarks the same connectome
+
+    """
+    def __init__(self, n_neurons=2000, fanout=20, synapses=8, seed=0):
+        rng = np.random.default_rng(seed)
+        self.n_neurons = n_neurons
+        degree = np.minimum(rng.lognormal(np.log(fanout)-0.5, 1.0, n_neurons).astype(int)+1, n_neurons-1)
+        degree[0] = min(int(fanout*5), n_neurons-1)
+        # partners are drawn with a preference for low neuron numbers, giving some strongly connected hubs
+        popularity = 1/np.arange(1, n_neurons+1)**0.5
+        popularity /= popularity.sum()
+        pre, post = [], []
+        for neuron, n in enumerate(degree):
+            partners = rng.choice(n_neurons, size=n, replace=False, p=popularity)
+            partners = partners[partners != neuron]
+            pre.append(np.full(len(partners), neuron))
+            post.append(partners)
+        pre, post = np.concatenate(pre), np.concatenate(post)
+        weight = rng.geometric(1/synapses, len(pre))
+        self.edges = pd.DataFrame({"pre": pre, "post": post, "weight": weight})
+
+        # neuron table: most neurons have a soma, a few are fragments or leave for posterior neuropils
+        self.neurons = pd.DataFrame({
+            "soma": rng.random(n_neurons) > 0.1,
+            "excluded": rng.random(n_neurons) < 0.05,
+            "type": ["IN%02dA%03d" % (i % 20, i % 50) if i % 7 else "MN%d" % (i % 30) for i in range(n_neurons)],
+            "side": rng.choice(["LHS", "RHS", "Midline"], n_neurons),
+            "nt": rng.choice(["acetylcholine", "glutamate", "gaba", "unknown"], n_neurons),
+        })
+        self.neurons.loc[0, ["soma", "excluded"]] = [True, False]
+        self.neurons["post"] = np.bincount(post, weights=weight, minlength=n_neurons).astype("int64")
+
+        # one row per FANC synapse with a presynapse position, about half of them in T1 (y below 118000)
+        n_synapses = int(weight.sum())
+        self.synapses = pd.DataFrame({
+            "pre_pt_root_id": FANC_OFFSET+np.repeat(pre, weight),
+            "post_pt_root_id": FANC_OFFSET+np.repeat(post, weight),
+            "pre_pt_position_x": rng.integers(0, 100000, n_synapses),
+            "pre_pt_position_y": rng.integers(0, 240000, n_synapses),
+            "pre_pt_position_z": rng.integers(0, 5000, n_synapses),
+        })
+
+        # matching table: some manual assignments, mostly agreeing nBlast and connectivity matches
+        manual = rng.random(n_neurons) < 0.1
+        agree = rng.random(n_neurons) < 0.7
+        other = (np.arange(n_neurons)+1) % n_neurons
+        self.matches = pd.DataFrame({
+            "queryID": [str(MANC_OFFSET+i) for i in range(n_neurons)],
+            "manualAssignment": [str(FANC_OFFSET+i) if m else None for i, m in enumerate(manual)],
+            "nBlastMatchID": [str(FANC_OFFSET+i) for i in range(n_neurons)],
+            "conMatchID": [str(FANC_OFFSET+(i if a else o)) for i, a, o in zip(range(n_neurons), agree, other)],
+            "check_L_R": [["Yes"] if i % 11 == 0 else ["No"] for i in range(n_neurons)],
+        })
+
+    def fanc_id(self, neuron):
+        return FANC_OFFSET+int(neuron)
+
+    def manc_id(self, neuron):
+        return MANC_OFFSET+int(neuron)
+
+class RequestLog:
+    """Thread-safe count of requests made to each stand-in service, with an optional latency per request."""
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def request(self, name):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0)+1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def total(self):
+        with self._lock:
+            return sum(self.counts.values())
+
+    def reset(self):
+        with self._lock:
+            self.counts = {}
+
+class StandInCAVE:
+    """Stands in for caveclient.CAVEclient, answering synapse queries and chunkedgraph lineage calls.
+
+    Proofreading is mimicked with chunkedgraph.edit. Materialized queries keep seeing the root IDs of
+    MATERIALIZED, while live queries at a timestamp see the IDs edited by then.
+    """
+    def __init__(self, connectome, log):
+        self.chunkedgraph = _ChunkedGraph(log)
+        self.materialize = _Materialize(connectome, log, self.chunkedgraph)
+
+class _Materialize:
+    version = 1
+
+    def __init__(self, connectome, log, chunkedgraph):
+        self._synapses = connectome.synapses
+        self._log = log
+        self._chunkedgraph = chunkedgraph
+
+    def get_timestamp(self, version=None, **kwargs):
+        self._log.request("cave.get_timestamp")
+        return MATERIALIZED
+
+    def synapse_query(self, pre_ids=None, post_ids=None, materialization_version=None, split_positions=False,
+                      limit=None, offset=None, timestamp=None, bounding_box=None, bounding_box_column="post_pt_position",
+                      **kwargs):
+        self._log.request("cave.synapse_query")
+        synapses = self._synapses
+        if timestamp is not None:
+            synapses = self._chunkedgraph.live(synapses, timestamp)
+        if bounding_box is not None:
+            # only presynapse positions are held, bounds included
+            assert bounding_box_column == "pre_pt_position"
+            positions = synapses[["pre_pt_position_x", "pre_pt_position_y", "pre_pt_position_z"]].to_numpy()
+            synapses = synapses.loc[((positions >= bounding_box[0]) & (positions <= bounding_box[1])).all(axis=1)]
+        if pre_ids is not None:
+            synapses = synapses.loc[synapses["pre_pt_root_id"].isin(np.asarray(pre_ids, dtype="int64"))]
+        if post_ids is not None:
+            synapses = synapses.loc[synapses["post_pt_root_id"].isin(np.asarray(post_ids, dtype="int64"))]
+        start = offset or 0
+        synapses = synapses.iloc[start:start+limit] if limit is not None else synapses.iloc[start:]
+        return synapses.reset_index(drop=True)
+
+class _ChunkedGraph:
+    # every root ID is the latest unless it has been marked as edited. Edits put straight into the edits
+    # dictionary count as made just after MATERIALIZED
+    def __init__(self, log):
+        self._log = log
+        self.edits = {}
+        self.edit_times = {}
+
+    def edit(self, old_id, new_id, when=None):
+        """Record that proofreading replaced old_id by new_id, which takes over its synapses, at when
+        (by default now)."""
+        self.edits[int(old_id)] = int(new_id)
+        self.edit_times[int(old_id)] = when or datetime.datetime.now(datetime.timezone.utc)
+
+    def live(self, synapses, timestamp):
+        # the synapses with the root IDs of timestamp, following every edit made by then
+        made = {old: new for old, new in self.edits.items() if self._edited_at(old) <= timestamp}
+        if not made:
+            return synapses
+        latest = {}
+        for old in made:
+            new = made[old]
+            while new in made:
+                new = made[new]
+            latest[old] = new
+        synapses = synapses.copy()
+        for column in ("pre_pt_root_id", "post_pt_root_id"):
+            synapses[column] = synapses[column].replace(latest)
+        return synapses
+
+    def _edited_at(self, root_id):
+        return self.edit_times.get(root_id, MATERIALIZED+datetime.timedelta(seconds=1))
+
+    def is_latest_roots(self, root_ids, **kwargs):
+        self._log.request("cave.is_latest_roots")
+        return np.array([int(x) not in self.edits for x in root_ids])
+
+    def suggest_latest_roots(self, root_id, **kwargs):
+        self._log.request("cave.suggest_latest_roots")
+        root_id = int(root_id)
+        while root_id in self.edits:
+            root_id = self.edits[root_id]
+        return root_id
+
+    def get_past_ids(self, root_ids, **kwargs):
+        self._log.request("cave.get_past_ids")
+        past = {}
+        for old, new in self.edits.items():
+            past.setdefault(new, []).append(old)
+        root_ids = np.atleast_1d(root_ids)
+        return {"past_id_map": {int(x): past.get(int(x), []) for x in root_ids}, "future_id_map": {}}
+
+    def get_delta_roots(self, timestamp_past, timestamp_future=None, **kwargs):
+        self._log.request("cave.get_delta_roots")
+        old = [x for x in self.edits if timestamp_past <= self._edited_at(x)
+               and (timestamp_future is None or self._edited_at(x) <= timestamp_future)]
+        return np.array(old, dtype="int64"), np.array([self.edits[x] for x in old], dtype="int64")
+
+class StandInNeuprint:
+    """Stands in for the neuprint module, answering the query functions the MANC code calls."""
+    def __init__(self, connectome, log):
+        self._connectome = connectome
+        self._log = log
+        edges = connectome.edges
+        self._edges = pd.DataFrame({"bodyId_pre": MANC_OFFSET+edges["pre"], "bodyId_post": MANC_OFFSET+edges["post"],
+                                    "weight": edges["weight"]})
+        neurons = connectome.neurons
+        ids = MANC_OFFSET+np.arange(connectome.n_neurons)
+        self._neurons = pd.DataFrame({
+            "bodyId": ids,
+            "type": neurons["type"],
+            "somaSide": np.where(neurons["soma"], neurons["side"].str[0], None),
+            "rootSide": neurons["side"].str[0],
+            "predictedNt": neurons["nt"],
+            "somaLocation": [[1.0, 2.0, 3.0] if soma else None for soma in neurons["soma"]],
+            "post": neurons["post"],
+        })
+        self._excluded = set(ids[neurons["excluded"].to_numpy()])
+        self.queries = _Queries()
+        self.NeuronCriteria = _NeuronCriteria
+
+    def fetch_simple_connections(self, upstream_criteria=None, downstream_criteria=None, rois=None, client=None, **kwargs):
+        self._log.request("neuprint.fetch_simple_connections")
+        connections = self._edges
+        upstream = _body_ids(upstream_criteria)
+        downstream = _body_ids(downstream_criteria)
+        if upstream is not None:
+            connections = connections.loc[connections["bodyId_pre"].isin(upstream)]
+        if downstream is not None:
+            connections = connections.loc[connections["bodyId_post"].isin(downstream)]
+        return connections.sort_values("weight", ascending=False).reset_index(drop=True)
+
+    def fetch_neurons(self, criteria, client=None, **kwargs):
+        self._log.request("neuprint.fetch_neurons")
+        body_ids = _body_ids(criteria)
+        neurons = self._neurons.loc[self._neurons["bodyId"].isin(body_ids)] if body_ids is not None else self._neurons
+        if isinstance(criteria, _NeuronCriteria) and set(criteria.rois or []) & set(NEURONS_TO_AVOID_ROIS):
+            neurons = neurons.loc[neurons["bodyId"].isin(self._excluded)]
+        return neurons.reset_index(drop=True), pd.DataFrame(columns=["bodyId", "roi", "pre", "post"])
+
+    def fetch_custom(self, cypher, dataset="", format="pandas", client=None):
+        # only the Cypher queries the analysis modules send are understood
+        self._log.request("neuprint.fetch_custom")
+        if cypher == input_table.MANC_QUERY:
+            return pd.DataFrame({"bodyId": self._neurons["bodyId"], "post": self._neurons["post"],
+                                 "soma": self._neurons["somaLocation"].notna()})
+        sources = re.match(r"WITH \[([0-9,]*)\] AS sources", cypher)
+        if sources and cypher.endswith("AS excluded"):
+            # manc_synapses.LAYER_QUERY
+            sources = [int(x) for x in sources.group(1).split(",") if x]
+            connections = self._edges.loc[self._edges["bodyId_pre"].isin(sources) & (self._edges["weight"] > 10)]
+            neurons = self._neurons.set_index("bodyId").loc[connections["bodyId_post"]]
+            return pd.DataFrame({"bodyId_pre": connections["bodyId_pre"].to_numpy(),
+                                 "bodyId_post": connections["bodyId_post"].to_numpy(),
+                                 "weight": connections["weight"].to_numpy(), "post": neurons["post"].to_numpy(),
+                                 "soma": neurons["somaLocation"].notna().to_numpy(),
+                                 "excluded": connections["bodyId_post"].isin(self._excluded).to_numpy()})
+        raise NotImplementedError("the stand-in neuprint does not answer this query:\n"+cypher)
+
+class _NeuronCriteria:
+    def __init__(self, bodyId=None, rois=None, roi_req="all", client=None, **kwargs):
+        self.bodyId = bodyId
+        self.rois = rois
+        self.roi_req = roi_req
+
+class _Queries:
+    NeuronCriteria = _NeuronCriteria
+
+class StandInNeuprintClient:
+    """Stands in for neuprint.Client."""
+    dataset = "vnc"
+
+    def __init__(self, log):
+        self._log = log
+
+    def fetch_datasets(self):
+        self._log.request("neuprint.fetch_datasets")
+        return {"vnc": {"uuid": "synthetic"}}
+
+class StandInSeaTable:
+    """Stands in for seaserpent.Table, filtering the matching table with boolean masks of its columns."""
+    def __init__(self, matches, log):
+        self._table = matches
+        self._log = log
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self._table[name]
+
+    def __getitem__(self, mask):
+        self._log.request("seatable.query")
+        return self._table.loc[mask].copy()
+
+    def __len__(self):
+        return len(self._table)
+
+    def __bool__(self):
+        return True
+
+    def to_frame(self):
+        self._log.request("seatable.query")
+        return self._table.copy()
+
+def install(connectome, latency=0.0):
+    """Register stand-in clients for every service in the shared client registry, with fresh in-memory
+    caches, and return the RequestLog counting their requests."""
+    log = RequestLog(latency)
+    clients.reset()
+    clients.override("cave", StandInCAVE(connectome, log))
+    clients.override("neuprint_api", StandInNeuprint(connectome, log))
+    clients.override("neuprint", StandInNeuprintClient(log))
+    clients.override("seatable", StandInSeaTable(connectome.matches, log))
+    clients.override("lineage", lineage.LineageResolver())
+    clients.override("metadata", neuron_metadata.NeuronMetadata(path=None))
+    return log
+
+def _body_ids(criteria):
+    # the body IDs a criteria argument is limited to, or None if it is not limited
+    if criteria is None:
+        return None
+    if isinstance(criteria, _NeuronCriteria):
+        return None if criteria.bodyId is None else np.asarray(criteria.bodyId, dtype="int64")
+    return np.asarray(list(np.atleast_1d(criteria)), dtype="int64")
@@ -0,0 +1,153 @@
+import json
+import os
+import atomic_file
+import edge_store
+import id_arrays
+import instrumentation
+
+# name of the file inside a cascade folder recording how far the cascade has got
+CHECKPOINT = "cascade_checkpoint.json"
+# name of the file inside a cascade folder breaking down the cost of the last run, see instrumentation
+REPORT = "cascade_report.json"
+
+def run_cascade(start_neuron, folder, expand_layer, layers=None, batch_size=None, stamp=None):
+    """Breadth-first walk downstream from a start neuron, visiting each neuron once.
+
+    Every neuron of a layer that has no saved output yet is passed to expand_layer, which queries and saves
+    its downstream partners. After every batch the frontier and the finished neurons are written to a
+    checkpoint in the folder, so an interrupted cascade resumes where it stopped without querying finished
+    neurons again. Neurons that already have saved output, from this or an earlier run, are not queried and
+    their partners are read back from the folder instead.
+
+    Every request and timed step of the run is recorded, and when the run ends, or is interrupted, a
+    breakdown per call, per layer and per neuron is written to REPORT in the folder.
+
+    Parameters
+    ----------
+    start_neuron :      int
+                        ID of the neuron the cascade starts from
+    folder :            str
+                        cascade folder holding the saved output and the checkpoint
+    expand_layer :      function
+                        called as expand_layer(neuron_ids, layer) for a list of neurons of the same layer. It must
+                        save their downstream partners and return a dictionary of neuron_id:list of partner IDs.
+    layers :            int or None
+                        number of hops downstream from the start neuron, or None to continue until no new
+                        neurons are found
+    batch_size :        int or None
+                        number of neurons passed to expand_layer at once, and so how often the checkpoint is
+                        written. If None the whole layer is expanded at once.
+    stamp :             dict
+                        entries recorded in a new checkpoint describing the data the cascade is made from, such
+                        as the materialization version and its timestamp (seconds since the epoch) of a FANC
+                        cascade, see fanc_synapses.refresh_cascade
+
+    Returns
+    -------
+    dict
+                        dictionary of neuron_id:layer for every neuron reached
+
+    """
+    with instrumentation.recording() as recorder:
+        try:
+            return _walk(start_neuron, folder, expand_layer, layers, batch_size, stamp)
+        finally:
+            recorder.save(os.path.join(folder, REPORT))
+
+def _walk(start_neuron, folder, expand_layer, layers, batch_size, stamp):
+    start_neuron = int(start_neuron)
+    state = load_checkpoint(folder)
+    if state is None or state["start"] != start_neuron:
+        state = {"start": start_neuron, "layer": 0, "frontier": [start_neuron], "depth": {start_neuron: 0}, "done": [],
+                 **(stamp or {})}
+    depth = state["depth"]
+    done = set(state["done"])
+    read_partners = saved_partners(folder)
+
+    while state["frontier"] and (layers is None or state["layer"] < layers):
+        layer = state["layer"]
+        frontier = state["frontier"]
+        print("layer", layer+1, "-", len(frontier), "neurons")
+        partners = {}
+        to_query = []
+        for neuron_id in frontier:
+            saved = read_partners(neuron_id)
+            if saved is not None or neuron_id in done:
+                partners[neuron_id] = saved or []
+                print(neuron_id, "file already exists")
+            else:
+                to_query.append(neuron_id)
+        size = batch_size or max(len(to_query), 1)
+        for i in range(0, len(to_query), size):
+            with instrumentation.context(layer=layer):
+                partners.update(expand_layer(to_query[i:i+size], layer))
+            done.update(to_query[i:i+size])
+            state["done"] = sorted(done)
+            save_checkpoint(folder, state)
+
+        next_frontier = []
+        for neuron_id in frontier:
+            for partner in partners[neuron_id]:
+                partner = int(partner)
+                if partner not in depth:
+                    depth[partner] = layer+1
+                    next_frontier.append(partner)
+        state["layer"] = layer+1
+        state["frontier"] = next_frontier
+        save_checkpoint(folder, state)
+    return depth
+
+def checkpoint_from_folder(start_neuron, folder):
+    """Build a checkpoint for a cascade folder that was written without one, by walking the saved output
+    out from the start neuron. The checkpoint has no version or timestamp as the data the outputs were made
+    from is unknown."""
+    start_neuron = int(start_neuron)
+    read_partners = saved_partners(folder)
+    depth = {start_neuron: 0}
+    done = []
+    frontier = [start_neuron]
+    layer = 0
+    while frontier:
+        saved = {neuron_id: read_partners(neuron_id) for neuron_id in frontier}
+        if all(partners is None for partners in saved.values()):
+            break
+        next_frontier = []
+        for neuron_id, partners in saved.items():
+            if partners is None:
+                continue
+            done.append(neuron_id)
+            for partner in partners:
+                if int(partner) not in depth:
+                    depth[int(partner)] = layer+1
+                    next_frontier.append(int(partner))
+        frontier = next_frontier
+        layer += 1
+    return {"start": start_neuron, "layer": layer, "frontier": frontier, "depth": depth, "done": sorted(done)}
+
+def load_checkpoint(folder):
+    """Return the checkpoint saved in a cascade folder, or None if there is none."""
+    path = os.path.join(folder, CHECKPOINT)
+    if not os.path.exists(path):
+        return None
+    with open(path) as file:
+        state = json.load(file)
+    state["depth"] = {int(neuron_id): layer for neuron_id, layer in state["depth"].items()}
+    return state
+
+def save_checkpoint(folder, state):
+    with atomic_file.write(os.path.join(folder, CHECKPOINT)) as file:
+        json.dump({**state, "depth": {str(neuron_id): layer for neuron_id, layer in state["depth"].items()}}, file)
+
+def saved_partners(folder):
+    """Return a function that gives the saved downstream partners of a neuron in a cascade folder,
+    from its _downstreampartners.csv file or the edge table, or None if nothing is saved for it."""
+    edges = edge_store.read_edges(os.path.join(folder, edge_store.EDGE_STORE))
+    from_store = {pre: group["post"].to_list() for pre, group in edges.groupby("pre", sort=False)}
+    def read_partners(neuron_id):
+        if int(neuron_id) in from_store:
+            return from_store[int(neuron_id)]
+        path = os.path.join(folder, str(neuron_id)+"_downstreampartners.csv")
+        if os.path.exists(path):
+            return id_arrays.read_table(path).index.to_list()
+        return None
+    return read_partners
@@ -0,0 +1,111 @@
+import os
+import threading
+
+CAVE_DATASTACK = 'fanc_production_mar2021'
+NEUPRINT_SERVER = 'neuprint-pre.janelia.org'
+NEUPRINT_DATASET = 'vnc'
+MATCH_TABLE = 'fanc851_manc_nblast95_60'
+# folder for local copies of remote tables, shared by every working directory
+CACHE_FOLDER = os.environ.get('T1_CACHE_FOLDER', os.path.join(os.path.expanduser('~'), '.cache', 't1_motor_neurons'))
+
+_lock = threading.RLock()
+_clients = {}
+
+def _make_cave():
+    import caveclient
+    return caveclient.CAVEclient(CAVE_DATASTACK)
+
+def _make_neuprint():
+    import neuprint
+    return neuprint.Client(NEUPRINT_SERVER, dataset=NEUPRINT_DATASET)
+
+def _make_neuprint_api():
+    import neuprint
+    return neuprint
+
+def _make_seatable():
+    import seaserpent
+    return seaserpent.Table(table=MATCH_TABLE)
+
+def _make_lineage():
+    import lineage
+    return lineage.LineageResolver()
+
+def _make_match_index():
+    import match_index
+    return match_index.shared_index()
+
+def _make_metadata():
+    import neuron_metadata
+    return neuron_metadata.NeuronMetadata()
+
+_factories = {
+    "cave": _make_cave,
+    "neuprint": _make_neuprint,
+    "neuprint_api": _make_neuprint_api,
+    "seatable": _make_seatable,
+    "lineage": _make_lineage,
+    "match_index": _make_match_index,
+    "metadata": _make_metadata,
+}
+
+def get(name):
+    """Return the shared client registered under name, creating it on first use.
+
+    Parameters
+    ----------
+    name :              str
+                        one of "cave" (caveclient.CAVEclient for FANC), "neuprint" (neuprint.Client for MANC),
+                        "neuprint_api" (the neuprint module whose query functions are called) or
+                        "seatable" (seaserpent.Table holding the FANC-MANC matches),
+                        "lineage" (lineage.LineageResolver remembering FANC root ID updates),
+                        "match_index" (match_index.MatchIndex, a local copy of the matching table) or
+                        "metadata" (neuron_metadata.NeuronMetadata, cached MANC neuron metadata)
+
+    Returns
+    -------
+    object
+                        the shared client
+
+    """
+    with _lock:
+        if name not in _clients:
+            _clients[name] = _factories[name]()
+        return _clients[name]
+
+def override(name, client):
+    """Replace the shared client registered under name, for example with a stand-in client for testing."""
+    if name not in _factories:
+        raise KeyError("unknown client "+str(name))
+    with _lock:
+        _clients[name] = client
+
+def reset(name=None):
+    """Forget the shared client registered under name, or every client if no name is passed,
+    so that it is created again on next use."""
+    with _lock:
+        if name is None:
+            _clients.clear()
+        else:
+            _clients.pop(name, None)
+
+def cave():
+    return get("cave")
+
+def neuprint_client():
+    return get("neuprint")
+
+def neuprint_api():
+    return get("neuprint_api")
+
+def seatable():
+    return get("seatable")
+
+def lineage():
+    return get("lineage")
+
+def match_index():
+    return get("match_index")
+
+def metadata():
+    return get("metadata")
@@ -0,0 +1,183 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from scipy import sparse
+import clients
+import influence
+
+# summary table written by compare_folders
+SUMMARY = "cascade_comparison.csv"
+SUMMARY_COLUMNS = ["manc_id", "fanc_id", "cosine", "overlap", "manc_partners", "fanc_partners", "manc_unmatched",
+                   "fanc_unmatched", "manc_no_match"]
+
+def cascade_partners(folder):
+    """Return the pre, post and percent columns of every connection saved in a cascade folder, read from its
+    edge table or its _downstreampartners.csv files."""
+    edges = influence.folder_edges(folder)
+    return edges.drop_duplicates(["pre", "post"])[["pre", "post", "percent"]].reset_index(drop=True)
+
+def match_map(manc_ids, index=None, resolver=None):
+    """Return a Series of the current FANC ID matched to each MANC ID that has a match, looked up all at
+    once in the match index (see match_index.MatchIndex.fanc_matches). If index is not passed the shared
+    match index is used."""
+    if index is None:
+        index = clients.match_index()
+    manc_ids = pd.unique(np.asarray(list(manc_ids), dtype="int64"))
+    matches = index.fanc_matches(manc_ids, resolver).dropna()
+    return pd.Series(matches.to_numpy(dtype="int64"), index=matches.index.astype("int64"), dtype="int64")
+
+def compare_edges(fanc_edges, manc_edges, matches):
+    """Compare the partners of every MANC cascade neuron with those of its FANC match, for all matched
+    pairs at once.
+
+    Each neuron's partners are held as a row of a sparse matrix of percentage inputs, with MANC partners
+    placed in the column of their FANC match so that the MANC and FANC rows of a pair line up. MANC
+    partners without a match get columns of their own.
+
+    Parameters
+    ----------
+    fanc_edges :        pandas DataFrame
+                        pre, post and percent columns of a FANC cascade, see cascade_partners
+    manc_edges :        pandas DataFrame
+                        pre, post and percent columns of a MANC cascade
+    matches :           pandas Series
+                        FANC ID matched to each MANC ID, see match_map
+
+    Returns
+    -------
+    pandas DataFrame
+                        one row per MANC neuron with partners whose match has partners in the FANC cascade,
+                        with columns -
+                            manc_id, fanc_id: the pair of source neurons
+                            cosine: cosine similarity of their aligned percentage input vectors
+                            overlap: number of partners present on both sides
+                            manc_partners, fanc_partners: number of partners on each side
+                            manc_unmatched, fanc_unmatched: percentage input onto partners with no
+                                counterpart among the partners of the other side
+                            manc_no_match: percentage input onto MANC partners with no FANC match at all
+
+    """
+    fanc_sources = pd.unique(fanc_edges["pre"].to_numpy(dtype="int64"))
+    manc_sources = pd.unique(manc_edges["pre"].to_numpy(dtype="int64"))
+    paired = matches.reindex(manc_sources).dropna().astype("int64")
+    paired = paired.loc[paired.isin(fanc_sources)]
+    paired = paired.loc[~paired.duplicated()]
+    if not len(paired):
+        return pd.DataFrame(columns=SUMMARY_COLUMNS)
+    manc, fanc, keys = _aligned(fanc_edges, manc_edges, matches, paired)
+    shape = (len(paired), len(keys))
+    m = sparse.csr_matrix((manc["percent"].to_numpy(dtype="float64"), (manc["pair"], manc["column"])), shape=shape)
+    f = sparse.csr_matrix((fanc["percent"].to_numpy(dtype="float64"), (fanc["pair"], fanc["column"])), shape=shape)
+    dot = np.asarray(m.multiply(f).sum(axis=1)).ravel()
+    norms = np.sqrt(np.asarray(m.multiply(m).sum(axis=1)).ravel()*np.asarray(f.multiply(f).sum(axis=1)).ravel())
+    both = (m > 0).multiply(f > 0)
+    return pd.DataFrame({
+        "manc_id": paired.index.to_numpy(dtype="int64"),
+        "fanc_id": paired.to_numpy(dtype="int64"),
+        "cosine": np.divide(dot, norms, out=np.zeros_like(dot), where=norms > 0),
+        "overlap": np.asarray(both.sum(axis=1)).ravel().astype("int64"),
+        "manc_partners": m.getnnz(axis=1),
+        "fanc_partners": f.getnnz(axis=1),
+        "manc_unmatched": np.asarray((m-m.multiply(f > 0)).sum(axis=1)).ravel(),
+        "fanc_unmatched": np.asarray((f-f.multiply(m > 0)).sum(axis=1)).ravel(),
+        "manc_no_match": np.bincount(manc["pair"], weights=manc["percent"]*manc["no_match"], minlength=len(paired)),
+    })
+
+def aligned_partners(fanc_edges, manc_edges, matches, manc_id):
+    """Return the partners of one MANC neuron and of its FANC match side by side, in the format of
+    fanc_synapses.rank_matches, so that it can be drawn with neuron_graph.scatter or render_scatter.
+    percent_x is the MANC percentage input and percent_y the FANC one."""
+    paired = matches.reindex([int(manc_id)]).dropna().astype("int64")
+    manc, fanc, keys = _aligned(fanc_edges, manc_edges, matches, paired)
+    # MANC partners that share a FANC match are summed, as they are in compare_edges
+    manc = manc.groupby("column").agg(manc=("post", "first"), percent_x=("percent", "sum"))
+    fanc = fanc.groupby("column").agg(fanc=("post", "first"), percent_y=("percent", "sum"))
+    table = pd.concat([manc, fanc], axis=1).reindex(np.arange(len(keys)))
+    table.index = keys
+    table = table[["manc", "percent_x", "fanc", "percent_y"]].astype({"manc": "Int64", "fanc": "Int64"})
+    # MANC partners without a match are labelled with their MANC ID
+    table["fanc"] = table["fanc"].fillna(pd.Series(np.where(keys < 0, -keys, keys), index=keys))
+    return table.reset_index(drop=True)
+
+def _aligned(fanc_edges, manc_edges, matches, paired):
+    # the edges of the paired sources, each with the row of its pair and the column of its partner. MANC
+    # partners are placed under their FANC match, or under minus their own ID if they have none
+    manc = manc_edges.loc[manc_edges["pre"].isin(paired.index)].copy()
+    manc["pair"] = paired.index.get_indexer(manc["pre"])
+    partner_matches = matches.reindex(manc["post"].to_numpy(dtype="int64"))
+    manc["no_match"] = partner_matches.isna().to_numpy()
+    manc["key"] = np.where(manc["no_match"], -manc["post"].to_numpy(dtype="int64"),
+                           partner_matches.fillna(0).to_numpy(dtype="int64"))
+    fanc = fanc_edges.loc[fanc_edges["pre"].isin(paired.to_numpy())].copy()
+    fanc["pair"] = pd.Index(paired.to_numpy()).get_indexer(fanc["pre"])
+    fanc["key"] = fanc["post"].to_numpy(dtype="int64")
+    keys = np.unique(np.concatenate([manc["key"].to_numpy(dtype="int64"), fanc["key"].to_numpy(dtype="int64")]))
+    manc["column"] = np.searchsorted(keys, manc["key"].to_numpy(dtype="int64"))
+    fanc["column"] = np.searchsorted(keys, fanc["key"].to_numpy(dtype="int64"))
+    return manc, fanc, keys
+
+def compare_folders(folder_pairs, output=SUMMARY, plot_folder=None, processes=None, index=None, resolver=None):
+    """Compare whole FANC and MANC cascades and write one summary table of every matched pair of neurons.
+
+    The cascade folders are read and compared on a pool of processes. Matches are looked up once in this
+    process for every MANC neuron of every cascade, so the workers need no access to the match index.
+
+    Parameters
+    ----------
+    folder_pairs :      list of tuples
+                        (FANC cascade folder, MANC cascade folder) pairs to compare
+    output :            str
+                        filepath of the .csv summary table, see compare_edges for its columns. Each row also
+                        has the fanc_folder and manc_folder it came from.
+    plot_folder :       str
+                        if passed, a scatter plot of the percentage inputs of every matched pair is rendered
+                        without opening a window to <plot_folder>/<manc_id>_<fanc_id>.png
+    processes :         int
+                        number of worker processes, by default one per CPU
+    index :             match_index.MatchIndex
+                        local copy of the matching table. If not passed the shared match index is used.
+    resolver :          lineage.LineageResolver
+                        resolver used to find current FANC IDs. If not passed the shared resolver is used.
+
+    Returns
+    -------
+    pandas DataFrame
+                        the summary table
+
+    """
+    folder_pairs = list(folder_pairs)
+    folders = list(dict.fromkeys([folder for pair in folder_pairs for folder in pair]))
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        edges = dict(zip(folders, executor.map(cascade_partners, folders)))
+        manc_ids = np.concatenate([edges[manc_folder][["pre", "post"]].to_numpy(dtype="int64").ravel()
+                                   for _, manc_folder in folder_pairs]) if folder_pairs else []
+        matches = match_map(manc_ids, index, resolver)
+        fanc_tables = [edges[fanc_folder] for fanc_folder, _ in folder_pairs]
+        manc_tables = [edges[manc_folder] for _, manc_folder in folder_pairs]
+        summaries = list(executor.map(compare_edges, fanc_tables, manc_tables, [matches]*len(folder_pairs)))
+        for summary, (fanc_folder, manc_folder) in zip(summaries, folder_pairs):
+            summary["fanc_folder"] = fanc_folder
+            summary["manc_folder"] = manc_folder
+        summary = pd.concat(summaries, ignore_index=True) if summaries else pd.DataFrame(columns=SUMMARY_COLUMNS)
+        if plot_folder is not None:
+            if plot_folder and not os.path.exists(plot_folder):
+                os.makedirs(plot_folder)
+            # each worker is sent only the edges of its pair
+            jobs = [(_source_edges(edges[row.fanc_folder], row.fanc_id), _source_edges(edges[row.manc_folder], row.manc_id),
+                     row.manc_id, row.fanc_id) for row in summary.itertuples(index=False)]
+            paths = [os.path.join(plot_folder, "%d_%d.png" % (manc_id, fanc_id)) for _, _, manc_id, fanc_id in jobs]
+            list(executor.map(_render_pair, jobs, [matches]*len(jobs), paths))
+    if output:
+        summary.to_csv(output, index=False)
+    return summary
+
+def _source_edges(edges, neuron_id):
+    return edges.loc[edges["pre"] == neuron_id]
+
+def _render_pair(job, matches, path):
+    import neuron_graph
+    fanc_edges, manc_edges, manc_id, fanc_id = job
+    table = aligned_partners(fanc_edges, manc_edges, matches, manc_id)
+    return neuron_graph.render_scatter(table, path, "Percentage input of %d in MANC" % manc_id,
+                                       "Percentage input of %d in FANC" % fanc_id)
@@ -0,0 +1,165 @@
+import os
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+# datasets whose cascade edges are limited to a region, so that the total inputs of their neurons must be given
+REGION_DATASETS = ("fanc", "manc")
+
+class ConnectomeSnapshot:
+    """A whole MANC or FANC connectome held in memory as a sparse adjacency matrix, so that partner
+    and percentage input lookups need no network access.
+
+    Rows of the matrix are presynaptic neurons and columns are postsynaptic neurons, both ordered
+    by the sorted neuron IDs in ids.
+
+    Parameters
+    ----------
+    edges :             pandas DataFrame
+                        edge list with columns -
+                            pre: the ID of the upstream neuron
+                            post: the ID of the downstream neuron
+                            weight: the number of synapses from pre onto post. For the cascades this should
+                                count only the synapses inside the region of interest (T1 ROIs in MANC,
+                                T1_REGION in FANC). Repeated pairs are summed.
+    neurons :           pandas DataFrame
+                        optional per-neuron table indexed by neuron ID, with any of the columns -
+                            post: the total number of inputs to the neuron, over the whole VNC. Required for
+                                every neuron receiving synapses in a "fanc" or "manc" snapshot, as their edges
+                                count only the region of interest. Otherwise defaults to the column sums of edges.
+                            soma: True if the neuron has a soma, False for fragments. Defaults to True.
+                            excluded: True for neurons the MANC cascade removes because they enter the
+                                abdominal or T3 neuropils. Defaults to False.
+    dataset :           str
+                        "manc" or "fanc". The total inputs of these snapshots are checked, see neurons.
+
+    Raises
+    ------
+    ValueError
+                        if a "fanc" or "manc" snapshot is missing the total inputs of a neuron receiving synapses
+
+    """
+    def __init__(self, edges, neurons=None, dataset=""):
+        self.dataset = dataset
+        pre = edges["pre"].to_numpy(dtype="int64")
+        post = edges["post"].to_numpy(dtype="int64")
+        weight = edges["weight"].to_numpy()
+        id_arrays = [pre, post]
+        if neurons is not None:
+            id_arrays.append(neurons.index.to_numpy(dtype="int64"))
+        self.ids = np.unique(np.concatenate(id_arrays))
+        n = len(self.ids)
+        self.matrix = sparse.csr_matrix((weight, (np.searchsorted(self.ids, pre), np.searchsorted(self.ids, post))),
+                                        shape=(n, n))
+        self.matrix.sum_duplicates()
+        self.total_input = np.asarray(self.matrix.sum(axis=0)).ravel()
+        self.soma = np.ones(n, dtype=bool)
+        self.excluded = np.zeros(n, dtype=bool)
+        if neurons is not None:
+            rows = np.searchsorted(self.ids, neurons.index.to_numpy(dtype="int64"))
+            if "post" in neurons:
+                post = neurons["post"].to_numpy()
+                self.total_input = self.total_input.astype(np.result_type(self.total_input, post))
+                self.total_input[rows] = post
+            if "soma" in neurons:
+                self.soma[rows] = neurons["soma"].to_numpy(dtype=bool)
+            if "excluded" in neurons:
+                self.excluded[rows] = neurons["excluded"].to_numpy(dtype=bool)
+        if dataset in REGION_DATASETS:
+            # column sums of edges limited to a region undercount the inputs and overstate percentage inputs
+            given = np.zeros(n, dtype=bool)
+            if neurons is not None and "post" in neurons:
+                given[rows] = neurons["post"].notna().to_numpy()
+            missing = (np.diff(self.matrix.tocsc().indptr) > 0) & ~given
+            if missing.any():
+                raise ValueError("%d neurons receiving synapses in the %s snapshot have no total input count in "
+                                 "the post column of neurons" % (missing.sum(), dataset))
+        self._transpose = None
+
+    @classmethod
+    def load(cls, edges_path, neurons_path=None, dataset=""):
+        """Load a snapshot from a local Feather, Parquet or .csv export of the edge list and neuron table.
+
+        Parameters
+        ----------
+        edges_path :        str
+                            filepath of the edge list, see the edges parameter of ConnectomeSnapshot
+        neurons_path :      str
+                            filepath of the neuron table, with the neuron ID in a column named bodyId or root_id
+        dataset :           str
+                            "manc" or "fanc"
+
+        Returns
+        -------
+        ConnectomeSnapshot
+
+        """
+        edges = _read_table(edges_path)
+        neurons = None
+        if neurons_path:
+            neurons = _read_table(neurons_path)
+            id_column = "bodyId" if "bodyId" in neurons else "root_id"
+            neurons = neurons.set_index(id_column)
+        return cls(edges, neurons, dataset)
+
+    def rows(self, neuron_ids):
+        """Return the matrix rows of the neuron IDs, or -1 for IDs that are not in the snapshot."""
+        neuron_ids = np.asarray(neuron_ids, dtype="int64")
+        rows = np.searchsorted(self.ids, neuron_ids)
+        rows[rows == len(self.ids)] = 0
+        found = self.ids[rows] == neuron_ids if len(self.ids) else np.zeros(len(neuron_ids), dtype=bool)
+        return np.where(found, rows, -1)
+
+    def downstream(self, neuron_id):
+        """Return a Series of synapse counts onto each downstream partner, sorted high to low."""
+        return self.downstream_layer([neuron_id])[neuron_id]
+
+    def downstream_layer(self, neuron_ids):
+        """Return a dictionary of neuron_id:Series of synapse counts onto each downstream partner,
+        sorted high to low, for a whole layer of neurons at once."""
+        return _split_rows(self.matrix, self.ids, self.rows(neuron_ids), neuron_ids)
+
+    def upstream(self, neuron_id):
+        """Return a Series of synapse counts from each upstream partner, sorted high to low."""
+        if self._transpose is None:
+            self._transpose = self.matrix.transpose().tocsr()
+        return _split_rows(self._transpose, self.ids, self.rows([neuron_id]), [neuron_id])[neuron_id]
+
+    def inputs(self, neuron_ids):
+        """Return a Series of the total number of inputs of each neuron."""
+        rows = self.rows(neuron_ids)
+        values = self.total_input[rows]
+        if (rows < 0).any():
+            values = np.where(rows >= 0, values, np.nan)
+        return pd.Series(values, index=pd.Index(np.asarray(neuron_ids, dtype="int64")))
+
+    def has_soma(self, neuron_ids):
+        """Return a boolean array, False for fragments and for IDs that are not in the snapshot."""
+        rows = self.rows(neuron_ids)
+        return (rows >= 0) & self.soma[rows]
+
+    def is_excluded(self, neuron_ids):
+        """Return a boolean array, True for neurons flagged as excluded."""
+        rows = self.rows(neuron_ids)
+        return (rows >= 0) & self.excluded[rows]
+
+def _split_rows(matrix, ids, rows, neuron_ids):
+    # slice each row of a CSR matrix into a Series of nonzero values indexed by neuron ID
+    tables = {}
+    for neuron_id, row in zip(neuron_ids, rows):
+        if row < 0:
+            tables[neuron_id] = pd.Series([], dtype=matrix.dtype, index=pd.Index([], dtype="int64"))
+            continue
+        start, end = matrix.indptr[row], matrix.indptr[row+1]
+        values = matrix.data[start:end]
+        order = np.argsort(-values, kind="stable")
+        tables[neuron_id] = pd.Series(values[order], index=pd.Index(ids[matrix.indices[start:end][order]]))
+    return tables
+
+def _read_table(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".feather":
+        return pd.read_feather(path)
+    if extension in (".parquet", ".pq"):
+        return pd.read_parquet(path)
+    return pd.read_csv(path)
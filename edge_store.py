@@ -0,0 +1,160 @@
+import os
+import glob
+import numpy as np
+import pandas as pd
+import atomic_file
+import id_arrays
+
+# name of the edge table written inside a cascade folder. It is a directory of Parquet files,
+# each append adds one file so earlier data is never rewritten.
+EDGE_STORE = "edges.parquet"
+COLUMNS = ["pre", "post", "weight", "inputs", "percent", "layer", "dataset"]
+
+def edges_from_table(table, neuron_id, layer, dataset):
+    """Convert the downstream partner table of one neuron, as saved in a _downstreampartners.csv file,
+    into rows of the edge table.
+
+    Parameters
+    ----------
+    table :             pandas DataFrame
+                        DataFrame indexed by the downstream neuron ID with weight and percent columns, and the
+                        total inputs of the downstream neuron in an inputs (FANC) or post (MANC) column
+    neuron_id :         int
+                        ID of the upstream neuron
+    layer :             int
+                        number of hops from the start of the cascade to the upstream neuron, starting at 0
+    dataset :           str
+                        "fanc" or "manc"
+
+    Returns
+    -------
+    pandas DataFrame
+                        DataFrame with the columns in COLUMNS
+
+    """
+    inputs = table["inputs"] if "inputs" in table else table["post"]
+    return pd.DataFrame({
+        "pre": np.full(len(table), int(neuron_id), dtype="int64"),
+        "post": table.index.to_numpy(dtype="int64"),
+        "weight": table["weight"].to_numpy(dtype="int64"),
+        "inputs": inputs.to_numpy(dtype="int64"),
+        "percent": table["percent"].to_numpy(dtype="float64"),
+        "layer": np.full(len(table), layer, dtype="int16"),
+        "dataset": [dataset]*len(table),
+    })
+
+def append_edges(store_path, edges):
+    """Append rows to the edge table, creating it if it does not exist.
+
+    Parameters
+    ----------
+    store_path :        str
+                        path of the edge table, usually os.path.join(folder, EDGE_STORE)
+    edges :             pandas DataFrame
+                        rows in the format returned by edges_from_table
+
+    """
+    if not len(edges):
+        return
+    if not os.path.exists(store_path):
+        os.makedirs(store_path)
+    part = len(glob.glob(os.path.join(store_path, "part-*.parquet")))
+    while os.path.exists(os.path.join(store_path, "part-%05d.parquet" % part)):
+        part += 1
+    edges[COLUMNS].to_parquet(os.path.join(store_path, "part-%05d.parquet" % part), index=False)
+
+def remove_edges(store_path, pre_ids):
+    """Remove every row of the edge table whose pre neuron is one of pre_ids. Only the files holding
+    such rows are rewritten.
+
+    Parameters
+    ----------
+    store_path :        str
+                        path of the edge table
+    pre_ids :           list of int
+                        IDs of the upstream neurons whose connections are removed
+
+    """
+    pre_ids = np.asarray(list(pre_ids), dtype="int64")
+    for part in sorted(glob.glob(os.path.join(store_path, "part-*.parquet"))):
+        edges = pd.read_parquet(part)
+        remove = edges["pre"].isin(pre_ids)
+        if not remove.any():
+            continue
+        if remove.all():
+            os.remove(part)
+        else:
+            with atomic_file.write(part, "wb") as file:
+                edges.loc[~remove].to_parquet(file, index=False)
+
+def read_edges(store_path):
+    """Read the whole edge table in one memory-mapped load.
+
+    Parameters
+    ----------
+    store_path :        str
+                        path of the edge table
+
+    Returns
+    -------
+    pandas DataFrame
+                        DataFrame with the columns in COLUMNS, empty if the table does not exist
+
+    """
+    import pyarrow.parquet as pq
+    if not os.path.exists(store_path) or not glob.glob(os.path.join(store_path, "part-*.parquet")):
+        return pd.DataFrame({column: pd.Series(dtype=dtype) for column, dtype in
+                             zip(COLUMNS, ["int64", "int64", "int64", "int64", "float64", "int16", "category"])})
+    edges = pq.read_table(store_path, memory_map=True).to_pandas()
+    edges["dataset"] = edges["dataset"].astype("category")
+    return edges
+
+def csv_folder_to_store(folder, dataset=None, store_path=None):
+    """Convert a cascade folder of _downstreampartners.csv files into an edge table. Rows already in the
+    table for the neurons of the folder are replaced, so converting a folder again adds no duplicate edges.
+
+    Parameters
+    ----------
+    folder :            str
+                        cascade folder, named <start neuron>-<threshold>
+    dataset :           str
+                        "fanc" or "manc". If not passed it is guessed from the length of the IDs, as FANC
+                        root IDs are much longer than MANC body IDs.
+    store_path :        str
+                        path of the edge table to write. Defaults to EDGE_STORE inside the folder.
+
+    Returns
+    -------
+    str
+                        path of the edge table
+
+    """
+    if store_path is None:
+        store_path = os.path.join(folder, EDGE_STORE)
+    start_neuron = int(os.path.basename(os.path.normpath(folder)).split("-")[0])
+    tables = {}
+    for csv in os.listdir(folder):
+        if csv.endswith("_downstreampartners.csv"):
+            neuron_id = int(csv.removesuffix("_downstreampartners.csv"))
+            tables[neuron_id] = id_arrays.read_table(os.path.join(folder, csv))
+    if dataset is None:
+        dataset = "fanc" if start_neuron >= id_arrays.FANC_MINIMUM else "manc"
+
+    # work out the layer of each neuron by walking out from the start neuron
+    layers = {start_neuron: 0}
+    frontier = [start_neuron]
+    while frontier:
+        next_frontier = []
+        for neuron_id in frontier:
+            for partner in tables.get(neuron_id, pd.DataFrame()).index:
+                if partner not in layers:
+                    layers[partner] = layers[neuron_id]+1
+                    next_frontier.append(partner)
+        frontier = next_frontier
+
+    edges = [edges_from_table(table, neuron_id, layers.get(neuron_id, -1), dataset)
+             for neuron_id, table in sorted(tables.items(), key=lambda item: layers.get(item[0], -1))]
+    remove_edges(store_path, list(tables))
+    if edges:
+        append_edges(store_path, pd.concat(edges, ignore_index=True))
+    return store_path
@@ -1,10 +1,24 @@
-import caveclient as cv
 import datetime
+import itertools
+import numpy as np
 import pandas as pd
 import os
-import seaserpent as ss
+import cascade
+import clients
+import edge_store
+import id_arrays
+import instrumentation
+import match_index
+import spatial_index
 
-def fetch_downstream_synapses(neuron_id, client=None):
+POSITION_COLUMNS = ["pre_pt_position_x", "pre_pt_position_y", "pre_pt_position_z"]
+# FANC T1 neuromere: synapses between these y values (anterior, posterior) in the VNC
+T1_REGION = {"y_slabs": [(0, 118000)]}
+# a box enclosing every FANC synapse position, ((min_x, min_y, min_z), (max_x, max_y, max_z)) in the voxel
+# units of the synapse table, split by stream_synapse_counts when one neuron has too many synapses for a query
+VOLUME_BOUNDS = ((0, 0, 0), (2**18, 2**19, 2**13))
+
+def fetch_downstream_synapses(neuron_id, client=None, cache=None):
     """Return a dataframe of synapses that are downstream of the neuron.
 
     Parameters
@@ -12,23 +26,269 @@ def fetch_downstream_synapses(neuron_id, client=None):
     neuron_id :         int or str
                         FANC neuron ID to find the downstream synapses of
     client :            caveclient.frameworkclient.CAVEclientFull
-                        CAVEclient to query information from. If not passed to the function it will create its own.
+                        CAVEclient to query information from. If not passed to the function the shared client is used.
+    cache :             synapse_cache.SynapseCache
+                        on-disk cache to read synapses from and store queried synapses in. If not passed to the
+                        function every synapse is queried.
 
     Returns
     -------
     pandas DataFrame
                         DataFrame with columns -
                             post_pt_root_id: the ID of the downstream neuron
-                            pre_pt_position: the [x,y,z] coordinates in list format of the presynapse
+                            pre_pt_position_x/_y/_z: the x, y and z coordinates of the presynapse
 
     """
     if not client:
-        client = cv.CAVEclient('fanc_production_mar2021')
-    synapses = client.materialize.synapse_query(pre_ids=[neuron_id])
-    syn = synapses[["post_pt_root_id", "pre_pt_position"]].copy()
+        client = clients.cave()
+    synapses = _query_synapses([neuron_id], "pre", client, cache)
+    syn = synapses[["post_pt_root_id"]+POSITION_COLUMNS].copy()
     return syn
 
-def get_percent_input(conn_table, client=None):
+def fetch_downstream_synapses_batch(neuron_ids, client=None, chunk_size=50, cache=None):
+    """Return a dataframe of synapses that are downstream of any of the neurons, using one
+    synapse query per chunk of neurons rather than one per neuron.
+
+    Parameters
+    ----------
+    neuron_ids :        list of int or str
+                        FANC neuron IDs to find the downstream synapses of
+    client :            caveclient.frameworkclient.CAVEclientFull
+                        CAVEclient to query information from. If not passed to the function the shared client is used.
+    chunk_size :        int
+                        maximum number of neuron IDs sent in a single synapse query
+    cache :             synapse_cache.SynapseCache
+                        on-disk cache to read synapses from and store queried synapses in. If not passed to the
+                        function every synapse is queried.
+
+    Returns
+    -------
+    pandas DataFrame
+                        DataFrame with columns -
+                            pre_pt_root_id: the ID of the upstream neuron the synapse belongs to
+                            post_pt_root_id: the ID of the downstream neuron
+                            pre_pt_position_x/_y/_z: the x, y and z coordinates of the presynapse
+
+    """
+    if not client:
+        client = clients.cave()
+    return _query_synapses(neuron_ids, "pre", client, cache, chunk_size)
+
+def count_inputs(neuron_ids, client=None, chunk_size=50, cache=None, timestamp=None, page_size=100000):
+    """Return the total number of input synapses of each neuron, using one synapse query
+    per chunk of neurons.
+
+    Parameters
+    ----------
+    neuron_ids :        list of int or str
+                        FANC neuron IDs to count the inputs of
+    client :            caveclient.frameworkclient.CAVEclientFull
+                        CAVEclient to query information from. If not passed to the function the shared client is used.
+    chunk_size :        int
+                        maximum number of neuron IDs sent in a single synapse query
+    cache :             synapse_cache.SynapseCache
+                        on-disk cache to read synapses from and store queried synapses in. If not passed to the
+                        function every synapse is queried.
+    timestamp :         datetime.datetime
+                        if passed, inputs are counted live at this time instead of at the client's
+                        materialization version. The cache cannot be used with it.
+    page_size :         int
+                        maximum number of synapse rows returned by a single synapse query, see stream_synapse_counts
+
+    Returns
+    -------
+    pandas Series
+                        index is the ID of the neuron, values are its total number of input synapses
+
+    """
+    _check_live(cache, timestamp)
+    if not client:
+        client = clients.cave()
+    to_query = list(neuron_ids)
+    counts = [pd.Series(dtype="int64")]
+    if cache is not None:
+        with instrumentation.timed("synapse_cache.counts", kind="cache") as timer:
+            cached = cache.counts(to_query, "post", client.materialize.version)
+            timer.set(hits=len(cached), misses=len(to_query)-len(cached))
+        to_query = [x for x in to_query if int(x) not in cached]
+        counts.append(pd.Series(cached, dtype="int64"))
+    if to_query and cache is None:
+        counts.append(stream_synapse_counts(to_query, "post", client, chunk_size, page_size, by_partner=False,
+                                            timestamp=timestamp))
+    elif to_query:
+        synapses = _query_synapses(to_query, "post", client, cache, chunk_size)
+        counts.append(synapses["post_pt_root_id"].value_counts())
+    return pd.concat(counts).rename("inputs")
+
+def _query_synapses(neuron_ids, direction, client, cache=None, chunk_size=50):
+    # query the synapses on the pre or post side of the neurons in chunks, reading from and
+    # filling the cache if one is passed
+    if direction == "pre":
+        key, partner = "pre_pt_root_id", "post_pt_root_id"
+    else:
+        key, partner = "post_pt_root_id", "pre_pt_root_id"
+    columns = [key, partner]+POSITION_COLUMNS
+    tables = {}
+    to_query = list(neuron_ids)
+    version = None
+    if cache is not None:
+        version = client.materialize.version
+        to_query = []
+        for neuron_id in neuron_ids:
+            with instrumentation.timed("synapse_cache.get", kind="cache", neuron=int(neuron_id)) as timer:
+                cached = cache.get(neuron_id, direction, version)
+                timer.set(hit=cached is not None)
+            if cached is None:
+                to_query.append(neuron_id)
+            else:
+                partners, positions = cached
+                tables[neuron_id] = pd.DataFrame({key: np.full(len(partners), int(neuron_id)),
+                                                  partner: partners,
+                                                  POSITION_COLUMNS[0]: positions[:,0],
+                                                  POSITION_COLUMNS[1]: positions[:,1],
+                                                  POSITION_COLUMNS[2]: positions[:,2]})
+    frames = []
+    for chunk in id_arrays.chunks(to_query, chunk_size):
+        with instrumentation.timed("cave.synapse_query", neurons=len(chunk), direction=direction) as timer:
+            if direction == "pre":
+                synapses = client.materialize.synapse_query(pre_ids=chunk, materialization_version=version,
+                                                            split_positions=True)
+            else:
+                synapses = client.materialize.synapse_query(post_ids=chunk, materialization_version=version,
+                                                            split_positions=True)
+            timer.set(synapses)
+        synapses = synapses[columns]
+        if direction == "pre":
+            _record_shares(synapses, key)
+        if cache is None:
+            frames.append(synapses)
+            continue
+        groups = dict(list(synapses.groupby(key, sort=False)))
+        for neuron_id in chunk:
+            group = groups.get(int(neuron_id), synapses.iloc[:0])
+            cache.put(neuron_id, direction, version, group[partner].to_numpy(), group[POSITION_COLUMNS].to_numpy())
+            tables[neuron_id] = group
+    if cache is not None:
+        frames = [tables[x] for x in neuron_ids if x in tables]
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(frames, ignore_index=True)
+
+def stream_synapse_counts(neuron_ids, direction="pre", client=None, chunk_size=50, page_size=100000, region=None,
+                          by_partner=True, partner_ids=None, timestamp=None):
+    """Count synapses of neurons without holding their synapse tables in memory. Synapses are fetched one
+    chunk of neurons at a time, filtered to the region and reduced to counts before the next chunk is
+    fetched. A query that fills its page_size row limit may have been cut short by the server, so its
+    rows are dropped and the chunk is split in half and queried again, first by neurons, then by partners
+    and then, for a single neuron with page_size or more synapses, by halving the box of presynapse
+    positions queried along its longest axis, starting from VOLUME_BOUNDS. Memory use therefore stays
+    below page_size rows however large a neuron is.
+
+    Parameters
+    ----------
+    neuron_ids :        list of int or str
+                        FANC neuron IDs to count the synapses of
+    direction :         str
+                        "pre" to count the downstream synapses of the neurons or "post" to count their inputs
+    client :            caveclient.frameworkclient.CAVEclientFull
+                        CAVEclient to query information from. If not passed to the function the shared client is used.
+    chunk_size :        int
+                        maximum number of neuron IDs sent in a single synapse query
+    page_size :         int
+                        maximum number of synapse rows returned by a single synapse query, at or below the
+                        server's own row limit
+    region :            dict
+                        optional keyword arguments for spatial_filter giving the region of the VNC in which
+                        synapses are counted
+    by_partner :        bool
+                        if True count the synapses between each neuron and each partner, if False count the
+                        synapses of each neuron in total
+    partner_ids :       list of int or str
+                        optional FANC neuron IDs to limit the partners to. They are sent in chunks of chunk_size
+                        along with each chunk of neuron_ids.
+    timestamp :         datetime.datetime
+                        if passed, synapses are queried live at this time instead of at the client's
+                        materialization version, so that root IDs edited since then are seen
+
+    Returns
+    -------
+    pandas Series
+                        synapse counts named count, indexed by (neuron, partner) if by_partner is True or by
+                        neuron if it is False
+
+    """
+    if not client:
+        client = clients.cave()
+    if direction == "pre":
+        key, partner = "pre_pt_root_id", "post_pt_root_id"
+    else:
+        key, partner = "post_pt_root_id", "pre_pt_root_id"
+    group_by = [key, partner] if by_partner else key
+    # pin the version so every chunk comes from the same materialization, unless the query is live
+    version = None if timestamp is not None else client.materialize.version
+    counts = None
+    partner_chunks = [None] if partner_ids is None else id_arrays.chunks(partner_ids, chunk_size)
+    # each pending query is (neuron IDs, partner IDs or None, presynapse position box or None)
+    pending = [(chunk, partner_chunk, None)
+               for chunk, partner_chunk in itertools.product(id_arrays.chunks(neuron_ids, chunk_size), partner_chunks)]
+    while pending:
+        chunk, partner_chunk, box = pending.pop()
+        ids = {"pre_ids": chunk, "post_ids": partner_chunk} if direction == "pre" else \
+              {"post_ids": chunk, "pre_ids": partner_chunk}
+        if box is not None:
+            ids.update(bounding_box=[list(box[0]), list(box[1])], bounding_box_column="pre_pt_position")
+        with instrumentation.timed("cave.synapse_query", neurons=len(chunk), direction=direction) as timer:
+            page = client.materialize.synapse_query(**ids, materialization_version=version, timestamp=timestamp,
+                                                    split_positions=True, limit=page_size)
+            timer.set(page)
+        if len(page) >= page_size:
+            # the rows returned are not in a stable order, so a cut short query is split rather than paged
+            del page
+            if len(chunk) > 1:
+                half = len(chunk)//2
+                pending += [(chunk[:half], partner_chunk, box), (chunk[half:], partner_chunk, box)]
+            elif partner_chunk is not None and len(partner_chunk) > 1:
+                half = len(partner_chunk)//2
+                pending += [(chunk, partner_chunk[:half], box), (chunk, partner_chunk[half:], box)]
+            else:
+                pending += [(chunk, partner_chunk, half) for half in _split_box(box or VOLUME_BOUNDS, page_size)]
+            continue
+        if direction == "pre":
+            _record_shares(page, key)
+        if region:
+            page = page.loc[synapse_mask(page, **region)]
+        page_counts = page.groupby(group_by).size()
+        counts = page_counts if counts is None else counts.add(page_counts, fill_value=0)
+        del page
+    if counts is None:
+        index = pd.MultiIndex.from_arrays([[], []], names=[key, partner]) if by_partner else pd.Index([], name=key)
+        counts = pd.Series([], index=index, dtype="int64")
+    return counts.astype("int64").rename("count")
+
+def _record_shares(synapses, key):
+    # the rows and bytes of a batched synapse query that belong to each neuron, recorded per neuron so that
+    # the report of a cascade breaks remote data down by neuron as well as by layer
+    if not instrumentation.active() or not len(synapses):
+        return
+    row_bytes = synapses.memory_usage(index=True).sum()/len(synapses)
+    for neuron_id, rows in synapses[key].value_counts(sort=False).items():
+        instrumentation.record("remote", "cave.synapse_query.neuron_share", 0.0, neuron=int(neuron_id),
+                               rows=int(rows), bytes=int(rows*row_bytes))
+
+def _split_box(box, page_size):
+    # halve a box of integer voxel coordinates, bounds included, along its longest axis into two boxes
+    # that do not overlap
+    lower, upper = np.asarray(box[0], dtype="int64"), np.asarray(box[1], dtype="int64")
+    axis = int(np.argmax(upper-lower))
+    if upper[axis] == lower[axis]:
+        raise ValueError("more than "+str(page_size)+" synapses at a single position, raise page_size")
+    middle = (lower[axis]+upper[axis])//2
+    first_upper, second_lower = upper.copy(), lower.copy()
+    first_upper[axis], second_lower[axis] = middle, middle+1
+    return [(lower.tolist(), first_upper.tolist()), (second_lower.tolist(), upper.tolist())]
+
+@instrumentation.instrumented()
+def get_percent_input(conn_table, client=None, input_counts=None, cache=None, snapshot=None, input_table=None):
     """Take a Series of synapse counts and return a dataframe of neurons with net and percentage inputs.
 
     Parameters
@@ -36,7 +296,18 @@ def get_percent_input(conn_table, client=None):
     conn_table :        pandas Series
                         index is the ID of the downstream neuron, values are the number of connections to this neuron
     client :            caveclient.frameworkclient.CAVEclientFull
-                        CAVEclient to query information from. If not passed to the function it will create its own.
+                        CAVEclient to query information from. If not passed to the function the shared client is used.
+    input_counts :      pandas Series
+                        total inputs per neuron as returned by count_inputs, covering at least the IDs in
+                        conn_table. If not passed to the function the inputs will be queried.
+    cache :             synapse_cache.SynapseCache
+                        on-disk cache to read synapses from and store queried synapses in. If not passed to the
+                        function every synapse is queried.
+    snapshot :          connectome_snapshot.ConnectomeSnapshot
+                        offline FANC connectome to read total inputs from instead of querying CAVE.
+    input_table :       input_table.InputTable
+                        table of total inputs to read from, so that only neurons missing from it are counted.
+                        Counted neurons are added to the table.
 
     Returns
     -------
@@ -49,16 +320,20 @@ def get_percent_input(conn_table, client=None):
                                 neuron represented by the connections in the input
 
     """
-    if not client:
-        client = cv.CAVEclient('fanc_production_mar2021')
-    IDs = conn_table.index.to_list()
-    synapses = client.materialize.synapse_query(post_ids=IDs)
-    dendrite_number = synapses["post_pt_root_id"].value_counts().rename("inputs")
+    if input_counts is None and snapshot is not None:
+        input_counts = snapshot.inputs(conn_table.index)
+    if input_counts is None:
+        if not client:
+            client = clients.cave()
+        IDs = conn_table.index.to_list()
+        input_counts = _partner_inputs(IDs, client, max(len(IDs), 1), cache, input_table)
+    dendrite_number = input_counts.loc[input_counts.index.isin(conn_table.index)].rename("inputs")
     inputs = pd.concat([conn_table,dendrite_number], axis=1)
     inputs["percent"] = (inputs["count"]/inputs["inputs"])*100
-    return inputs.sort_values("percent",ascending=False)
+    # a stable sort keeps neurons with equal percentages in the order of conn_table
+    return inputs.sort_values("percent",ascending=False,kind="stable")
 
-def fetch_upstream_synapses(neuron_id, client=None):
+def fetch_upstream_synapses(neuron_id, client=None, cache=None):
     """Return a dataframe of synapses that are upstream of the neuron.
 
     Parameters
@@ -66,20 +341,23 @@ def fetch_upstream_synapses(neuron_id, client=None):
     neuron_id :         int or str
                         FANC neuron ID to find the upstream synapses of
     client :            caveclient.frameworkclient.CAVEclientFull
-                        CAVEclient to query information from. If not passed to the function it will create its own.
+                        CAVEclient to query information from. If not passed to the function the shared client is used.
+    cache :             synapse_cache.SynapseCache
+                        on-disk cache to read synapses from and store queried synapses in. If not passed to the
+                        function every synapse is queried.
 
     Returns
     -------
     pandas DataFrame
                         DataFrame with columns -
                             pre_pt_root_id: the ID of the upstream neuron
-                            pre_pt_position: the [x,y,z] coordinates in list format of the presynapse
+                            pre_pt_position_x/_y/_z: the x, y and z coordinates of the presynapse
 
     """
     if not client:
-        client = cv.CAVEclient('fanc_production_mar2021')
-    synapses = client.materialize.synapse_query(post_ids=[neuron_id])
-    syn = synapses[["pre_pt_root_id", "pre_pt_position"]].copy()
+        client = clients.cave()
+    synapses = _query_synapses([neuron_id], "post", client, cache)
+    syn = synapses[["pre_pt_root_id"]+POSITION_COLUMNS].copy()
     return syn
 
 def synapse_y_limit(synapses, posterior_limit, anterior_limit=0):
@@ -88,31 +366,91 @@ def synapse_y_limit(synapses, posterior_limit, anterior_limit=0):
 
     Parameters
     ----------
-    pandas DataFrame
+    synapses :          pandas DataFrame
                         DataFrame with columns -
-                            post_pt_root_id: the ID of the downstream neuron
-                            pre_pt_position: the [x,y,z] coordinates in list format of the presynapse
+                            post_pt_root_id/pre_pt_root_id: the ID of the partner neuron
+                            pre_pt_position_x/_y/_z: the x, y and z coordinates of the presynapse
     posterior_limit :   int
                         y value in the VNC below which synapses will be discarded
-    anterior_limit :   int
+    anterior_limit :    int
                         y value in the VNC above which synapses will be discarded
 
     Returns
     -------
     pandas DataFrame
-                        DataFrame with columns -
-                            post_pt_root_id/pre_pt_root_id: the ID of the downstream neuron
-                            pre_pt_position: the [x,y,z] coordinates of the presynapse in list format
-                            pre_pt_y_axis: just the y value of the coordinates
+                        the rows of the input DataFrame inside the limits
 
     """
-    y_axis = []
-    for _, value in synapses["pre_pt_position"].items():
-        y_axis.append(value[1])
-    synapses["pre_pt_y_axis"] = y_axis
-    return synapses[synapses["pre_pt_y_axis"].between(anterior_limit,posterior_limit)]
+    return spatial_filter(synapses, y_slabs=[(anterior_limit, posterior_limit)])
+
+@instrumentation.instrumented()
+def spatial_filter(synapses, box=None, y_slabs=None, polygon=None, polygon_axes=("x","y"), mesh=None):
+    """Take a dataframe of synapses and return only those inside a region of the VNC. Every region
+    that is passed must contain the synapse, and boundaries count as inside. The input is not modified.
+
+    Parameters
+    ----------
+    synapses :          pandas DataFrame
+                        DataFrame with pre_pt_position_x, pre_pt_position_y and pre_pt_position_z columns
+    box :               tuple
+                        axis-aligned box as ((min_x, min_y, min_z), (max_x, max_y, max_z))
+    y_slabs :           list of tuples
+                        list of (anterior, posterior) y ranges, a synapse in any of them is kept
+    polygon :           array-like
+                        Nx2 vertices of a polygon such as a neuromere outline, in the plane given by polygon_axes
+    polygon_axes :      tuple of str
+                        the two axes the polygon is drawn in, out of "x", "y" and "z"
+    mesh :              tuple
+                        closed triangle mesh such as a neuromere, as (vertices, faces) or an object with vertices
+                        and faces attributes, see spatial_index.load_mesh. For repeated queries over the same
+                        synapses use spatial_index.SynapseIndex.
+
+    Returns
+    -------
+    pandas DataFrame
+                        the rows of the input DataFrame inside the region
 
-def downstream_of(neuron_id, threshold=3, client=None):
+    """
+    return synapses[synapse_mask(synapses, box, y_slabs, polygon, polygon_axes, mesh)]
+
+def synapse_mask(synapses, box=None, y_slabs=None, polygon=None, polygon_axes=("x","y"), mesh=None):
+    """Return a boolean NumPy array marking the synapses inside a region, see spatial_filter."""
+    positions = {axis: synapses["pre_pt_position_"+axis].to_numpy() for axis in ("x", "y", "z")}
+    mask = np.ones(len(synapses), dtype=bool)
+    if box is not None:
+        lower, upper = box
+        for axis, low, high in zip(("x", "y", "z"), lower, upper):
+            mask &= (positions[axis] >= low) & (positions[axis] <= high)
+    if y_slabs is not None:
+        in_slab = np.zeros(len(synapses), dtype=bool)
+        for anterior, posterior in y_slabs:
+            in_slab |= (positions["y"] >= anterior) & (positions["y"] <= posterior)
+        mask &= in_slab
+    if polygon is not None:
+        mask &= _in_polygon(positions[polygon_axes[0]], positions[polygon_axes[1]], np.asarray(polygon, dtype=float))
+    if mesh is not None:
+        points = np.column_stack([positions["x"], positions["y"], positions["z"]])
+        mask[mask] = spatial_index.in_mesh(points[mask], mesh)
+    return mask
+
+def _in_polygon(u, v, polygon):
+    # even-odd ray casting, vectorized over the points and looped over the polygon edges
+    inside = np.zeros(len(u), dtype=bool)
+    on_edge = np.zeros(len(u), dtype=bool)
+    for (u1, v1), (u2, v2) in zip(polygon, np.roll(polygon, -1, axis=0)):
+        crosses = (v1 > v) != (v2 > v)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            u_cross = u1 + (v - v1)*(u2 - u1)/(v2 - v1)
+        inside ^= crosses & (u < u_cross)
+        # points lying on the edge itself
+        cross_product = (u2 - u1)*(v - v1) - (v2 - v1)*(u - u1)
+        on_edge |= (cross_product == 0) & (np.minimum(u1, u2) <= u) & (u <= np.maximum(u1, u2)) \
+            & (np.minimum(v1, v2) <= v) & (v <= np.maximum(v1, v2))
+    return inside | on_edge
+
+@instrumentation.instrumented()
+def downstream_of(neuron_id, threshold=3, client=None, cache=None, region=T1_REGION, snapshot=None, input_table=None,
+                  page_size=100000):
     """Return a dataframe of neurons that are downstream of the neuron, by percentage input.
 
     Parameters
@@ -122,7 +460,20 @@ def downstream_of(neuron_id, threshold=3, client=None):
     threshold :         int
                         minimum number of synapses required to be considered a connection between neurons
     client :            caveclient.frameworkclient.CAVEclientFull
-                        CAVEclient to query information from. If not passed to the function it will create its own.
+                        CAVEclient to query information from. If not passed to the function the shared client is used.
+    cache :             synapse_cache.SynapseCache
+                        on-disk cache to read synapses from and store queried synapses in. If not passed to the
+                        function every synapse is queried.
+    region :            dict
+                        keyword arguments for spatial_filter giving the region of the VNC in which synapses are
+                        counted. Defaults to the T1 neuromere.
+    snapshot :          connectome_snapshot.ConnectomeSnapshot
+                        offline FANC connectome to read connections from instead of querying CAVE. Its edge
+                        weights should already be restricted to the region of interest.
+    input_table :       input_table.InputTable
+                        table of total inputs and fragments, see downstream_of_layer
+    page_size :         int
+                        maximum number of synapse rows returned by a single synapse query, see stream_synapse_counts
 
     Returns
     -------
@@ -135,26 +486,147 @@ def downstream_of(neuron_id, threshold=3, client=None):
                                 neuron represented by the connections in the input
 
     """
+    if snapshot is not None:
+        return downstream_of_layer([neuron_id], threshold, snapshot=snapshot)[neuron_id]
     if not client:
-        client = cv.CAVEclient('fanc_production_mar2021')
+        client = clients.cave()
+    if cache is None or input_table is not None:
+        # without a cache the synapses are only counted, never held in memory
+        return downstream_of_layer([neuron_id], threshold, client, cache=cache, region=region,
+                                   input_table=input_table, page_size=page_size)[neuron_id]
     #get downstream neurons and sort by synapse counts up to the Nth downstream synapse
-    downstream_synapses = fetch_downstream_synapses(neuron_id, client)
-    t1_downstream_synapses = synapse_y_limit(downstream_synapses,118000)
+    downstream_synapses = fetch_downstream_synapses(neuron_id, client, cache)
+    values = _partner_counts(spatial_filter(downstream_synapses, **region), threshold)
+    percentage_table = get_percent_input(values, client, cache=cache)
+    return _remove_fragments(percentage_table)
+
+@instrumentation.instrumented()
+def downstream_of_layer(neuron_ids, threshold=3, client=None, chunk_size=50, cache=None, region=T1_REGION,
+                        snapshot=None, input_table=None, timestamp=None, page_size=100000):
+    """Return the downstream_of table for every neuron in a layer of the cascade. The downstream synapses
+    of the whole layer are counted together and split by neuron locally, then the total inputs of every
+    partner in the layer are counted together. Without a cache synapses are counted chunk by chunk with
+    stream_synapse_counts and never held in memory in full. With an input table, partners it knows to be
+    fragments are dropped before any of their inputs are counted, and only partners missing from it are
+    counted.
+
+    Parameters
+    ----------
+    neuron_ids :        list of int or str
+                        FANC neuron IDs to find the downstream partners of
+    threshold :         int
+                        minimum number of synapses required to be considered a connection between neurons
+    client :            caveclient.frameworkclient.CAVEclientFull
+                        CAVEclient to query information from. If not passed to the function the shared client is used.
+    chunk_size :        int
+                        maximum number of neuron IDs sent in a single synapse query
+    cache :             synapse_cache.SynapseCache
+                        on-disk cache to read synapses from and store queried synapses in. If not passed to the
+                        function every synapse is queried.
+    region :            dict
+                        keyword arguments for spatial_filter giving the region of the VNC in which synapses are
+                        counted. Defaults to the T1 neuromere.
+    snapshot :          connectome_snapshot.ConnectomeSnapshot
+                        offline FANC connectome to read connections from instead of querying CAVE. Its edge
+                        weights should already be restricted to the region of interest.
+    input_table :       input_table.InputTable
+                        table of total inputs and fragments to join against before counting inputs. Counted
+                        neurons are added to the table.
+    timestamp :         datetime.datetime
+                        if passed, synapses are counted live at this time instead of at the client's
+                        materialization version. The cache cannot be used with it.
+    page_size :         int
+                        maximum number of synapse rows returned by a single synapse query, see stream_synapse_counts
+
+    Returns
+    -------
+    dict
+                        dictionary of neuron_id:DataFrame, each DataFrame in the format returned by downstream_of
+
+    """
+    # a neuron reached from two parents must be queried once, or its synapses would be counted twice
+    neuron_ids = list(dict.fromkeys(neuron_ids))
+    if snapshot is not None:
+        tables = {}
+        for neuron_id, counts in snapshot.downstream_layer(neuron_ids).items():
+            values = counts.loc[counts >= threshold].rename("count")
+            values.index.name = "post_pt_root_id"
+            tables[neuron_id] = _remove_fragments(get_percent_input(values, snapshot=snapshot))
+        return tables
+    _check_live(cache, timestamp)
+    if not client:
+        client = clients.cave()
+    values = {}
+    if cache is None:
+        # count synapses page by page rather than downloading them all
+        counts = stream_synapse_counts(neuron_ids, "pre", client, chunk_size, page_size, region=region,
+                                       timestamp=timestamp)
+        groups = dict(list(counts.groupby(level=0, sort=False)))
+        for neuron_id in neuron_ids:
+            group = _by_count(groups.get(int(neuron_id), counts.iloc[:0]).droplevel(0))
+            values[neuron_id] = group.loc[group >= threshold]
+    else:
+        downstream_synapses = fetch_downstream_synapses_batch(neuron_ids, client, chunk_size, cache)
+        downstream_synapses = spatial_filter(downstream_synapses, **region)
+        groups = dict(list(downstream_synapses.groupby("pre_pt_root_id", sort=False)))
+        empty = downstream_synapses.iloc[:0]
+        for neuron_id in neuron_ids:
+            values[neuron_id] = _partner_counts(groups.get(int(neuron_id), empty), threshold)
 
-    # get value counts as Series
-    values = t1_downstream_synapses.iloc[:,0].value_counts()
-    values = values.loc[values >= threshold]
-    percentage_table = get_percent_input(values, client)
+    if input_table is not None:
+        # fragments the table knows of cost no input queries
+        values = {neuron_id: v.loc[~input_table.fragments(v.index)] for neuron_id, v in values.items()}
+    # count inputs once for the union of partners across the layer
+    partners = []
+    for v in values.values():
+        partners.extend(v.index.to_list())
+    partners = list(dict.fromkeys(partners))
+    input_counts = _partner_inputs(partners, client, chunk_size, cache, input_table, timestamp, page_size)
+    tables = {}
+    for neuron_id, v in values.items():
+        with instrumentation.context(neuron=int(neuron_id)):
+            tables[neuron_id] = _remove_fragments(get_percent_input(v, client, input_counts))
+    return tables
 
-    # filter out fragments
-    percentage_table = percentage_table.loc[percentage_table.inputs > 100]
-    return percentage_table
+def _partner_inputs(partners, client, chunk_size, cache, input_table, timestamp=None, page_size=100000):
+    # total inputs of the partners, read from the input table where it has them and counted otherwise
+    if input_table is None:
+        return count_inputs(partners, client, chunk_size, cache, timestamp, page_size)
+    known = input_table.known(partners)
+    missing = [x for x, k in zip(partners, known) if not k]
+    instrumentation.record("cache", "input_table.inputs", 0.0, hits=int(known.sum()), misses=len(missing))
+    if missing:
+        counted = count_inputs(missing, client, chunk_size, cache, timestamp, page_size)
+        # neurons without inputs are not counted at all, so are added with none
+        input_table.add(counted.groupby(level=0).sum().reindex(pd.Index(missing, dtype="int64"), fill_value=0))
+    return input_table.inputs(partners)
 
-def cascade_csvs(start_neuron, percentage_threshold=1, connection_threshold=3, layers=3, client=None):
+def _check_live(cache, timestamp):
+    # the cache holds synapses of a materialization version, which live queries must not read or fill
+    if cache is not None and timestamp is not None:
+        raise ValueError("a synapse cache cannot be used for live queries at a timestamp")
+
+def _partner_counts(synapses, threshold):
+    # count the synapses onto each downstream neuron, keeping connections of at least threshold synapses
+    values = _by_count(synapses["post_pt_root_id"].value_counts())
+    return values.loc[values >= threshold]
+
+def _by_count(values):
+    # synapse counts from high to low, equal counts in order of neuron ID, so that the order of the saved
+    # tables does not depend on the order the synapses were returned in
+    return values.sort_index().sort_values(ascending=False, kind="stable")
+
+def _remove_fragments(percentage_table):
+    # fragments have few inputs, so drop neurons with 100 inputs or fewer
+    return percentage_table.loc[percentage_table.inputs > 100]
+
+def cascade_csvs(start_neuron, percentage_threshold=1, connection_threshold=3, layers=3, client=None, chunk_size=50, cache=None,
+                 region=T1_REGION, snapshot=None, output="csv", batch_size=None, input_table=None, page_size=100000):
     """Take an initial starting neuron and save .csv files of its most significant downstream partners
         then do the same for each of the downstream partners for the chosen number of layers. The dataframes
         representing the downstream partners of each neuron are saved in a standard .csv
-        format inside a folder named after the start neuron
+        format inside a folder named after the start neuron. Each neuron is queried once, and an
+        interrupted cascade resumes from the checkpoint in the folder (see cascade.run_cascade)
 
     Parameters
     ----------
@@ -164,52 +636,229 @@ def cascade_csvs(start_neuron, percentage_threshold=1, connection_threshold=3, l
                             minimum percentage input required to be included in the saved csv files
     connection_threshold :  int
                             minimum number of synapses required to be considered a connection between neurons
-    layers :                int
-                            number of hops downstream from the starting neuron
+    layers :                int or None
+                            number of hops downstream from the starting neuron, or None to continue until no new
+                            neurons are found
     client :                caveclient.frameworkclient.CAVEclientFull
-                            CAVEclient to query information from. If not passed to the function it will create its own.
+                            CAVEclient to query information from. If not passed to the function the shared client is used.
+    chunk_size :            int
+                            maximum number of neuron IDs sent in a single synapse query
+    cache :                 synapse_cache.SynapseCache
+                            on-disk cache to read synapses from and store queried synapses in, so that reruns
+                            with a different percentage_threshold need no synapse queries. Entries of root IDs
+                            that have been superseded by proofreading are removed from it first, once per
+                            materialization version (see synapse_cache.SynapseCache.invalidate_superseded).
+    region :                dict
+                            keyword arguments for spatial_filter giving the region of the VNC in which synapses are
+                            counted. Defaults to the T1 neuromere.
+    snapshot :              connectome_snapshot.ConnectomeSnapshot
+                            offline FANC connectome to read connections from instead of querying CAVE.
+    output :                str
+                            "csv" to save one .csv file per neuron, "store" to append every connection to a single
+                            edge table (edge_store.EDGE_STORE in the folder) or "both"
+    batch_size :            int or None
+                            number of neurons queried together before the checkpoint is saved. If None each
+                            layer is queried at once.
+    input_table :           input_table.InputTable
+                            table of total inputs and fragments, so that fragments are dropped before their
+                            inputs are counted. Neurons missing from it are counted and added to it.
+    page_size :             int
+                            maximum number of synapse rows returned by a single synapse query, see stream_synapse_counts
 
     Returns
     -------
-    None
+    dict
+                            dictionary of neuron_id:layer for every neuron reached, the start neuron being layer 0
 
     """
-    if not client:
-        client = cv.CAVEclient('fanc_production_mar2021')
-    def make_csvs_in_list(neuron_list):
-        downstream_neurons = []
-        for neuron_id in neuron_list:
-            print(neuron_id, end=" ")
-            if str(neuron_id)+"_downstreampartners.csv" in files:
-                print("file already exists")
-                pass
-            else:
-                downstream_new = make_csv(neuron_id, percentage_threshold, connection_threshold, folder, client)
-                downstream_neurons = downstream_neurons+downstream_new
-                if len(downstream_new):
-                    print("created file")
-                else:
-                    print("no downstream partners")
-        return downstream_neurons
+    if not client and snapshot is None:
+        client = clients.cave()
+    def make_csvs_in_list(neuron_list, layer):
+        tables = downstream_of_layer(neuron_list, connection_threshold, client, chunk_size, cache, region, snapshot,
+                                     input_table, page_size=page_size)
+        return _save_partners(tables, {neuron_id: layer for neuron_id in neuron_list}, percentage_threshold,
+                              folder, output)
 
     folder = str(start_neuron)+"-"+str(percentage_threshold)+"/"
     if not os.path.exists(folder):
         os.makedirs(folder)
-    files = os.listdir(folder)
-
-    layer_names = ["first layer", "second layer", "third layer", "fourth layer", "fifth layer"]
-    if layers > 3:
+    if layers is None or layers > 3:
         print("Warning - querying more than 3 layers can take a very long time")
-    if layers > 5:
-        print("limiting layers to max = 5")
-        layers = 5
-    
-    next_layer = [start_neuron]
-    for n in range(layers):
-        print(layer_names[n])
-        next_layer = make_csvs_in_list(next_layer)
-    
-def make_csv(neuron_id, percentage_threshold=0.5, connection_threshold=3, folder="", client=None):
+    stamp = None
+    if snapshot is None:
+        # the root IDs of the cascade are those of this materialization, so refresh_cascade looks for
+        # edits made since its timestamp
+        version = client.materialize.version
+        if cache is not None:
+            cache.invalidate_superseded(client, version=version)
+            timestamp = cache.materialization_timestamp(client, version)
+        else:
+            timestamp = client.materialize.get_timestamp(version).timestamp()
+        stamp = {"version": version, "timestamp": timestamp}
+    return cascade.run_cascade(start_neuron, folder, make_csvs_in_list, layers, batch_size, stamp)
+
+def refresh_cascade(start_neuron, percentage_threshold=1, connection_threshold=3, client=None, chunk_size=50,
+                    cache=None, region=T1_REGION, output="csv", input_table=None, resolver=None, page_size=100000):
+    """Bring an existing cascade folder up to date with proofreading. Root IDs in the cascade that have
+    changed since the materialization it was made from are found in one batched chunkedgraph request, and
+    only neurons whose own ID changed, or that had a partner whose ID changed, are queried again. Their
+    outputs are rewritten under their latest IDs, and new partners found this way are followed down to the
+    depth of the cascade. Outputs of neurons that are no longer reached are left in place.
+
+    The neurons are queried again live, at the time of the refresh, since a materialization version made
+    before the edits does not know the new root IDs. The checkpoint then records that time, so the next
+    refresh looks for edits made after it. Neurons merged into one by proofreading take the shallowest of
+    their layers, and the cost of the refresh is written to cascade.REPORT in the folder, as for a run.
+
+    Parameters
+    ----------
+    start_neuron :          int
+                            FANC neuron ID the cascade was started from, as in the folder name
+    percentage_threshold :  float
+                            percentage threshold the cascade was made with, as in the folder name
+    connection_threshold :  int
+                            minimum number of synapses required to be considered a connection between neurons
+    client :                caveclient.frameworkclient.CAVEclientFull
+                            CAVEclient to query information from. If not passed to the function the shared client is used.
+    chunk_size :            int
+                            maximum number of neuron IDs sent in a single synapse query
+    cache :                 synapse_cache.SynapseCache
+                            on-disk cache of the cascade. The entries of root IDs that have been superseded by
+                            proofreading are removed from it. Live queries are not cached.
+    region :                dict
+                            keyword arguments for spatial_filter giving the region of the VNC in which synapses are
+                            counted. Defaults to the T1 neuromere.
+    output :                str
+                            "csv", "store" or "both", see cascade_csvs
+    input_table :           input_table.InputTable
+                            table of total inputs and fragments, see cascade_csvs
+    resolver :              lineage.LineageResolver
+                            resolver used to find the latest IDs. If not passed to the function the shared resolver is used.
+    page_size :             int
+                            maximum number of synapse rows returned by a single synapse query, see stream_synapse_counts
+
+    Returns
+    -------
+    dict
+                            dictionary of old_id:latest_id for every root ID in the cascade that had changed
+
+    """
+    if not client:
+        client = clients.cave()
+    folder = str(start_neuron)+"-"+str(percentage_threshold)+"/"
+    if not resolver:
+        resolver = clients.lineage()
+    # the cost of the refresh is broken down in the report of the folder, as for a cascade run
+    with instrumentation.recording() as recorder:
+        try:
+            return _refresh(start_neuron, folder, percentage_threshold, connection_threshold, client, chunk_size,
+                            cache, region, output, input_table, resolver, page_size)
+        finally:
+            recorder.save(folder+cascade.REPORT)
+
+def _refresh(start_neuron, folder, percentage_threshold, connection_threshold, client, chunk_size, cache, region,
+             output, input_table, resolver, page_size):
+    state = cascade.load_checkpoint(folder)
+    if state is None:
+        state = cascade.checkpoint_from_folder(start_neuron, folder)
+    refresh_time = datetime.datetime.now(datetime.timezone.utc)
+    depth = state["depth"]
+    done = set(state["done"])
+    read_partners = cascade.saved_partners(folder)
+
+    # find the root IDs that have changed, in one request if we know the data the cascade was made from.
+    # Checkpoints written before the version was recorded hold the wall-clock time of the run, which
+    # misses edits made between the materialization and the run, so every ID is checked for them
+    if state.get("version") is not None and state.get("timestamp"):
+        since = datetime.datetime.fromtimestamp(state["timestamp"], datetime.timezone.utc)
+        with instrumentation.timed("cave.get_delta_roots") as timer:
+            old_roots, _ = client.chunkedgraph.get_delta_roots(since, refresh_time)
+            timer.set(old_roots)
+        outdated = set(id_arrays.as_ids(old_roots).tolist()) & set(depth)
+    else:
+        outdated = set()
+        for chunk in id_arrays.chunks(list(depth), 500):
+            with instrumentation.timed("cave.is_latest_roots") as timer:
+                latest = client.chunkedgraph.is_latest_roots(chunk)
+                timer.set(latest)
+            outdated.update(x for x, is_latest in zip(chunk, latest) if not is_latest)
+    outdated = sorted(outdated)
+    # remembered answers may predate the edits, so every one is checked again in a batched request
+    new_ids = dict(zip(outdated, resolver.latest_roots(outdated, client=client, max_age=0).tolist()))
+    if cache is not None:
+        cache.invalidate_superseded(client)
+
+    affected = {}
+    for neuron_id in done:
+        partners = read_partners(neuron_id) or []
+        if neuron_id in outdated or any(int(x) in outdated for x in partners):
+            affected[neuron_id] = depth[neuron_id]
+    for neuron_id in affected:
+        path = folder+str(neuron_id)+"_downstreampartners.csv"
+        if os.path.exists(path):
+            os.remove(path)
+        done.discard(neuron_id)
+    edge_store.remove_edges(folder+edge_store.EDGE_STORE, affected)
+    # neurons merged by proofreading share a new ID, which keeps the shallowest of their layers
+    for old_id, new_id in new_ids.items():
+        layer = depth.pop(old_id)
+        depth[new_id] = min(layer, depth.get(new_id, layer))
+    state["frontier"] = [x for x in dict.fromkeys(new_ids.get(x, x) for x in state["frontier"])
+                         if depth[x] == state["layer"]]
+
+    # query the affected neurons again, shallowest first, following any new partners
+    pending = {}
+    for neuron_id in affected:
+        neuron_id = new_ids.get(neuron_id, neuron_id)
+        pending[neuron_id] = depth[neuron_id]
+    while pending:
+        layer = min(pending.values())
+        batch = [x for x, x_layer in pending.items() if x_layer == layer]
+        for neuron_id in batch:
+            del pending[neuron_id]
+        with instrumentation.context(layer=layer):
+            tables = downstream_of_layer(batch, connection_threshold, client, chunk_size, None, region,
+                                         input_table=input_table, timestamp=refresh_time, page_size=page_size)
+            partners = _save_partners(tables, {neuron_id: layer for neuron_id in batch}, percentage_threshold,
+                                      folder, output)
+        done.update(batch)
+        for neuron_id in batch:
+            for partner in partners[neuron_id]:
+                if partner not in depth:
+                    depth[partner] = layer+1
+                    if layer+1 < state["layer"]:
+                        pending[partner] = layer+1
+                    elif layer+1 == state["layer"]:
+                        state["frontier"].append(partner)
+    state["done"] = sorted(done)
+    state["timestamp"] = refresh_time.timestamp()
+    cascade.save_checkpoint(folder, state)
+    return new_ids
+
+@instrumentation.instrumented()
+def _save_partners(tables, layers, percentage_threshold, folder, output):
+    # save the downstream_of tables of a batch of neurons as .csv files and/or edge table rows,
+    # returning a dictionary of neuron_id:list of saved partner IDs
+    downstream_neurons = {}
+    edges = []
+    for neuron_id, layer in layers.items():
+        print(neuron_id, end=" ")
+        dataframe = _partner_table(tables[neuron_id], percentage_threshold)
+        if output in ("csv", "both") and dataframe.size:
+            dataframe.to_csv(folder+str(neuron_id)+"_downstreampartners.csv")
+        if output in ("store", "both") and dataframe.size:
+            edges.append(edge_store.edges_from_table(dataframe, neuron_id, layer, "fanc"))
+        downstream_neurons[neuron_id] = dataframe.index.to_list()
+        if len(dataframe):
+            print("created file")
+        else:
+            print("no downstream partners")
+    if edges:
+        edge_store.append_edges(folder+edge_store.EDGE_STORE, pd.concat(edges, ignore_index=True))
+    return downstream_neurons
+
+def make_csv(neuron_id, percentage_threshold=0.5, connection_threshold=3, folder="", client=None, cache=None,
+             region=T1_REGION, snapshot=None, input_table=None, page_size=100000):
     """Save a dataframe in .csv format of the neurons downstream from the input neuron, ordered by percentage input.
     the dataframe is sorted by high to low percent with columns -
                             bodyId: the ID of the downstream neuron
@@ -228,7 +877,19 @@ def make_csv(neuron_id, percentage_threshold=0.5, connection_threshold=3, folder
     folder :                str
                             name of the folder in which to save the .csv file.
     client :                caveclient.frameworkclient.CAVEclientFull
-                            CAVEclient to query information from. If not passed to the function it will create its own.
+                            CAVEclient to query information from. If not passed to the function the shared client is used.
+    cache :                 synapse_cache.SynapseCache
+                            on-disk cache to read synapses from and store queried synapses in. If not passed to the
+                            function every synapse is queried.
+    region :                dict
+                            keyword arguments for spatial_filter giving the region of the VNC in which synapses are
+                            counted. Defaults to the T1 neuromere.
+    snapshot :              connectome_snapshot.ConnectomeSnapshot
+                            offline FANC connectome to read connections from instead of querying CAVE.
+    input_table :           input_table.InputTable
+                            table of total inputs and fragments, see downstream_of_layer
+    page_size :             int
+                            maximum number of synapse rows returned by a single synapse query, see stream_synapse_counts
 
     Returns
     -------
@@ -236,23 +897,52 @@ def make_csv(neuron_id, percentage_threshold=0.5, connection_threshold=3, folder
                         List of the IDs of downstream neurons contained in the dataframe.
 
     """
-    table = downstream_of(neuron_id,connection_threshold)
-    dataframe = table.loc[table.percent >= percentage_threshold]
+    table = downstream_of(neuron_id,connection_threshold,client,cache,region,snapshot,input_table,page_size)
+    return save_csv(table, neuron_id, percentage_threshold, folder)
+
+def save_csv(table, neuron_id, percentage_threshold=0.5, folder=""):
+    """Save a table returned by downstream_of in the .csv format written by make_csv.
+
+    Parameters
+    ----------
+    table :                 pandas DataFrame
+                            DataFrame of downstream partners in the format returned by downstream_of
+    neuron_id :             int
+                            FANC neuron ID the table describes the downstream partners of
+    percentage_threshold :  float
+                            minimum percentage input required to be included in the saved csv file
+    folder :                str
+                            name of the folder in which to save the .csv file.
+
+    Returns
+    -------
+    list
+                        List of the IDs of downstream neurons contained in the dataframe.
+
+    """
+    dataframe = _partner_table(table, percentage_threshold)
     if dataframe.size == 0:
         return []
-    dataframe = dataframe.rename(columns={'count': 'weight'})
-    dataframe.index.names = ['bodyId']
     dataframe.to_csv(folder+str(neuron_id)+"_downstreampartners.csv")
     return dataframe.index.to_list()
 
-def update_fanc_id(fanc_id, client=None):
+def _partner_table(table, percentage_threshold):
+    # keep the partners above the percentage threshold, in the layout of the saved .csv files
+    dataframe = table.loc[table.percent >= percentage_threshold]
+    dataframe = dataframe.rename(columns={'count': 'weight'})
+    dataframe.index.names = ['bodyId']
+    return dataframe
+
+def update_fanc_id(fanc_id, client=None, resolver=None):
     """Query CAVEclient for the newest ID associated with a neuron
     Parameters
     ----------
     neuron_id :             int or str
                             FANC neuron ID to find the current ID of
     client :                caveclient.frameworkclient.CAVEclientFull
-                            CAVEclient to query information from. If not passed to the function it will create its own.
+                            CAVEclient to query information from. If not passed to the function the shared client is used.
+    resolver :              lineage.LineageResolver
+                            resolver that remembers earlier answers. If not passed to the function the shared resolver is used.
 
     Returns
     -------
@@ -260,21 +950,46 @@ def update_fanc_id(fanc_id, client=None):
                         Current FANC neuron ID, or None if input ID in not valid
 
     """
-    if not client:
-        client = cv.CAVEclient('fanc_production_mar2021')
-    if fanc_id == "" or fanc_id == None or fanc_id == "NotAssigned":
-        return None
-    newest_id = client.chunkedgraph.suggest_latest_roots(fanc_id)
-    return newest_id
-
-def mf_match(manc_id, seatable=None):
-    """Query the matching table on Seatable for the FANC ID associated with a MANC neuron
+    return update_fanc_ids([fanc_id], client, resolver)[0]
+
+def update_fanc_ids(fanc_ids, client=None, resolver=None):
+    """Query CAVEclient for the newest IDs associated with many neurons at once
+    Parameters
+    ----------
+    fanc_ids :              list of int or str
+                            FANC neuron IDs to find the current IDs of
+    client :                caveclient.frameworkclient.CAVEclientFull
+                            CAVEclient to query information from. If not passed to the function the shared client is used.
+    resolver :              lineage.LineageResolver
+                            resolver that remembers earlier answers. If not passed to the function the shared resolver is used.
+
+    Returns
+    -------
+    list
+                        Current FANC neuron IDs, with None for input IDs that are not valid
+
+    """
+    if not resolver:
+        resolver = clients.lineage()
+    valid = [fanc_id for fanc_id in fanc_ids if not _missing_id(fanc_id)]
+    newest_ids = iter(resolver.latest_roots(valid, client=client).tolist())
+    return [None if _missing_id(fanc_id) else next(newest_ids) for fanc_id in fanc_ids]
+
+def _missing_id(fanc_id):
+    return fanc_id is None or fanc_id == "" or fanc_id == "NotAssigned" or (isinstance(fanc_id, float) and np.isnan(fanc_id))
+
+def mf_match(manc_id, seatable=None, resolver=None, index=None):
+    """Look up the FANC ID associated with a MANC neuron in the matching table
     Parameters
     ----------
     manc_id :       int or str
                     MANC neuron ID to find the FANC match of
     seatable :      seaserpent.base.Table
-                    Seaserpent table to query information from. If not passed to the function it will create its own.
+                    Seaserpent table to read the matches from. If not passed to the function the shared match index is used.
+    resolver :      lineage.LineageResolver
+                    resolver used to find current FANC IDs. If not passed to the function the shared resolver is used.
+    index :         match_index.MatchIndex
+                    local copy of the matching table to look the match up in
 
     Returns
     -------
@@ -282,39 +997,22 @@ def mf_match(manc_id, seatable=None):
                 Current FANC neuron ID, or String with both connectivity match and nBlast match if they aren't the same.
 
     """
-    if not seatable:
-        seatable = ss.Table(table='fanc851_manc_nblast95_60')
-    row = seatable[seatable.queryID == str(manc_id)].iloc[0]
-    if row.manualAssignment:
-        return update_fanc_id(row.manualAssignment)
-    try:
-        nblast_match = row.nBlastMatchID
-    except:
-        nblast_match = None
-    try:
-        cosine_match = row.conMatchID
-    except:
-        cosine_match = None
-    if nblast_match == cosine_match:
-        return update_fanc_id(nblast_match)
-    else:
-        if row.check_L_R[0] == "Yes":
-            symmetry_string = ", also neuron may be left/right flipped"
-        else:
-            symmetry_string = ""
-        print("nblast and cosine similarity don't agree on a match for ", manc_id, symmetry_string)
-        return ("nblast:", update_fanc_id(nblast_match), "connectivity:", update_fanc_id(cosine_match))
+    return _match_index(seatable, index).fanc_match(manc_id, resolver)
 
-def fm_match(fanc_id, seatable=None, client=None):
-    """Query the matching table on Seatable for the MANC ID associated with a FANC neuron
+def fm_match(fanc_id, seatable=None, client=None, resolver=None, index=None):
+    """Look up the MANC ID associated with a FANC neuron in the matching table
     Parameters
     ----------
     fanc_id :       int or str
                     FANC neuron ID to find the MANC match of
     seatable :      seaserpent.base.Table
-                    Seaserpent table to query information from. If not passed to the function it will create its own.
+                    Seaserpent table to read the matches from. If not passed to the function the shared match index is used.
     client :        caveclient.frameworkclient.CAVEclientFull
-                    CAVEclient to query information from. If not passed to the function it will create its own.
+                    CAVEclient to query information from. If not passed to the function the shared client is used.
+    resolver :      lineage.LineageResolver
+                    resolver used to find past FANC IDs. If not passed to the function the shared resolver is used.
+    index :         match_index.MatchIndex
+                    local copy of the matching table to look the match up in
 
     Returns
     -------
@@ -322,30 +1020,9 @@ def fm_match(fanc_id, seatable=None, client=None):
                 Current MANC neuron ID, or List with possible matches.
 
     """
-    if not client:
-        client = cv.CAVEclient('fanc_production_mar2021')
-    if not seatable:
-        seatable = ss.Table(table='fanc851_manc_nblast95_60')
-    # search in the manual matches
-    past_ids = [str(x) for x in client.chunkedgraph.get_past_ids(fanc_id)["past_id_map"][fanc_id]]
-    past_ids.append(str(fanc_id))
-    rows = seatable[seatable.manualAssignment.isin(past_ids)]
-    if rows.shape[0] == 1:
-        print("manually assigned")
-        return int(rows.iloc[0].queryID)
-
-    # if there are no manual matches look for nBlast and connectivity matches instead
-    if rows.shape[0] == 0:
-        rows = seatable[seatable.nBlastMatchID.isin(past_ids) or seatable.conMatchID.isin(past_ids)]
-    
-    # if there's one row and the nblast and connection matches are the same
-    if rows.shape[0] == 1 and rows.iloc[0].nBlastMatchID == rows.iloc[0].conMatchID:
-        return int(rows.iloc[0].queryID)
-    else:
-        print("no definite match for", fanc_id, ", options returned as a list.")
-    return rows.queryID.to_list()
+    return _match_index(seatable, index).manc_match(fanc_id, resolver, client)
 
-def rank_matches(fanc_csv, manc_csv, seatable=None):
+def rank_matches(fanc_csv, manc_csv, seatable=None, resolver=None, index=None):
     """Create a table from one MANC neuron table and one FANC table for comparison
     Parameters
     ----------
@@ -356,35 +1033,40 @@ def rank_matches(fanc_csv, manc_csv, seatable=None):
                     either a DataFrame with MANC IDs in the leftmost column or a filepath
                         (in string format) to an equivalent .csv file
     seatable :      seaserpent.base.Table
-                    Seaserpent table to query information from. If not passed to the function it will create its own.
+                    Seaserpent table to read the matches from. If not passed to the function the shared match index is used.
+    resolver :      lineage.LineageResolver
+                    resolver used to find current FANC IDs. If not passed to the function the shared resolver is used.
+    index :         match_index.MatchIndex
+                    local copy of the matching table to look the matches up in
 
     Returns
     -------
     pandas DataFrame
-                Combined table with all MANC IDs and the FANC IDs that could be matched to them
+                Combined table indexed by Int64 MANC ID, with the Int64 FANC ID matched to each MANC neuron in the
+                fanc column. FANC neurons without a match have a missing MANC ID.
 
     """
-    if not seatable:
-        seatable = ss.Table(table='fanc851_manc_nblast95_60')
     if isinstance(fanc_csv, str):
-        fanc = pd.read_csv(fanc_csv, index_col=0)
+        fanc = id_arrays.read_table(fanc_csv)
     else:
         fanc = fanc_csv
     if isinstance(manc_csv, str):
-        manc = pd.read_csv(manc_csv, index_col=0)
+        manc = id_arrays.read_table(manc_csv)
     else:
         manc = manc_csv
 
-    assigned_fanc = []
-    clean_fanc = []
-    for id, _ in manc.iterrows():
-        fanc_id = mf_match(id,seatable)
-        assigned_fanc.append(fanc_id)
-        if not isinstance(fanc_id, tuple):
-            clean_fanc.append(fanc_id)
-        else:
-            clean_fanc.append(None)
-    manc["fanc"] = clean_fanc
-    fanc.index = fanc.index.astype(float)
+    # matches are kept as Int64 and joined on exact int64 IDs, as FANC IDs are too large for floats
+    manc["fanc"] = _match_index(seatable, index).fanc_matches(manc.index, resolver).array
+    # the MANC IDs are made Int64 as well, so the FANC rows without a match leave them missing rather than float
+    manc.index = pd.Index(id_arrays.optional_ids(manc.index), name=manc.index.name)
+    fanc.index = id_arrays.id_index(fanc.index, fanc.index.name)
     combined_table = manc.merge(fanc, left_on="fanc", right_index=True, how="outer")
     return combined_table
+
+def _match_index(seatable, index):
+    # a table passed in is read whole into a local index, otherwise the shared index is used
+    if index is not None:
+        return index
+    if seatable:
+        return match_index.MatchIndex.from_seatable(seatable)
+    return clients.match_index()
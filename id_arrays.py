@@ -0,0 +1,98 @@
+import numpy as np
+import pandas as pd
+
+# FANC root IDs such as 648518346477182224 are above 2**53, so they cannot pass through a float without
+# being changed. IDs are held as int64 NumPy arrays, or as the nullable Int64 pandas type where an ID may
+# be missing, and converted a whole array at a time.
+ID_DTYPE = "int64"
+OPTIONAL_ID_DTYPE = "Int64"
+# the largest integer a float64 holds exactly
+FLOAT_EXACT = 2**53
+# MANC body IDs are short, FANC root IDs all have 18 digits
+FANC_MINIMUM = 10**12
+# values that mean "no ID" in the matching table and in .csv files
+_EMPTY = ["", "NotAssigned", "nan", "NaN", "None", "<NA>"]
+
+def as_ids(values):
+    """Return IDs given as ints, strings, or a NumPy array, pandas Series or Index of them, as an int64 array.
+    No ID may be missing. Float IDs are only accepted if every one is below 2**53, where floats are exact.
+
+    Raises
+    ------
+    ValueError
+                        if an ID is missing or is a float too large to be exact
+    """
+    if isinstance(values, (pd.Series, pd.Index)) and isinstance(values.dtype, pd.Int64Dtype):
+        if values.isna().any():
+            raise ValueError("missing ID")
+        return values.to_numpy(dtype=ID_DTYPE)
+    array = np.asarray(values if isinstance(values, (np.ndarray, pd.Series, pd.Index)) else list(values))
+    if array.dtype.kind in "iu":
+        return array.astype(ID_DTYPE, copy=False)
+    if array.dtype.kind == "f":
+        if np.isnan(array).any():
+            raise ValueError("missing ID")
+        if (np.abs(array) >= FLOAT_EXACT).any():
+            raise ValueError("IDs were stored as floats above 2**53 and may have been changed")
+        return array.astype(ID_DTYPE)
+    if array.dtype.kind == "b":
+        raise ValueError("IDs cannot be booleans")
+    optional = optional_ids(array)
+    if optional.isna().any():
+        raise ValueError("missing ID")
+    return optional.to_numpy(dtype=ID_DTYPE)
+
+def optional_ids(values, errors="raise"):
+    """Return IDs that may be missing as a nullable Int64 pandas array. None, NaN, empty strings and
+    "NotAssigned" become missing. Strings are parsed exactly, "123.0" being read as 123. Values that are
+    not exact IDs, such as "6.48e+17" or "[1, 2]", raise a ValueError, or become missing if errors is
+    "coerce" as in pandas.to_numeric."""
+    if isinstance(values, (pd.Series, pd.Index)) and isinstance(values.dtype, pd.Int64Dtype):
+        return values.array
+    array = np.asarray(values if isinstance(values, (np.ndarray, pd.Series, pd.Index)) else list(values))
+    if array.dtype.kind in "iu":
+        return pd.array(array.astype(ID_DTYPE, copy=False), dtype=OPTIONAL_ID_DTYPE)
+    if array.dtype.kind == "f":
+        missing = np.isnan(array)
+        inexact = ~missing & (np.abs(np.where(missing, 0, array)) >= FLOAT_EXACT)
+        if inexact.any() and errors != "coerce":
+            raise ValueError("IDs were stored as floats above 2**53 and may have been changed")
+        missing |= inexact
+        return pd.arrays.IntegerArray(np.where(missing, 0, array).astype(ID_DTYPE), missing)
+    # ints, floats and strings mixed in an object array are parsed from their text
+    text = pd.Series(array.astype(str), dtype="string").str.strip().str.removesuffix(".0")
+    missing = (text.isna() | text.isin(_EMPTY)).to_numpy()
+    invalid = ~missing & ~text.str.fullmatch(r"[+-]?\d+").fillna(False).to_numpy(dtype=bool)
+    if invalid.any():
+        if errors != "coerce":
+            raise ValueError("not an ID: "+repr(text[invalid].iloc[0]))
+        missing = missing | invalid
+    parsed = np.zeros(len(text), dtype=ID_DTYPE)
+    if (~missing).any():
+        parsed[~missing] = text[~missing].to_numpy(dtype=str).astype(ID_DTYPE)
+    return pd.arrays.IntegerArray(parsed, missing)
+
+def id_index(values, name=None):
+    """Return IDs as an int64 pandas Index."""
+    return pd.Index(as_ids(values), dtype=ID_DTYPE, name=name)
+
+def read_table(path, **kwargs):
+    """Read a .csv file with IDs in its first column, such as a _downstreampartners.csv file, as a DataFrame
+    indexed by those IDs. The IDs are read as text and parsed exactly, so empty or float-formatted IDs do
+    not round the others. The index is int64, or Int64 if some IDs are missing."""
+    first = pd.read_csv(path, nrows=0).columns[0]
+    table = pd.read_csv(path, dtype={first: "string"}, **kwargs)
+    index = optional_ids(table.pop(first))
+    # a .csv file written from an unnamed index has no name for the column
+    name = None if first.startswith("Unnamed: ") else first
+    table.index = pd.Index(index if index.isna().any() else index.to_numpy(dtype=ID_DTYPE), name=name)
+    return table
+
+def chunks(items, chunk_size):
+    """Split IDs into consecutive lists of at most chunk_size IDs, for example one list per request."""
+    items = list(items)
+    return [items[i:i+chunk_size] for i in range(0, len(items), chunk_size)]
+
+def is_fanc(ids):
+    """Return a boolean array, True for FANC root IDs and False for MANC body IDs."""
+    return as_ids(ids) >= FANC_MINIMUM
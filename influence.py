@@ -0,0 +1,125 @@
+import os
+import numpy as np
+import pandas as pd
+from scipy import sparse
+import edge_store
+import id_arrays
+
+def propagate(matrix, ids, start_neurons, hops=3, threshold=1e-4):
+    """Spread influence from start neurons through a weighted connectivity matrix, one sparse
+    matrix-vector product per hop.
+
+    The influence of a neuron at hop k is the sum, over every path of k connections from a start neuron,
+    of the product of the input fractions along the path. Values below threshold are dropped after each
+    hop so the active set stays small.
+
+    Parameters
+    ----------
+    matrix :            scipy sparse matrix
+                        square matrix whose entry [i, j] is the fraction of the inputs of neuron j that come
+                        from neuron i
+    ids :               numpy array
+                        sorted neuron IDs of the rows and columns of matrix
+    start_neurons :     int or list of int
+                        IDs of the neurons influence spreads from, each starting with influence 1
+    hops :              int
+                        number of connections to follow
+    threshold :         float
+                        smallest influence kept after each hop
+
+    Returns
+    -------
+    pandas DataFrame
+                        DataFrame indexed by neuron ID, sorted by high to low influence, with columns -
+                            influence: influence summed over all hops
+                            hop_1 ... hop_N: influence arriving at each hop
+                            first_hop: the first hop at which the neuron is reached
+
+    """
+    start_neurons = np.atleast_1d(np.asarray(start_neurons, dtype="int64"))
+    rows = np.searchsorted(ids, start_neurons)
+    found = rows < len(ids)
+    found[found] = ids[rows[found]] == start_neurons[found]
+    vector = sparse.csr_matrix((np.ones(found.sum()), (np.zeros(found.sum(), dtype=int), rows[found])),
+                               shape=(1, len(ids)))
+    transposed = sparse.csr_matrix(matrix).transpose().tocsr()
+    per_hop = []
+    for hop in range(hops):
+        vector = (transposed @ vector.transpose()).transpose().tocsr()
+        vector.data[vector.data < threshold] = 0
+        vector.eliminate_zeros()
+        if not vector.nnz:
+            break
+        per_hop.append(pd.Series(vector.data, index=ids[vector.indices], name="hop_"+str(hop+1)))
+
+    table = pd.concat(per_hop, axis=1).fillna(0) if per_hop else pd.DataFrame(index=pd.Index([], dtype="int64"))
+    for hop in range(hops):
+        if "hop_"+str(hop+1) not in table:
+            table["hop_"+str(hop+1)] = 0.0
+    hop_columns = ["hop_"+str(hop+1) for hop in range(hops)]
+    table = table[hop_columns]
+    table.insert(0, "influence", table.sum(axis=1))
+    table["first_hop"] = (table[hop_columns].to_numpy() > 0).argmax(axis=1)+1
+    table.index.name = "neuron"
+    return table.sort_values("influence", ascending=False)
+
+def influence_from_edges(edges, start_neuron, hops=3, threshold=1e-4, targets=None):
+    """Rank every neuron reachable from the start neuron by its multi-hop influence, using the percentage
+    inputs saved by a cascade.
+
+    Parameters
+    ----------
+    edges :             pandas DataFrame
+                        edge table with pre, post and percent columns, as read by edge_store.read_edges or
+                        folder_edges. Repeated pairs keep their first row.
+    start_neuron :      int
+                        ID of the neuron influence spreads from
+    hops :              int
+                        number of connections to follow
+    threshold :         float
+                        smallest influence kept after each hop, as a fraction (0.01 is 1%)
+    targets :           list of int
+                        optional IDs, such as T1 motor neurons, to limit the returned table to
+
+    Returns
+    -------
+    pandas DataFrame
+                        see propagate
+
+    """
+    edges = edges.drop_duplicates(["pre", "post"])
+    pre = edges["pre"].to_numpy(dtype="int64")
+    post = edges["post"].to_numpy(dtype="int64")
+    ids = np.unique(np.concatenate([pre, post, [int(start_neuron)]]))
+    matrix = sparse.csr_matrix((edges["percent"].to_numpy(dtype="float64")/100,
+                                (np.searchsorted(ids, pre), np.searchsorted(ids, post))), shape=(len(ids), len(ids)))
+    return _targets(propagate(matrix, ids, start_neuron, hops, threshold), targets)
+
+def influence_from_snapshot(snapshot, start_neuron, hops=3, threshold=1e-4, targets=None):
+    """Rank every neuron reachable from the start neuron by its multi-hop influence over a whole
+    connectome_snapshot.ConnectomeSnapshot, without the thresholds a cascade applies. Fragments take no
+    part. Arguments are as for influence_from_edges."""
+    total_input = np.asarray(snapshot.total_input, dtype="float64")
+    scale = np.divide(1, total_input, out=np.zeros_like(total_input), where=(total_input > 0) & snapshot.soma)
+    matrix = snapshot.matrix.astype("float64") @ sparse.diags(scale)
+    return _targets(propagate(matrix, snapshot.ids, start_neuron, hops, threshold), targets)
+
+def folder_edges(folder):
+    """Read the edges of a cascade folder from its edge table, or from its _downstreampartners.csv files
+    if it has none."""
+    store = os.path.join(folder, edge_store.EDGE_STORE)
+    if os.path.exists(store):
+        return edge_store.read_edges(store)
+    tables = []
+    for csv in os.listdir(folder):
+        if csv.endswith("_downstreampartners.csv"):
+            table = id_arrays.read_table(os.path.join(folder, csv))
+            tables.append(edge_store.edges_from_table(table, int(csv.removesuffix("_downstreampartners.csv")), -1, ""))
+    if not tables:
+        return edge_store.read_edges(store)
+    return pd.concat(tables, ignore_index=True)
+
+def _targets(table, targets):
+    if targets is None:
+        return table
+    return table.loc[table.index.isin(np.asarray(list(targets), dtype="int64"))]
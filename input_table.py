@@ -0,0 +1,153 @@
+import os
+import time
+import numpy as np
+import pandas as pd
+import atomic_file
+import clients
+import instrumentation
+from rate_limit import throttle
+
+# local tables written by save, one per dataset
+FANC_TABLE = "fanc_inputs.parquet"
+MANC_TABLE = "manc_inputs.parquet"
+# FANC neurons with this many inputs or fewer are treated as fragments, as in fanc_synapses
+FANC_FRAGMENT_INPUTS = 100
+MANC_QUERY = """MATCH (n:Neuron)
+RETURN n.bodyId AS bodyId, n.post AS post, n.somaLocation IS NOT NULL AS soma"""
+
+class InputTable:
+    """The total number of inputs and a fragment flag for each neuron, built once and kept on disk, so that
+    percentage inputs are a join against the table and fragments are dropped before any synapse or
+    neuron is downloaded for them.
+
+    FANC neurons are fragments if they have FANC_FRAGMENT_INPUTS inputs or fewer, MANC neurons if they have
+    no soma, matching the filters of fanc_synapses and manc_synapses. Neurons that are not in the table are
+    queried as before and can be added to it with add.
+
+    Parameters
+    ----------
+    neurons :           pandas DataFrame
+                        table indexed by neuron ID with the columns -
+                            inputs: the total number of inputs to the neuron
+                            soma: True if the neuron has a soma. Defaults to True.
+    dataset :           str
+                        "fanc" or "manc", setting which fragment rule is used
+    built :             float
+                        time the table was built, in seconds since the epoch. Defaults to now.
+
+    """
+    def __init__(self, neurons, dataset="fanc", built=None):
+        self.dataset = dataset
+        self.built = time.time() if built is None else built
+        self.neurons = pd.DataFrame(index=pd.Index([], dtype="int64"))
+        self.add(neurons)
+
+    @classmethod
+    def from_fanc(cls, neuron_ids, client=None, chunk_size=50):
+        """Count the inputs of FANC neurons, such as every neuron reached by earlier cascades, page by page
+        with fanc_synapses.stream_synapse_counts."""
+        import fanc_synapses
+        counts = fanc_synapses.stream_synapse_counts(neuron_ids, "post", client, chunk_size, by_partner=False)
+        counts = counts.reindex(pd.Index(neuron_ids, dtype="int64"), fill_value=0)
+        return cls(pd.DataFrame({"inputs": counts}), "fanc")
+
+    @classmethod
+    def from_synapse_export(cls, path, chunk_size=1000000):
+        """Count the inputs of every FANC neuron in a local Parquet or .csv export of the synapse table,
+        reading it chunk_size rows at a time. Only the post_pt_root_id column is read."""
+        counts = None
+        for chunk in _read_chunks(path, "post_pt_root_id", chunk_size):
+            chunk_counts = chunk.value_counts()
+            counts = chunk_counts if counts is None else counts.add(chunk_counts, fill_value=0)
+        if counts is None:
+            counts = pd.Series([], dtype="int64")
+        return cls(pd.DataFrame({"inputs": counts.astype("int64")}), "fanc")
+
+    @classmethod
+    def from_manc(cls, limiter=None):
+        """Fetch the total inputs and soma of every MANC neuron from neuprint in a single query."""
+        neuprint, client = clients.neuprint_api(), clients.neuprint_client()
+        throttle(limiter)
+        with instrumentation.timed("neuprint.fetch_custom") as timer:
+            neurons = neuprint.fetch_custom(MANC_QUERY, client=client)
+            timer.set(neurons)
+        neurons = neurons.set_index("bodyId").rename(columns={"post": "inputs"})
+        neurons["inputs"] = pd.to_numeric(neurons["inputs"]).fillna(0)
+        return cls(neurons, "manc")
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        """Take the inputs and soma flags of a connectome_snapshot.ConnectomeSnapshot."""
+        return cls(pd.DataFrame({"inputs": snapshot.total_input, "soma": snapshot.soma}, index=snapshot.ids),
+                   snapshot.dataset or "fanc")
+
+    @classmethod
+    def load(cls, path, dataset="fanc"):
+        neurons = pd.read_parquet(path)
+        return cls(neurons, dataset, os.path.getmtime(path))
+
+    def save(self, path):
+        with atomic_file.write(path, "wb") as file:
+            self.neurons[["inputs", "soma"]].to_parquet(file)
+
+    def age(self):
+        """Seconds since the table was built."""
+        return time.time()-self.built
+
+    def add(self, neurons):
+        """Add or replace neurons, given as a DataFrame in the format of the neurons parameter or as a
+        Series of total inputs."""
+        if isinstance(neurons, pd.Series):
+            neurons = neurons.rename("inputs").to_frame()
+        neurons = neurons.reindex(columns=["inputs", "soma"])
+        neurons.index = neurons.index.astype("int64")
+        neurons["inputs"] = neurons["inputs"].to_numpy(dtype="int64")
+        neurons["soma"] = neurons["soma"].fillna(True).to_numpy(dtype=bool)
+        if self.dataset == "manc":
+            neurons["fragment"] = ~neurons["soma"]
+        else:
+            neurons["fragment"] = neurons["inputs"] <= FANC_FRAGMENT_INPUTS
+        neurons = neurons.loc[~neurons.index.duplicated(keep="last")]
+        if len(self.neurons):
+            neurons = pd.concat([self.neurons.loc[~self.neurons.index.isin(neurons.index)], neurons])
+        self.neurons = neurons
+
+    def known(self, neuron_ids):
+        """Return a boolean array, True for the neuron IDs that are in the table."""
+        return self.neurons.index.get_indexer(np.asarray(neuron_ids, dtype="int64")) >= 0
+
+    def inputs(self, neuron_ids):
+        """Return a Series of the total number of inputs of each neuron, NaN for neurons not in the table."""
+        neuron_ids = pd.Index(np.asarray(neuron_ids, dtype="int64"))
+        return self.neurons["inputs"].reindex(neuron_ids).rename("inputs")
+
+    def has_soma(self, neuron_ids):
+        """Return a boolean array, False for neurons without a soma and for neurons not in the table."""
+        return self.neurons["soma"].reindex(np.asarray(neuron_ids, dtype="int64"), fill_value=False).to_numpy(dtype=bool)
+
+    def fragments(self, neuron_ids):
+        """Return a boolean array, True for the neurons the table knows to be fragments."""
+        return self.neurons["fragment"].reindex(np.asarray(neuron_ids, dtype="int64"),
+                                                fill_value=False).to_numpy(dtype=bool)
+
+def load_or_build(path, build, dataset="fanc", max_age=7*24*3600):
+    """Load the table at path, or call build() to make a new one and save it there if the file is missing
+    or older than max_age seconds.
+
+    table = input_table.load_or_build(input_table.MANC_TABLE, input_table.InputTable.from_manc, "manc")
+    """
+    if os.path.exists(path) and time.time()-os.path.getmtime(path) < max_age:
+        return InputTable.load(path, dataset)
+    table = build()
+    table.save(path)
+    return table
+
+def _read_chunks(path, column, chunk_size):
+    # yield one column of a Parquet or .csv file in chunks of rows
+    if path.endswith(".parquet"):
+        import pyarrow.parquet
+        for batch in pyarrow.parquet.ParquetFile(path).iter_batches(batch_size=chunk_size, columns=[column]):
+            yield batch.column(0).to_pandas()
+    else:
+        for chunk in pd.read_csv(path, usecols=[column], chunksize=chunk_size):
+            yield chunk[column]
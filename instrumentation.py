@@ -0,0 +1,199 @@
+import contextlib
+import contextvars
+import functools
+import json
+import threading
+import time
+import numpy as np
+import pandas as pd
+import atomic_file
+
+# fields such as the cascade layer and neuron ID attached to every event recorded inside a context
+_context = contextvars.ContextVar("instrumentation_context", default={})
+_lock = threading.Lock()
+_recorders = []
+_hooks = []
+
+class Recorder:
+    """Collects the events recorded while it is active and summarises them into a report.
+
+    Each event is a dictionary with the keys -
+        kind: "remote" for requests to CAVE, neuprint or SeaTable, "cache" for cache lookups and
+            "local" for local processing
+        name: what was called, for example "cave.synapse_query"
+        seconds: how long it took
+        rows, bytes: the size of what it returned, when known
+        hit: True or False for a single cache lookup, or hits and misses counts for a batch of lookups
+        layer, neuron: the cascade layer and neuron it was made for, when known
+    """
+    def __init__(self):
+        self.events = []
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def add(self, event):
+        with self._lock:
+            self.events.append(event)
+
+    def report(self):
+        """Return totals for each call name overall, per layer and per neuron, as a dictionary that can be
+        written as JSON."""
+        with self._lock:
+            events = list(self.events)
+        layers = {}
+        neurons = {}
+        for event in events:
+            if "layer" in event:
+                layers.setdefault(str(event["layer"]), []).append(event)
+            if "neuron" in event:
+                neurons.setdefault(str(event["neuron"]), []).append(event)
+        return {
+            "started": self.started,
+            "seconds": time.time()-self.started,
+            "events": len(events),
+            "calls": _summarise(events),
+            "layers": {layer: _summarise(layer_events) for layer, layer_events in layers.items()},
+            "neurons": {neuron: _summarise(neuron_events) for neuron, neuron_events in neurons.items()},
+        }
+
+    def save(self, path):
+        with atomic_file.write(path) as file:
+            json.dump(self.report(), file, indent=1)
+
+@contextlib.contextmanager
+def recording():
+    """Record every event until the end of the with block.
+
+    with instrumentation.recording() as recorder:
+        fanc_synapses.cascade_csvs(...)
+    recorder.save("report.json")
+    """
+    recorder = Recorder()
+    with _lock:
+        _recorders.append(recorder)
+    try:
+        yield recorder
+    finally:
+        with _lock:
+            _recorders.remove(recorder)
+
+def add_hook(hook):
+    """Call hook(event) for every event recorded from now on, for example to log or to send metrics
+    elsewhere. The event is the dictionary described in Recorder."""
+    with _lock:
+        _hooks.append(hook)
+
+def remove_hook(hook):
+    with _lock:
+        if hook in _hooks:
+            _hooks.remove(hook)
+
+def active():
+    return bool(_recorders or _hooks)
+
+@contextlib.contextmanager
+def context(**fields):
+    """Attach fields, such as layer=2 or neuron=<ID>, to every event recorded inside the with block."""
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+def carry_context(function):
+    """Wrap function so that, when run on a worker thread, its events get the fields of the context it
+    was wrapped in."""
+    fields = _context.get()
+    @functools.wraps(function)
+    def run(*args, **kwargs):
+        token = _context.set(fields)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _context.reset(token)
+    return run
+
+def record(kind, name, seconds, result=None, hit=None, **fields):
+    """Record one event, see Recorder. rows and bytes are measured from result if it is passed."""
+    if not _recorders and not _hooks:
+        return
+    event = {"kind": kind, "name": name, "seconds": seconds, **_context.get(), **fields}
+    if result is not None:
+        event["rows"], event["bytes"] = _size(result)
+    if hit is not None:
+        event["hit"] = bool(hit)
+    with _lock:
+        recorders = list(_recorders)
+        hooks = list(_hooks)
+    for recorder in recorders:
+        recorder.add(event)
+    for hook in hooks:
+        hook(event)
+
+class _Timer:
+    def __init__(self):
+        self.result = None
+        self.fields = {}
+
+    def set(self, result=None, **fields):
+        # record the returned value and any extra fields of the timed call
+        self.result = result
+        self.fields.update(fields)
+
+@contextlib.contextmanager
+def timed(name, kind="remote", **fields):
+    """Time the with block and record it as one event. Pass what the call returned to the set method of
+    the yielded timer to record its size.
+
+    with instrumentation.timed("cave.synapse_query", neurons=len(chunk)) as timer:
+        synapses = client.materialize.synapse_query(...)
+        timer.set(synapses)
+    """
+    timer = _Timer()
+    start = time.perf_counter()
+    try:
+        yield timer
+    finally:
+        record(kind, name, time.perf_counter()-start, timer.result, **{**fields, **timer.fields})
+
+def instrumented(name=None, kind="local"):
+    """Decorator recording the duration and result size of every call of a function."""
+    def decorate(function):
+        event_name = name or function.__module__+"."+function.__name__
+        @functools.wraps(function)
+        def run(*args, **kwargs):
+            if not _recorders and not _hooks:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            result = function(*args, **kwargs)
+            record(kind, event_name, time.perf_counter()-start, result)
+            return result
+        return run
+    return decorate
+
+def _size(result):
+    # number of rows and bytes of a returned value, None where they do not apply
+    if isinstance(result, (pd.DataFrame, pd.Series)):
+        return len(result), int(np.sum(result.memory_usage(index=True, deep=False)))
+    if isinstance(result, np.ndarray):
+        return len(result), int(result.nbytes)
+    if isinstance(result, tuple) and result and isinstance(result[0], pd.DataFrame):
+        return _size(result[0])
+    if isinstance(result, (dict, list, set)):
+        return len(result), None
+    return None, None
+
+def _summarise(events):
+    totals = {}
+    for event in events:
+        total = totals.setdefault(event["name"], {"kind": event["kind"], "calls": 0, "seconds": 0.0, "rows": 0,
+                                                  "bytes": 0, "hits": 0, "misses": 0})
+        total["calls"] += 1
+        total["seconds"] += event["seconds"]
+        total["rows"] += event.get("rows") or 0
+        total["bytes"] += event.get("bytes") or 0
+        if "hit" in event:
+            total["hits" if event["hit"] else "misses"] += 1
+        total["hits"] += event.get("hits", 0)
+        total["misses"] += event.get("misses", 0)
+    return totals
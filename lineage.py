@@ -0,0 +1,178 @@
+import json
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import clients
+import id_arrays
+import instrumentation
+
+class LineageResolver:
+    """Resolves FANC root IDs to their latest IDs and to the IDs they were made from, for many IDs per
+    chunkedgraph request, remembering every answer.
+
+    Past IDs never change so they are remembered for good. Latest IDs are remembered with the time they
+    were resolved and are checked again once they are older than max_age, or after invalidate is called
+    with a later timestamp. Re-checking a remembered answer only asks whether the remembered latest ID is
+    still the latest, in one batched request. chunkedgraph has no batched call for the latest ID of a
+    superseded root ID, so those are looked up on a pool of worker threads.
+
+    Parameters
+    ----------
+    client :            caveclient.frameworkclient.CAVEclientFull
+                        CAVEclient to query information from. If not passed the shared client is used.
+    max_age :           float
+                        number of seconds a latest ID is trusted before it is checked again
+    path :              str
+                        optional filepath of an SQLite database in which answers are also kept between sessions
+    chunk_size :        int
+                        maximum number of root IDs sent in a single chunkedgraph request
+    workers :           int
+                        maximum number of superseded root IDs looked up at once
+
+    """
+    def __init__(self, client=None, max_age=3600, path=None, chunk_size=500, workers=8):
+        self.client = client
+        self.max_age = max_age
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self._latest = {}
+        self._past = {}
+        self._lock = threading.Lock()
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS latest (root_id INTEGER PRIMARY KEY, latest_id INTEGER, resolved_at REAL)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS past (root_id INTEGER PRIMARY KEY, past_ids TEXT)")
+            self._db.commit()
+            for root_id, latest_id, resolved_at in self._db.execute("SELECT * FROM latest"):
+                self._latest[root_id] = (latest_id, resolved_at)
+            for root_id, past_ids in self._db.execute("SELECT * FROM past"):
+                self._past[root_id] = json.loads(past_ids)
+
+    def latest_roots(self, root_ids, client=None, max_age=None):
+        """Return the latest ID of each root ID.
+
+        Parameters
+        ----------
+        root_ids :          array-like
+                            FANC root IDs, as ints or strings
+        client :            caveclient.frameworkclient.CAVEclientFull
+                            CAVEclient to use instead of the resolver's own
+        max_age :           float
+                            number of seconds a remembered latest ID is trusted for this call, instead of the
+                            resolver's max_age. 0 checks every remembered answer again.
+
+        Returns
+        -------
+        numpy array
+                            int64 array of the latest IDs, in the same order as root_ids
+
+        """
+        root_ids = id_arrays.as_ids(root_ids)
+        if max_age is None:
+            max_age = self.max_age
+        now = time.time()
+        answers = {}
+        to_check = {}
+        with self._lock:
+            for root_id in dict.fromkeys(root_ids.tolist()):
+                if root_id in self._latest:
+                    latest_id, resolved_at = self._latest[root_id]
+                    if now - resolved_at < max_age:
+                        answers[root_id] = latest_id
+                        continue
+                    to_check[root_id] = latest_id
+                else:
+                    to_check[root_id] = root_id
+        instrumentation.record("cache", "lineage.latest_roots", 0.0, hits=len(answers), misses=len(to_check))
+        if to_check:
+            client = self._client(client)
+            candidates = list(dict.fromkeys(to_check.values()))
+            still_latest = {}
+            for chunk in id_arrays.chunks(candidates, self.chunk_size):
+                with instrumentation.timed("cave.is_latest_roots") as timer:
+                    latest = client.chunkedgraph.is_latest_roots(chunk)
+                    timer.set(latest)
+                still_latest.update(zip(chunk, (bool(x) for x in latest)))
+            # only superseded IDs need to be followed, one request each
+            superseded = [x for x in candidates if not still_latest[x]]
+            newest = {x: x for x in candidates if still_latest[x]}
+            newest.update(zip(superseded, self._suggest_all(client, superseded)))
+            resolved = {root_id: newest[candidate] for root_id, candidate in to_check.items()}
+            answers.update(resolved)
+            self._remember_latest(resolved, now)
+        return np.array([answers[x] for x in root_ids.tolist()], dtype="int64")
+
+    def past_ids(self, root_ids, client=None):
+        """Return the IDs each root ID was made from by proofreading.
+
+        Parameters
+        ----------
+        root_ids :          array-like
+                            FANC root IDs, as ints or strings
+        client :            caveclient.frameworkclient.CAVEclientFull
+                            CAVEclient to use instead of the resolver's own
+
+        Returns
+        -------
+        dict
+                            dictionary of root_id:list of past IDs
+
+        """
+        root_ids = id_arrays.as_ids(root_ids).tolist()
+        with self._lock:
+            missing = [x for x in dict.fromkeys(root_ids) if x not in self._past]
+        instrumentation.record("cache", "lineage.past_ids", 0.0, hits=len(set(root_ids))-len(missing), misses=len(missing))
+        if missing:
+            client = self._client(client)
+            found = {}
+            for chunk in id_arrays.chunks(missing, self.chunk_size):
+                with instrumentation.timed("cave.get_past_ids", neurons=len(chunk)):
+                    past_id_map = client.chunkedgraph.get_past_ids(chunk)["past_id_map"]
+                found.update({int(x): [int(y) for y in past_id_map.get(x, past_id_map.get(str(x), []))] for x in chunk})
+            with self._lock:
+                self._past.update(found)
+                if self._db is not None:
+                    self._db.executemany("INSERT OR REPLACE INTO past VALUES (?,?)",
+                                         [(x, json.dumps(past)) for x, past in found.items()])
+                    self._db.commit()
+        with self._lock:
+            return {x: list(self._past[x]) for x in root_ids}
+
+    def invalidate(self, timestamp=None):
+        """Forget latest IDs resolved before timestamp (seconds since the epoch), or all of them if no
+        timestamp is passed, so that they are checked again on next use."""
+        with self._lock:
+            if timestamp is None:
+                self._latest.clear()
+            else:
+                self._latest = {x: entry for x, entry in self._latest.items() if entry[1] >= timestamp}
+            if self._db is not None:
+                self._db.execute("DELETE FROM latest WHERE resolved_at < ?", (timestamp if timestamp is not None else float("inf"),))
+                self._db.commit()
+
+    def _remember_latest(self, resolved, now):
+        with self._lock:
+            for root_id, latest_id in resolved.items():
+                self._latest[root_id] = (latest_id, now)
+                # the latest ID is its own latest ID
+                self._latest[latest_id] = (latest_id, now)
+            if self._db is not None:
+                rows = [(x, y, now) for x, y in resolved.items()]+[(y, y, now) for y in set(resolved.values())]
+                self._db.executemany("INSERT OR REPLACE INTO latest VALUES (?,?,?)", rows)
+                self._db.commit()
+
+    def _suggest_all(self, client, root_ids):
+        if self.workers <= 1 or len(root_ids) <= 1:
+            return [self._suggest(client, x) for x in root_ids]
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(root_ids))) as executor:
+            return list(executor.map(instrumentation.carry_context(lambda x: self._suggest(client, x)), root_ids))
+
+    def _suggest(self, client, root_id):
+        with instrumentation.timed("cave.suggest_latest_roots", neuron=root_id):
+            return int(client.chunkedgraph.suggest_latest_roots(root_id))
+
+    def _client(self, client):
+        return client or self.client or clients.cave()
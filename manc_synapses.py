@@ -1,46 +1,170 @@
-import neuprint
 import os
 import pandas as pd
-client = neuprint.Client('neuprint-pre.janelia.org', dataset='vnc')
+from concurrent.futures import ThreadPoolExecutor
+import cascade
+import clients
+import edge_store
+import id_arrays
+import instrumentation
+from rate_limit import TokenBucket, throttle
 
-def fetch_downstream_connections(neuron_id):
-    t1_ROIs = ["IntTct","LTct","LegNp(T1)(L)","LegNp(T1)(R)","NTct(UTct-T1)(L)","NTct(UTct-T1)(R)","mVAC(T1)(L)","mVAC(T1)(R)"]
-    t1_area = neuprint.queries.NeuronCriteria(rois=["LegNp(T1)(L)","LegNp(T1)(R)"], roi_req="any", client=client)
-    connections = neuprint.fetch_simple_connections([neuron_id], downstream_criteria=t1_area, rois=t1_ROIs, client=client)
+T1_ROIS = ["IntTct","LTct","LegNp(T1)(L)","LegNp(T1)(R)","NTct(UTct-T1)(L)","NTct(UTct-T1)(R)","mVAC(T1)(L)","mVAC(T1)(R)"]
+T1_LEG_ROIS = ["LegNp(T1)(L)","LegNp(T1)(R)"]
+# neurons that go into the abdomen or T3 are removed from the cascade
+ROIS_TO_AVOID = ["ANm","LegNp(T3)(L)","LegNp(T3)(R)","HTct(UTct-T3)(L)","HTct(UTct-T3)(R)"]
+# the downstream partners of many neurons with everything _percent_table needs, in one query. Partners must
+# be in a T1 leg neuropil and connect in a T1 ROI, as for fetch_downstream_connections
+LAYER_QUERY = """WITH {sources} AS sources
+MATCH (upstream:Neuron)-[e:ConnectsTo]->(downstream:Neuron)
+WHERE upstream.bodyId IN sources AND e.weight > 10
+  AND ({leg_rois})
+  AND any(roi IN {t1_rois} WHERE apoc.convert.fromJsonMap(e.roiInfo)[roi] IS NOT NULL)
+RETURN upstream.bodyId AS bodyId_pre, downstream.bodyId AS bodyId_post, e.weight AS weight,
+       downstream.post AS post, downstream.somaLocation IS NOT NULL AS soma,
+       ({avoid_rois}) AS excluded"""
+
+def _neuprint():
+    # the neuprint module and the shared client, both set up on first use
+    return clients.neuprint_api(), clients.neuprint_client()
+
+def fetch_downstream_connections(neuron_id, limiter=None, snapshot=None, input_table=None):
+    if snapshot is not None:
+        # the snapshot edges are expected to be the T1 ROI export, see connectome_snapshot
+        synapse_values = snapshot.downstream(neuron_id).rename("weight").to_frame()
+        synapse_values.index.name = "bodyId_post"
+        synapse_values = synapse_values.loc[synapse_values['weight'] > 10]
+        return synapse_values.loc[~snapshot.is_excluded(synapse_values.index)]
+    neuprint, client = _neuprint()
+    t1_area = neuprint.queries.NeuronCriteria(rois=T1_LEG_ROIS, roi_req="any", client=client)
+    throttle(limiter)
+    with instrumentation.timed("neuprint.fetch_simple_connections", neuron=int(neuron_id)) as timer:
+        connections = neuprint.fetch_simple_connections([neuron_id], downstream_criteria=t1_area, rois=T1_ROIS, client=client)
+        timer.set(connections)
     synapse_values = connections[["bodyId_post", "weight"]].copy()
     synapse_values = synapse_values.set_index("bodyId_post")
     synapse_values = synapse_values.loc[synapse_values['weight'] > 10]
+    if input_table is not None:
+        # fragments known to the input table are dropped before the exclusion query
+        synapse_values = synapse_values.loc[~input_table.fragments(synapse_values.index)]
+        if not len(synapse_values):
+            return synapse_values
     # find neurons that go into the abdomen and remove them
-    ROIs_to_avoid = ["ANm","LegNp(T3)(L)","LegNp(T3)(R)","HTct(UTct-T3)(L)","HTct(UTct-T3)(R)"]
-    criteria = neuprint.queries.NeuronCriteria(bodyId=synapse_values.index.to_list(), rois=ROIs_to_avoid, roi_req="any", client=client)
-    neurons_to_remove,_ = neuprint.fetch_neurons(criteria, client=client)
+    criteria = neuprint.queries.NeuronCriteria(bodyId=synapse_values.index.to_list(), rois=ROIS_TO_AVOID, roi_req="any", client=client)
+    throttle(limiter)
+    with instrumentation.timed("neuprint.fetch_neurons", neuron=int(neuron_id)) as timer:
+        neurons_to_remove,_ = neuprint.fetch_neurons(criteria, client=client)
+        timer.set(neurons_to_remove)
     neurons_to_remove = neurons_to_remove.bodyId.to_list()
     return synapse_values.loc[~synapse_values.index.isin(neurons_to_remove)]
 
-def get_percent_input(neuron_id):
-    conn_table = fetch_downstream_connections(neuron_id)
+def get_percent_input(neuron_id, limiter=None, snapshot=None, metadata=None, input_table=None, combined=False):
+    # combined=True asks for the partners, their inputs and their exclusion in a single query
+    if combined and snapshot is None:
+        return layer_percent_inputs([neuron_id], limiter, input_table=input_table)[neuron_id]
+    conn_table = fetch_downstream_connections(neuron_id, limiter, snapshot, input_table)
+    return _percent_table(conn_table, limiter, snapshot, metadata, input_table)
+
+def fetch_layer_connections(neuron_ids, limiter=None, chunk_size=200, workers=1):
+    # run LAYER_QUERY for chunks of neuron_ids, returning one row per connection with the columns
+    # bodyId_pre, bodyId_post, weight, post, soma and excluded. A layer of up to chunk_size neurons is
+    # a single request, and with more than one worker the chunks are queried at the same time
+    neuprint, client = _neuprint()
+    def fetch(chunk):
+        cypher = LAYER_QUERY.format(sources="["+",".join(str(int(x)) for x in chunk)+"]",
+                                    leg_rois=" OR ".join("downstream.`"+roi+"`" for roi in T1_LEG_ROIS),
+                                    t1_rois="["+",".join("'"+roi+"'" for roi in T1_ROIS)+"]",
+                                    avoid_rois=" OR ".join("coalesce(downstream.`"+roi+"`, false)" for roi in ROIS_TO_AVOID))
+        throttle(limiter)
+        with instrumentation.timed("neuprint.fetch_custom", neurons=len(chunk)) as timer:
+            connections = neuprint.fetch_custom(cypher, client=client)
+            timer.set(connections)
+        return connections
+    chunks = id_arrays.chunks(neuron_ids, chunk_size)
+    if workers <= 1 or len(chunks) <= 1:
+        frames = [fetch(chunk) for chunk in chunks]
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            frames = list(executor.map(instrumentation.carry_context(fetch), chunks))
+    columns = ["bodyId_pre", "bodyId_post", "weight", "post", "soma", "excluded"]
+    frames = [frame.reindex(columns=columns) for frame in frames]
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(frames, ignore_index=True)
+
+@instrumentation.instrumented()
+def layer_percent_inputs(neuron_ids, limiter=None, chunk_size=200, workers=1, input_table=None):
+    # the _percent_table of every neuron in a layer from fetch_layer_connections, so that a layer of up to
+    # chunk_size neurons costs one neuprint request instead of three per neuron. Returns a dictionary of
+    # neuron_id:table in the order of neuron_ids. Partners known to the input table take their inputs
+    # and soma from it, as in _percent_table
+    connections = fetch_layer_connections(neuron_ids, limiter, chunk_size, workers)
+    if input_table is not None:
+        known = input_table.known(connections["bodyId_post"])
+        known_IDs = connections["bodyId_post"][known]
+        connections.loc[known, "post"] = input_table.inputs(known_IDs).to_numpy()
+        connections.loc[known, "soma"] = input_table.has_soma(known_IDs)
+    # remove neurons that go into the abdomen, and fragments by filtering out neurons with no soma
+    connections = connections.loc[~connections["excluded"].astype(bool) & connections["soma"].astype(bool)]
+    groups = dict(list(connections.groupby("bodyId_pre", sort=False)))
+    tables = {}
+    for neuron_id in neuron_ids:
+        group = groups.get(int(neuron_id))
+        if group is None:
+            tables[neuron_id] = pd.DataFrame({"percent":[], "weight":[]})
+            continue
+        inputs = group.drop_duplicates("bodyId_post").set_index("bodyId_post")[["weight", "post"]]
+        inputs.index.name = "bodyId"
+        inputs["post"] = pd.to_numeric(inputs["post"])
+        inputs["percent"] = (inputs["weight"]/inputs["post"])*100
+        tables[neuron_id] = inputs.sort_values("percent",ascending=False)
+    return tables
+
+@instrumentation.instrumented()
+def _percent_table(conn_table, limiter=None, snapshot=None, metadata=None, input_table=None):
+    # add the total inputs of each downstream neuron and the percentage of them coming from the upstream neuron.
+    # Inputs are read from the input table if it has the neuron, and from the neuron metadata otherwise
     IDs = conn_table.index.to_list()
     if not len(IDs):
         return pd.DataFrame({"percent":[], "weight":[]})
-    neurons,_ = neuprint.fetch_neurons(IDs, client=client)
-    neurons = neurons.set_index("bodyId")
-    neurons = neurons.reindex(IDs)
-    # remove fragments by filtering out IDs with no soma location
-    dendrite_number = neurons[~neurons["somaLocation"].isnull()]
-    dendrite_number = dendrite_number["post"]
+    if snapshot is not None:
+        dendrite_number = snapshot.inputs(IDs).loc[snapshot.has_soma(IDs)].rename("post")
+        dendrite_number.index.name = "bodyId"
+    else:
+        dendrite_numbers = []
+        if input_table is not None:
+            known = input_table.known(IDs)
+            known_IDs = [x for x, k in zip(IDs, known) if k]
+            dendrite_numbers.append(input_table.inputs(known_IDs).loc[input_table.has_soma(known_IDs)].rename("post"))
+            IDs = [x for x, k in zip(IDs, known) if not k]
+        if IDs:
+            if metadata is None:
+                metadata = clients.metadata()
+            neurons = metadata.fetch(IDs, limiter)
+            # remove fragments by filtering out IDs with no soma location
+            dendrite_number = neurons[~neurons["somaLocation"].isnull()]
+            dendrite_numbers.append(pd.to_numeric(dendrite_number["post"]))
+        dendrite_number = pd.concat(dendrite_numbers)
+        dendrite_number.index.name = "bodyId"
     inputs = conn_table.merge(dendrite_number, left_index=True, right_index=True, how="right")
     inputs["percent"] = (inputs["weight"]/inputs["post"])*100
     return inputs.sort_values("percent",ascending=False)
 
-def fetch_upstream_connections(neuron_id):
-    connections = neuprint.fetch_simple_connections(None,[neuron_id], client=client)
+def fetch_upstream_connections(neuron_id, snapshot=None):
+    if snapshot is not None:
+        synapse_values = snapshot.upstream(neuron_id).rename("weight").to_frame()
+        synapse_values.index.name = "bodyId_pre"
+        return synapse_values
+    neuprint, client = _neuprint()
+    with instrumentation.timed("neuprint.fetch_simple_connections", neuron=int(neuron_id)) as timer:
+        connections = neuprint.fetch_simple_connections(None,[neuron_id], client=client)
+        timer.set(connections)
     synapse_values = connections[["bodyId_pre", "weight"]].copy()
     synapse_values = synapse_values.set_index("bodyId_pre")
     return synapse_values
 
-def downstream_of(neuron_id, threshold):
+def downstream_of(neuron_id, threshold, snapshot=None):
     #get downstream neurons and sort by synapse counts up to the Nth downstream synapse
-    values = fetch_downstream_connections(neuron_id)
+    values = fetch_downstream_connections(neuron_id, snapshot=snapshot)
     values = values.loc[values['weight'] >= threshold]
     indices = values.index.to_list()
     for index in indices:
@@ -49,12 +173,10 @@ def downstream_of(neuron_id, threshold):
     for synapse_value in synapse_values:
         print(synapse_value)
 
-def get_type(neuron_ids):
-    neurons, _ = neuprint.fetch_neurons(neuron_ids)
-    neurons = neurons[["bodyId", "type"]].copy()
-    neurons = neurons.set_index("bodyId")
-    neurons = neurons.reindex(neuron_ids)
-    return neurons
+def get_type(neuron_ids, metadata=None):
+    if metadata is None:
+        metadata = clients.metadata()
+    return metadata.fetch(neuron_ids)[["type"]]
 
 def print_type():
     IDs = []
@@ -67,48 +189,87 @@ def print_type():
     for t in types["type"].items():
         print(t[1])
 
-def cascade_csvs(start_neuron, threshold):
-    def make_csvs_in_list(neuron_list):
-        downstream_neurons = []
+def cascade_csvs(start_neuron, threshold, workers=1, requests_per_second=None, snapshot=None, output="csv",
+                 layers=3, batch_size=None, input_table=None, combined=False):
+    # workers sets how many neurons of a layer are queried at once, and requests_per_second
+    # caps the rate of neuprint requests across all workers. With a ConnectomeSnapshot
+    # no requests are made at all. output is "csv" for one .csv file per neuron, "store"
+    # for a single edge table (edge_store.EDGE_STORE in the folder) or "both".
+    # layers=None keeps going until no new neurons are found, and batch_size sets how many
+    # neurons are queried between checkpoints (see cascade.run_cascade). An input_table.InputTable
+    # gives the inputs and soma of partners it knows, so their metadata is never fetched.
+    # combined=True fetches each layer with layer_percent_inputs, one request per 200 neurons
+    limiter = TokenBucket(requests_per_second) if requests_per_second else None
+    def make_csvs_in_list(neuron_list, layer):
+        downstream_neurons = {}
+        layer_edges = []
+        if combined and snapshot is None:
+            tables = layer_percent_inputs(neuron_list, limiter, workers=workers, input_table=input_table)
+        else:
+            tables = percent_inputs(neuron_list, workers, limiter, snapshot, input_table=input_table)
         for neuron_id in neuron_list:
             print(neuron_id, end=" ")
-            if str(neuron_id)+"_downstreampartners.csv" in files:
-                print("file already exists")
-                pass
+            dataframe = _partner_table(tables[neuron_id], threshold)
+            if output in ("csv", "both") and dataframe.size:
+                dataframe.to_csv(folder+str(neuron_id)+"_downstreampartners.csv")
+            if output in ("store", "both") and dataframe.size:
+                layer_edges.append(edge_store.edges_from_table(dataframe, neuron_id, layer, "manc"))
+            downstream_neurons[neuron_id] = dataframe.index.to_list()
+            if len(dataframe):
+                print("created file")
             else:
-                downstream_new = make_csv(neuron_id, threshold, folder)
-                downstream_neurons = downstream_neurons+downstream_new
-                if len(downstream_new):
-                    print("created file")
-                else:
-                    print("no downstream partners")
+                print("no downstream partners")
+        if layer_edges:
+            edge_store.append_edges(store, pd.concat(layer_edges, ignore_index=True))
         return downstream_neurons
     # takes an initial starting neuron and finds its most significant downstream partners
     # then does the same for each of the downstream partners for n layers
     folder = str(start_neuron)+"-"+str(threshold)+"/"
     if not os.path.exists(folder):
         os.makedirs(folder)
-    files = os.listdir(folder)
+    store = folder+edge_store.EDGE_STORE
     print("downstream of",start_neuron)
-    first_layer = make_csvs_in_list([start_neuron])
-    print("second layer")
-    threshold=threshold
-    second_layer = make_csvs_in_list(first_layer)
-    print("third_layer")
-    threshold=threshold
-    third_layer = make_csvs_in_list(second_layer)
-    #print("fourth layer")
-    #make_csvs_in_list(third_layer)
-    
-def make_csv(neuron_id, threshold, folder=""):
-    dataframe = get_percent_input(neuron_id)
-    dataframe = dataframe.loc[dataframe['percent'] >= threshold]
-    #dataframe = dataframe.loc[dataframe['weight'] >= threshold]
-    dataframe = dataframe.sort_values("weight",ascending=False)
+    return cascade.run_cascade(start_neuron, folder, make_csvs_in_list, layers, batch_size)
+
+@instrumentation.instrumented()
+def percent_inputs(neuron_ids, workers=1, limiter=None, snapshot=None, metadata=None, input_table=None):
+    # find the downstream connections of each neuron on a pool of worker threads, then fetch the
+    # metadata of all their partners together, returning a dictionary of neuron_id:table in the
+    # order of neuron_ids
+    if workers <= 1 or snapshot is not None:
+        connections = [fetch_downstream_connections(neuron_id, limiter, snapshot, input_table) for neuron_id in neuron_ids]
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            fetch = instrumentation.carry_context(lambda neuron_id: fetch_downstream_connections(neuron_id, limiter,
+                                                                                                 input_table=input_table))
+            connections = list(executor.map(fetch, neuron_ids))
+    if snapshot is None:
+        if metadata is None:
+            metadata = clients.metadata()
+        partners = [x for table in connections for x in table.index]
+        if input_table is not None:
+            partners = [x for x, k in zip(partners, input_table.known(partners)) if not k]
+        if partners:
+            metadata.fetch(partners, limiter)
+    return {neuron_id: _percent_table(table, limiter, snapshot, metadata, input_table)
+            for neuron_id, table in zip(neuron_ids, connections)}
+
+def make_csv(neuron_id, threshold, folder="", snapshot=None, input_table=None):
+    dataframe = get_percent_input(neuron_id, snapshot=snapshot, input_table=input_table)
+    return save_csv(dataframe, neuron_id, threshold, folder)
+
+def save_csv(dataframe, neuron_id, threshold, folder=""):
+    dataframe = _partner_table(dataframe, threshold)
     if dataframe.size == 0:
         return []
     dataframe.to_csv(folder+str(neuron_id)+"_downstreampartners.csv")
     return dataframe.index.to_list()
 
+def _partner_table(dataframe, threshold):
+    dataframe = dataframe.loc[dataframe['percent'] >= threshold]
+    #dataframe = dataframe.loc[dataframe['weight'] >= threshold]
+    return dataframe.sort_values("weight",ascending=False)
+
 def synapses_between(upstream,downstream):
+    neuprint, client = _neuprint()
     return neuprint.fetch_simple_connections([upstream], [downstream], client=client)
\ No newline at end of file
@@ -0,0 +1,185 @@
+import os
+import time
+import numpy as np
+import pandas as pd
+import atomic_file
+import clients
+import id_arrays
+import instrumentation
+
+# local copy of the SeaTable matching table, written by refresh
+SNAPSHOT = os.path.join(clients.CACHE_FOLDER, "match_snapshot.parquet")
+ID_COLUMNS = ["queryID", "manualAssignment", "nBlastMatchID", "conMatchID"]
+
+class MatchIndex:
+    """A local copy of the FANC-MANC matching table indexed in both directions, so that a match is found
+    with a dictionary lookup instead of a query over the whole SeaTable.
+
+    MANC IDs are looked up by queryID, FANC IDs by manualAssignment, nBlastMatchID and conMatchID.
+    IDs are held as nullable Int64 columns, parsed exactly from the strings of the SeaTable, so the
+    dictionaries are keyed by int.
+
+    Parameters
+    ----------
+    table :             pandas DataFrame
+                        rows of the matching table with the columns queryID, manualAssignment, nBlastMatchID,
+                        conMatchID and check_L_R
+
+    """
+    def __init__(self, table):
+        table = table.reset_index(drop=True)
+        missing = pd.array([None]*len(table), dtype=id_arrays.OPTIONAL_ID_DTYPE)
+        self.table = pd.DataFrame({column: id_arrays.optional_ids(table[column]) if column in table else missing
+                                   for column in ID_COLUMNS})
+        self.table["check_L_R"] = [_first(x) for x in table["check_L_R"]] if "check_L_R" in table else None
+        # the first row of each queryID, keys assigned in reverse so that earlier rows overwrite later ones
+        query_ids, rows = _present(self.table["queryID"])
+        self.by_query = dict(zip(query_ids[::-1].tolist(), rows[::-1].tolist()))
+        self.by_manual = _positions(self.table["manualAssignment"])
+        self.by_nblast = _positions(self.table["nBlastMatchID"])
+        self.by_connectivity = _positions(self.table["conMatchID"])
+
+    @classmethod
+    def from_seatable(cls, seatable=None):
+        """Pull the whole matching table from SeaTable in one request. If seatable is not passed the
+        shared client is used."""
+        if not seatable:
+            seatable = clients.seatable()
+        with instrumentation.timed("seatable.query") as timer:
+            table = seatable.to_frame()
+            timer.set(table)
+        return cls(table)
+
+    @classmethod
+    def load(cls, path=SNAPSHOT):
+        """Load a matching table snapshot written by save."""
+        return cls(pd.read_parquet(path))
+
+    def save(self, path=SNAPSHOT):
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        with atomic_file.write(path, "wb") as file:
+            self.table.to_parquet(file, index=False)
+
+    def fanc_match(self, manc_id, resolver=None):
+        """Return the current FANC ID matched to a MANC neuron, following the rules of
+        fanc_synapses.mf_match: a manual assignment wins, otherwise the nBlast and connectivity matches
+        must agree. If they disagree a tuple of both is returned."""
+        row = self.table.iloc[self.by_query[int(manc_id)]]
+        row = row.astype(object).where(row.notna(), None)
+        if row.manualAssignment is not None:
+            return _latest([row.manualAssignment], resolver)[0]
+        if row.nBlastMatchID == row.conMatchID:
+            return _latest([row.nBlastMatchID], resolver)[0]
+        print("nblast and cosine similarity don't agree on a match for ", manc_id, _symmetry_string(row.check_L_R))
+        nblast_match, cosine_match = _latest([row.nBlastMatchID, row.conMatchID], resolver)
+        return ("nblast:", nblast_match, "connectivity:", cosine_match)
+
+    def manc_match(self, fanc_id, resolver=None, client=None):
+        """Return the MANC ID matched to a FANC neuron or any of its past IDs, following the rules of
+        fanc_synapses.fm_match: a single manual assignment wins, otherwise a single row whose nBlast and
+        connectivity matches agree. If there is no definite match a list of candidate MANC IDs is returned."""
+        if not resolver:
+            resolver = clients.lineage()
+        fanc_ids = resolver.past_ids([fanc_id], client=client)[int(fanc_id)]+[int(fanc_id)]
+        rows = _lookup(self.by_manual, fanc_ids)
+        if len(rows) == 1:
+            print("manually assigned")
+            return int(self.table.queryID.iat[rows[0]])
+        if len(rows) == 0:
+            rows = sorted(set(_lookup(self.by_nblast, fanc_ids)+_lookup(self.by_connectivity, fanc_ids)))
+        if len(rows) == 1 and self.table.nBlastMatchID.iat[rows[0]] == self.table.conMatchID.iat[rows[0]]:
+            return int(self.table.queryID.iat[rows[0]])
+        print("no definite match for", fanc_id, ", options returned as a list.")
+        return self.table.queryID.iloc[rows].dropna().to_numpy(dtype=id_arrays.ID_DTYPE).tolist()
+
+    def fanc_matches(self, manc_ids, resolver=None):
+        """Return an Int64 Series of the current FANC ID matched to each MANC neuron, indexed by int64 MANC
+        ID, missing where there is no match or the nBlast and connectivity matches disagree, with every
+        FANC ID brought up to date at once."""
+        manc_ids = id_arrays.as_ids(manc_ids)
+        rows = self.table.dropna(subset=["queryID"]).drop_duplicates("queryID")
+        rows = rows.set_index(rows["queryID"].to_numpy(dtype=id_arrays.ID_DTYPE)).reindex(manc_ids)
+        manual = rows.manualAssignment.notna()
+        agree = (rows.nBlastMatchID == rows.conMatchID).fillna(False)
+        disagree = ~manual & ~agree & (rows.nBlastMatchID.notna() | rows.conMatchID.notna())
+        for manc_id, flip in zip(rows.index[disagree], rows.check_L_R[disagree]):
+            print("nblast and cosine similarity don't agree on a match for ", manc_id, _symmetry_string(flip))
+        candidates = rows.manualAssignment.where(manual, rows.nBlastMatchID.where(agree)).array
+        return pd.Series(_latest_array(candidates, resolver), index=id_arrays.id_index(manc_ids))
+
+def refresh(path=SNAPSHOT, seatable=None):
+    """Pull the matching table from SeaTable again, save it to path and make it the shared match index.
+
+    Parameters
+    ----------
+    path :              str
+                        filepath of the snapshot
+    seatable :          seaserpent.base.Table
+                        Seaserpent table to query information from. If not passed the shared client is used.
+
+    Returns
+    -------
+    MatchIndex
+
+    """
+    index = MatchIndex.from_seatable(seatable)
+    index.save(path)
+    clients.override("match_index", index)
+    return index
+
+def shared_index(path=SNAPSHOT, max_age=24*3600):
+    """Return a match index loaded from the snapshot at path, pulling it from SeaTable first if the snapshot
+    is missing or older than max_age seconds."""
+    if os.path.exists(path) and time.time()-os.path.getmtime(path) < max_age:
+        return MatchIndex.load(path)
+    index = MatchIndex.from_seatable()
+    index.save(path)
+    return index
+
+def _latest(fanc_ids, resolver=None):
+    # current IDs of FANC IDs that may be None, resolved together
+    if not resolver:
+        resolver = clients.lineage()
+    latest = iter(resolver.latest_roots([x for x in fanc_ids if x is not None]).tolist())
+    return [None if x is None else next(latest) for x in fanc_ids]
+
+def _latest_array(fanc_ids, resolver=None):
+    # current IDs of an Int64 array of FANC IDs with missing entries, resolved together
+    if not resolver:
+        resolver = clients.lineage()
+    latest = fanc_ids.copy()
+    present = ~fanc_ids.isna()
+    if present.any():
+        latest[present] = resolver.latest_roots(fanc_ids[present].to_numpy(dtype=id_arrays.ID_DTYPE))
+    return latest
+
+def _first(value):
+    # check_L_R is a multiple select column, so SeaTable returns a list
+    if isinstance(value, str) or value is None:
+        return value
+    try:
+        return value[0] if len(value) else None
+    except TypeError:
+        return None
+
+def _symmetry_string(flip):
+    return ", also neuron may be left/right flipped" if flip == "Yes" else ""
+
+def _present(column):
+    # the IDs of an Int64 column that are not missing, with their row numbers
+    present = column.notna().to_numpy()
+    return column[present].to_numpy(dtype=id_arrays.ID_DTYPE), np.flatnonzero(present)
+
+def _positions(column):
+    positions = {}
+    for value, row in zip(*(x.tolist() for x in _present(column))):
+        positions.setdefault(value, []).append(row)
+    return positions
+
+def _lookup(positions, keys):
+    return sorted({row for key in keys for row in positions.get(key, [])})
+
+if __name__ == "__main__":
+    refresh()
@@ -1,12 +1,25 @@
-import networkx as nx
-from networkx.drawing.nx_agraph import graphviz_layout
-import matplotlib.pyplot as plt
+import hashlib
+import json
+import numpy as np
 import pandas as pd
 import os
-import netgraph
-import neuprint
+import atomic_file
+import clients
+import edge_store
+import id_arrays
+import instrumentation
+# networkx, graphviz, matplotlib and netgraph are only imported by the functions that draw,
+# so that importing this module stays fast
+
+# table of FANC IDs (match column) and their MANC matches (queryID column)
+MATCH_CSV = "MF_match_with_additions.csv"
+_match_lookups = {}
+# folder of saved graph layouts, shared by every working directory, see graph_layout
+LAYOUT_CACHE = os.path.join(clients.CACHE_FOLDER, "layout_cache")
+_layouts = {}
 
 def scatter(csv_name):
+    import matplotlib.pyplot as plt
     if isinstance(csv_name, str):
         df = pd.read_csv(csv_name)
     else:
@@ -27,29 +40,46 @@ def scatter(csv_name):
             plt.text(mi, fi, int(label), va='bottom', ha='center')
     plt.show()
 
-def get_manc_types(neuronlist):
-    client = neuprint.Client('neuprint-pre.janelia.org', dataset='vnc')
-    neurons, _ = neuprint.fetch_neurons(neuronlist, client=client)
-    neurons = neurons[["bodyId", "type", "somaSide", "rootSide", "predictedNt"]].copy()
-    neurons = neurons.set_index("bodyId")
-    types = {}
-    sides = {}
-    nts = {}
-    for ID in neuronlist:
-        side = neurons.loc[ID].somaSide or neurons.loc[ID].rootSide
-        types[ID] = str(neurons.loc[ID].type)
-        nts[ID] = str(neurons.loc[ID].predictedNt)
-        sides[ID] = str(side)
-    return types, sides, nts
+def render_scatter(table, path, xlabel="Percentage input in MANC", ylabel="Percentage input in FANC", figsize=(6,6)):
+    # draw the same plot as scatter into an image file without opening a window
+    from matplotlib.figure import Figure
+    manc_percent = table.percent_x.fillna(0).to_list()
+    fanc_percent = table.percent_y.fillna(0).to_list()
+    labels = table.fanc.to_list() if "fanc" in table else table.index.to_list()
+    fig = Figure(figsize=figsize)
+    ax = fig.add_subplot()
+    ax.scatter(manc_percent, fanc_percent)
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+    for (mi, fi, label) in zip(manc_percent, fanc_percent, labels):
+        if fi > 0 and mi > 0:
+            ax.text(mi, fi, int(label), va='bottom', ha='center', fontsize=6)
+    fig.savefig(path)
+    return path
+
+def get_manc_types(neuronlist, metadata=None):
+    # metadata is a neuron_metadata.NeuronMetadata, the shared one if not passed
+    if metadata is None:
+        metadata = clients.metadata()
+    return metadata.types(neuronlist)
+
+def match_lookup(path=MATCH_CSV):
+    # dictionary of fanc_id:manc_id from the match table, read once and read again only when the file changes
+    mtime = os.path.getmtime(path)
+    if path not in _match_lookups or _match_lookups[path][0] != mtime:
+        match_table = pd.read_csv(path, usecols=["match", "queryID"], dtype="string")
+        # cells that are not a single exact ID, such as lists of candidates, leave their row unmatched
+        match_table = pd.DataFrame({column: id_arrays.optional_ids(match_table[column], errors="coerce")
+                                    for column in match_table})
+        match_table = match_table.dropna().drop_duplicates("match")
+        _match_lookups[path] = (mtime, dict(zip(match_table["match"].to_numpy(dtype=id_arrays.ID_DTYPE).tolist(),
+                                                match_table["queryID"].to_numpy(dtype=id_arrays.ID_DTYPE).tolist())))
+    return _match_lookups[path][1]
 
 def get_fanc_types(neuronlist):
-    match_table = pd.read_csv("MF_match_with_additions.csv", dtype={'match': object})
-    manc_ids = {}
+    lookup = match_lookup()
     # make dictionary of fanc_id:manc_id
-    for fanc_id in neuronlist:
-        potential_manc_ids = match_table.loc[match_table["match"]==str(fanc_id)]["queryID"].to_list()
-        if len(potential_manc_ids):
-            manc_ids[fanc_id] = potential_manc_ids[0]
+    manc_ids = {fanc_id: lookup[fanc_id] for fanc_id in neuronlist if fanc_id in lookup}
     if not manc_ids:
         manc_types = {}
     else:
@@ -87,66 +117,107 @@ def get_fanc_types(neuronlist):
 #                 types[ID] = ""
 #     return types
 
-def prepare_graph_data(csv_name):
-    df = pd.read_csv(csv_name, index_col=0)
+@instrumentation.instrumented()
+def get_types(neuronlist):
+    # types, sides and neurotransmitters of a mix of FANC and MANC neurons, each dataset looked up in one go
+    neuronlist = list(neuronlist)
+    fanc = id_arrays.is_fanc(neuronlist) if neuronlist else np.zeros(0, dtype=bool)
+    fanc_neurons = [x for x, is_fanc in zip(neuronlist, fanc) if is_fanc]
+    manc_neurons = [x for x, is_fanc in zip(neuronlist, fanc) if not is_fanc]
+    types, sides, nts = {}, {}, {}
+    for dataset_neurons, get_dataset_types in [(fanc_neurons, get_fanc_types), (manc_neurons, get_manc_types)]:
+        if dataset_neurons:
+            dataset_types, dataset_sides, dataset_nts = get_dataset_types(dataset_neurons)
+            types, sides, nts = types|dataset_types, sides|dataset_sides, nts|dataset_nts
+    return types, sides, nts
+
+def read_graph_data(csv_name):
+    # neurons and weighted edges of one downstream partner .csv file
+    df = id_arrays.read_table(csv_name)
     startneuron = int(csv_name.removesuffix("_downstreampartners.csv").split("/")[-1])
     neurons = [startneuron]+df.index.to_list()
-    weighted_edges = []
-    if len(str(startneuron)) > 12:
-        types, sides, nts = get_fanc_types(neurons)
-    else:
-        types, sides, nts = get_manc_types(neurons)
-    for index, row in df.iterrows():
-        weighted_edges.append((startneuron, index, row["percent"]/3))
+    weighted_edges = [(startneuron, index, percent) for index, percent in zip(df.index.to_list(), (df["percent"]/3).to_list())]
+    return neurons, weighted_edges
+
+def prepare_graph_data(csv_name):
+    neurons, weighted_edges = read_graph_data(csv_name)
+    types, sides, nts = get_types(neurons)
+    return neurons, weighted_edges, types, sides, nts
+
+def prepare_store_data(edges):
+    # same as prepare_graph_data but for every neuron in an edge table at once
+    neurons = list(dict.fromkeys(edges["pre"].to_list()+edges["post"].to_list()))
+    weighted_edges = list(zip(edges["pre"].to_list(), edges["post"].to_list(), (edges["percent"]/3).to_list()))
+    types, sides, nts = get_types(neurons)
     return neurons, weighted_edges, types, sides, nts
 
-def contract_edges(edges, u, v):
-    # replace v with u
-    edges = [(u,y,w) if x==v else (x,u,w) if y==v else (x,y,w) for x,y,w in edges]
-    # find edges containing u
-    contracting_edges = [(x,y,w) for x,y,w in edges if x==u or y==u]
-    unaffected_edges = [(x,y,w) for x,y,w in edges if x!=u and y!=u]
-    weighted_edges = []
-    for n, edge in enumerate(contracting_edges):
-        x,y,w = edge
-        following_edges = [(a,b,w) for a,b,w in contracting_edges[n+1:] if x==a and y==b]
-        if following_edges:
-            following_edge=following_edges[0]
-            w = (w+following_edge[2])/2
-        weighted_edges.append((x,y,w))
-    dictionary = {(a,b):c for a,b,c in reversed(weighted_edges)}
-    contracted_edges = [(a,b,c) for ((a,b),c) in dictionary.items()]
-    return unaffected_edges+contracted_edges
-
-def show_graph(neuronIDs, edges, types, sides, nts):
+def add_adjacency_edges(neuronIDs, edges, matrix, ids, inputs):
+    # add the connections of an adjacency matrix (see adjacency.py) between neurons of the graph that are not
+    # already edges, such as recurrent and lateral connections. Their weights are scaled like the cascade
+    # edges, as percentage input/3, so connections onto neurons whose total inputs are not in inputs are skipped
+    import adjacency
+    extra = adjacency.adjacency_edges(matrix, ids)
+    extra = extra.loc[extra["pre"].isin(neuronIDs) & extra["post"].isin(neuronIDs) & extra["post"].isin(list(inputs))]
+    existing = set((pre, post) for pre, post, _ in edges)
+    inputs = extra["post"].map(inputs)
+    return edges+[(pre, post, weight/total*100/3)
+                  for pre, post, weight, total in zip(extra["pre"].to_list(), extra["post"].to_list(),
+                                                      extra["weight"].to_list(), inputs.to_list())
+                  if (pre, post) not in existing and total > 0]
+
+def contract_by_type(neuronIDs, edges, types, types_to_collapse, how="mean"):
+    # merge every neuron of each type in types_to_collapse into one node, the first neuron of that type,
+    # in a single pass. Parallel edges created by the merge are combined with how ("mean", "sum" or "max").
+    # Returns the contracted DiGraph and a dictionary of node:number of neurons merged into it
+    import networkx as nx
+    collapse = set(types_to_collapse)
+    representatives = {}
+    merged_into = {}
+    for ID in neuronIDs:
+        typ = types.get(ID)
+        if typ in collapse:
+            merged_into[ID] = representatives.setdefault(typ, ID)
+        else:
+            merged_into[ID] = ID
+    table = pd.DataFrame(edges, columns=["pre", "post", "weight"])
+    for ID in pd.concat([table["pre"], table["post"]]).unique():
+        merged_into.setdefault(ID, ID)
+    table["pre"] = table["pre"].map(merged_into)
+    table["post"] = table["post"].map(merged_into)
+    table = table.groupby(["pre", "post"], sort=False)["weight"].agg(how).reset_index()
+
     G = nx.DiGraph()
+    G.add_nodes_from(dict.fromkeys(merged_into.values()))
+    G.add_weighted_edges_from(table.itertuples(index=False, name=None))
+    sizes = pd.Series(list(merged_into.values())).value_counts().to_dict()
+    return G, sizes
+
+@instrumentation.instrumented()
+def display_graph(neuronIDs, edges, types, sides, nts, how="mean"):
+    # contract the graph by type and work out its labels and colours.
+    # Returns the DiGraph, node labels, node colours and edge colours
+    import networkx as nx
+    types = dict(types)
     labels = {}
     for ID in neuronIDs:
-        node = G.add_node(ID)
         #labels[ID] = str(ID)+"\n"+str(types[ID])+" "+str(sides[ID])#this is for uncontracted graphs
         labels[ID] = str(types[ID])+" "+str(sides[ID])# for contracted graphs
     ##contract node groups###
     types_to_collapse = []#["IN00A021"]
     all_types = list(set([typ for typ in types.values()]))
-    all_types.remove("No type")
+    if "No type" in all_types:
+        all_types.remove("No type")
     types_to_collapse = all_types
-    for typ in types_to_collapse:
-        ids_to_join = [x for x,y in types.items() if y==typ]
-        for id in ids_to_join[1:]:
-            u = ids_to_join[0]
-            v = id
-            edges = contract_edges(edges,u,v)
-            G.remove_node(v)
-            del types[v]
-            del labels[v]
-            labels[u] = types[u]+"("+str(len(ids_to_join))+")"
+    G, sizes = contract_by_type(neuronIDs, edges, types, types_to_collapse, how)
+    for ID in neuronIDs:
+        if ID not in G:
+            del types[ID]
+            del labels[ID]
+        elif sizes[ID] > 1:
+            labels[ID] = types[ID]+"("+str(sizes[ID])+")"
     #####
-    G.add_weighted_edges_from(edges)
     G.remove_edges_from(list(nx.selfloop_edges(G)))
 
-    widths = nx.get_edge_attributes(G, 'weight')
-    nodelist = G.nodes()
-
     # node colours
     colors= {}
     for node in G:
@@ -171,15 +242,6 @@ def show_graph(neuronIDs, edges, types, sides, nts):
         del colors[node],
     ######
 
-    # plot potition of nodes
-    layout_type = "dot"# hierarchical layout
-    #layout_type = "fdp"# spring layout
-    pos=graphviz_layout(G, prog=layout_type)
-    # remap positions to values between 0,1
-    max_x = max(pos.values())[0]
-    max_y = max([y for _,y in pos.values()])
-    interactive_pos = {key: (2*x/max_x,y/max_y) for key,(x,y) in zip(pos.keys(),pos.values())}
-
     # colour edges according to neurotransmitter
     edge_nts = {(x,y):nts[x] for x,y in G.edges}
     nt_colours = {
@@ -189,7 +251,105 @@ def show_graph(neuronIDs, edges, types, sides, nts):
         "unknown":"black",
         "No record":"orange"
     }
-    edge_colours = {key:nt_colours[value] for key,value in edge_nts.items()}
+    edge_colours = {key:nt_colours.get(value, "black") for key,value in edge_nts.items()}
+    return G, labels, colors, edge_colours
+
+def graph_layout(G, prog="dot", max_dot_nodes=2000, cache_folder=LAYOUT_CACHE):
+    # node positions scaled to 0-2 across and 0-1 up. Layouts are kept in memory and in cache_folder
+    # under a hash of the graph's nodes and edges, so drawing the same graph again skips the layout.
+    # Graphs with more than max_dot_nodes nodes, or any graph if graphviz is not installed, get the
+    # faster layered_layout instead of dot
+    if prog == "dot" and len(G) > max_dot_nodes:
+        prog = "layered"
+    key = graph_hash(G, prog)
+    path = os.path.join(cache_folder, key+".json") if cache_folder else None
+    instrumentation.record("cache", "neuron_graph.graph_layout", 0.0,
+                           hit=key in _layouts or bool(path and os.path.exists(path)))
+    if key in _layouts:
+        return _layouts[key]
+    if path and os.path.exists(path):
+        with open(path) as file:
+            saved = json.load(file)
+        pos = {node: tuple(xy) for node, xy in zip(saved["nodes"], saved["pos"])}
+    else:
+        pos = None
+        if prog != "layered":
+            try:
+                from networkx.drawing.nx_agraph import graphviz_layout
+                with instrumentation.timed("graphviz."+prog, kind="local", nodes=len(G)):
+                    pos = graphviz_layout(G, prog=prog)
+            except ImportError:
+                print("graphviz is not available, using the layered layout")
+        if pos is None:
+            pos = layered_layout(G)
+        pos = _scale_layout(pos)
+        if path:
+            # the folder is shared, so another process may create it first
+            os.makedirs(cache_folder, exist_ok=True)
+            with atomic_file.write(path) as file:
+                json.dump({"nodes": [_json_node(node) for node in pos], "pos": list(pos.values())}, file)
+    _layouts[key] = pos
+    return pos
+
+def graph_hash(G, prog=""):
+    # hash of the structure of a graph, independent of the order nodes and edges were added in
+    digest = hashlib.sha1(prog.encode())
+    digest.update(repr(sorted(map(str, G.nodes))).encode())
+    digest.update(repr(sorted((str(x), str(y)) for x, y in G.edges)).encode())
+    return digest.hexdigest()
+
+@instrumentation.instrumented()
+def layered_layout(G):
+    # hierarchical layout like dot but in a single pass: each node is placed in the layer of its shortest
+    # path from a source node, top to bottom, and ordered within its layer by the mean position of its
+    # upstream nodes to keep edges short
+    import networkx as nx
+    sources = [node for node, degree in G.in_degree() if degree == 0] or list(G.nodes)[:1]
+    depth = {}
+    for source in sources:
+        for node, length in nx.single_source_shortest_path_length(G, source).items():
+            depth[node] = min(depth.get(node, length), length)
+    deepest = max(depth.values(), default=-1)
+    for node in G:
+        depth.setdefault(node, deepest+1)
+    layers = {}
+    for node, layer in depth.items():
+        layers.setdefault(layer, []).append(node)
+    x = {}
+    pos = {}
+    for layer in sorted(layers):
+        nodes = layers[layer]
+        order = {}
+        for node in nodes:
+            upstream = [x[up] for up in G.predecessors(node) if up in x]
+            order[node] = sum(upstream)/len(upstream) if upstream else 0
+        for i, node in enumerate(sorted(nodes, key=lambda node: order[node])):
+            x[node] = i-(len(nodes)-1)/2
+            pos[node] = (x[node], -layer)
+    return pos
+
+def _scale_layout(pos):
+    # remap positions to values between 0,1 (0,2 across)
+    xs = [x for x,_ in pos.values()]
+    ys = [y for _,y in pos.values()]
+    min_x, min_y = min(xs, default=0), min(ys, default=0)
+    width = (max(xs, default=0)-min_x) or 1
+    height = (max(ys, default=0)-min_y) or 1
+    return {key: (2*(x-min_x)/width, (y-min_y)/height) for key,(x,y) in pos.items()}
+
+def _json_node(node):
+    return int(node) if isinstance(node, (int, np.integer)) else str(node)
+
+def show_graph(neuronIDs, edges, types, sides, nts, how="mean", layout="dot"):
+    import networkx as nx
+    import matplotlib.pyplot as plt
+    import netgraph
+    G, labels, colors, edge_colours = display_graph(neuronIDs, edges, types, sides, nts, how)
+
+    # plot potition of nodes
+    # layout is "dot" for a hierarchical layout, "fdp" for a spring layout or "layered" for the
+    # built-in hierarchical layout
+    interactive_pos = graph_layout(G, layout)
 
     plt.figure(figsize=(6,6))
     plot_instance = netgraph.InteractiveGraph(
@@ -210,20 +370,85 @@ def show_graph(neuronIDs, edges, types, sides, nts):
     # To access the new node positions:
     node_positions = plot_instance.node_positions
     plt.show()
-    
-def operator_function(folder):
-    # take all downstream partner .csv files in folder and plot them as a graph
-    csvs = [x for x in os.listdir(folder) if x.endswith("_downstreampartners.csv")]
-    neurons = []
-    edges = []
-    types = {}
-    sides = {}
-    nts = {}
+
+def render_graph(neuronIDs, edges, types, sides, nts, path, how="mean", layout="dot", figsize=(6,6)):
+    # draw the same graph as show_graph into an image file without opening a window.
+    # The file type (.svg, .png, .pdf) is taken from the extension of path
+    import networkx as nx
+    from matplotlib.figure import Figure
+    import netgraph
+    G, labels, colors, edge_colours = display_graph(neuronIDs, edges, types, sides, nts, how)
+    fig = Figure(figsize=figsize)
+    ax = fig.add_subplot()
+    netgraph.Graph(
+        G,
+        prettify=False,
+        scale=(1,1),
+        arrows=True,
+        node_size=0.6,
+        node_layout=graph_layout(G, layout),
+        node_labels=labels,
+        node_color=colors,
+        node_edge_color=colors,
+        node_label_offset=(0,.008),
+        node_label_fontdict={"size":6},
+        edge_width=nx.get_edge_attributes(G, "weight"),
+        edge_color=edge_colours,
+        ax=ax,
+    )
+    fig.savefig(path)
+    return path
+
+@instrumentation.instrumented()
+def folder_graph_data(folder, adjacency=None):
+    # neurons, edges, types, sides and neurotransmitters of a cascade folder.
+    # If the folder has an edge table it is read instead of the .csv files.
+    # adjacency is an optional (matrix, ids) pair from adjacency.py whose connections among
+    # the neurons of the folder are added as extra edges, with no further queries
+    store = os.path.join(folder, edge_store.EDGE_STORE)
+    if os.path.exists(store):
+        store_edges = edge_store.read_edges(store)
+        neurons, edges, types, sides, nts = prepare_store_data(store_edges)
+        inputs = dict(zip(store_edges["post"].to_list(), store_edges["inputs"].to_list()))
+    else:
+        csvs = [x for x in os.listdir(folder) if x.endswith("_downstreampartners.csv")]
+        neurons = []
+        edges = []
+        for csv in csvs:
+            csv_neurons, csv_edges = read_graph_data(folder+"/"+csv)
+            neurons = neurons+csv_neurons
+            edges = edges+csv_edges
+        # look up the types of every neuron in the folder together
+        neurons = list(dict.fromkeys(neurons))
+        types, sides, nts = get_types(neurons)
+        inputs = _csv_inputs(folder, csvs) if adjacency is not None else {}
+    if adjacency is not None:
+        edges = add_adjacency_edges(neurons, edges, *adjacency, inputs)
+    return neurons, edges, types, sides, nts
+
+def _csv_inputs(folder, csvs):
+    # total inputs of every downstream neuron in the .csv files of a folder
+    inputs = {}
     for csv in csvs:
-        csv_neurons, csv_edges, csv_types, csv_sides, csv_nts = prepare_graph_data(folder+"/"+csv)
-        neurons=list(set(neurons+csv_neurons))
-        edges=edges+csv_edges
-        types=types|csv_types
-        sides=sides|csv_sides
-        nts=nts|csv_nts
-    show_graph(neurons, edges, types, sides, nts)
+        df = id_arrays.read_table(folder+"/"+csv)
+        column = "inputs" if "inputs" in df else "post"
+        inputs.update(zip(df.index.to_list(), df[column].to_list()))
+    return inputs
+
+def operator_function(folder, adjacency=None):
+    # take all downstream partner .csv files in folder and plot them as a graph.
+    # If the folder has an edge table it is read instead of the .csv files
+    show_graph(*folder_graph_data(folder, adjacency))
+
+def render_folders(folders, output_folder="", file_format="svg", layout="dot", processes=None):
+    # render the graph of each cascade folder to <output_folder>/<folder name>.<file_format>
+    # on a pool of processes, without opening any windows. Returns the filepaths written
+    from concurrent.futures import ProcessPoolExecutor
+    paths = [os.path.join(output_folder, os.path.basename(os.path.normpath(folder))+"."+file_format) for folder in folders]
+    if output_folder and not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        return list(executor.map(_render_folder, folders, paths, [layout]*len(folders)))
+
+def _render_folder(folder, path, layout):
+    return render_graph(*folder_graph_data(folder), path, layout=layout)
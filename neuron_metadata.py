@@ -0,0 +1,146 @@
+import json
+import os
+import sqlite3
+import threading
+import numpy as np
+import pandas as pd
+import clients
+import id_arrays
+import instrumentation
+from rate_limit import throttle
+
+# metadata database shared by every working directory
+METADATA_CACHE = os.path.join(clients.CACHE_FOLDER, "neuron_metadata.sqlite")
+# the neuprint columns kept for each neuron
+COLUMNS = ["type", "somaSide", "rootSide", "predictedNt", "somaLocation", "post"]
+
+class NeuronMetadata:
+    """MANC neuron metadata fetched from neuprint in as few requests as possible and kept on disk, so that
+    each neuron is fetched at most once per dataset release.
+
+    Metadata is stored in SQLite under the dataset version it was fetched at. When neuprint moves to a new
+    release the version changes and every neuron is fetched again on next use.
+
+    Parameters
+    ----------
+    path :              str
+                        filepath of the SQLite database, created if it does not exist. By default it is in
+                        clients.CACHE_FOLDER. If None the metadata is only kept in memory.
+    version :           str
+                        dataset version to store metadata under. If not passed it is read from neuprint on
+                        first use.
+    chunk_size :        int
+                        maximum number of neuron IDs sent in a single fetch_neurons request
+
+    """
+    def __init__(self, path=METADATA_CACHE, version=None, chunk_size=10000):
+        self.path = path
+        self.chunk_size = chunk_size
+        self._version = version
+        self._known = pd.DataFrame(columns=COLUMNS, index=pd.Index([], dtype="int64", name="bodyId"))
+        self._lock = threading.Lock()
+        self._db = None
+        if path:
+            directory = os.path.dirname(path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("""CREATE TABLE IF NOT EXISTS neurons (
+                version TEXT, bodyId INTEGER, type TEXT, somaSide TEXT, rootSide TEXT, predictedNt TEXT,
+                somaLocation TEXT, post INTEGER, PRIMARY KEY (version, bodyId))""")
+            self._db.commit()
+
+    @property
+    def version(self):
+        """The dataset version, as reported by neuprint for the shared client's dataset."""
+        if self._version is None:
+            client = clients.neuprint_client()
+            info = client.fetch_datasets().get(client.dataset, {})
+            self._version = str(client.dataset)+":"+str(info.get("uuid") or info.get("last-mod") or "")
+        return self._version
+
+    def fetch(self, neuron_ids, limiter=None):
+        """Return the metadata of each neuron, fetching only neurons that have not been seen at this
+        dataset version.
+
+        Parameters
+        ----------
+        neuron_ids :        list of int
+                            MANC body IDs
+        limiter :           rate_limit.TokenBucket
+                            optional limiter acquired before each neuprint request
+
+        Returns
+        -------
+        pandas DataFrame
+                            DataFrame indexed by bodyId in the order of neuron_ids with the columns in COLUMNS.
+                            Neurons neuprint does not know have every column empty.
+
+        """
+        neuron_ids = id_arrays.as_ids(neuron_ids)
+        unique = pd.unique(neuron_ids)
+        with self._lock:
+            missing = unique[~np.isin(unique, self._known.index.to_numpy())].tolist()
+            if missing and self._db is not None:
+                self._add(self._read_cache(missing))
+                missing = [x for x in missing if x not in self._known.index]
+        instrumentation.record("cache", "neuron_metadata.fetch", 0.0, hits=len(unique)-len(missing),
+                               misses=len(missing))
+        if missing:
+            fetched = self._fetch_neuprint(missing, limiter)
+            with self._lock:
+                self._add(fetched)
+                self._write_cache(fetched)
+        with self._lock:
+            return self._known.reindex(neuron_ids)
+
+    def types(self, neuron_ids, limiter=None):
+        """Return dictionaries of neuron_id:type, neuron_id:side and neuron_id:predicted neurotransmitter,
+        where the side is the soma side or, for neurons without one, the root side."""
+        neurons = self.fetch(neuron_ids, limiter)
+        sides = neurons["somaSide"].where(neurons["somaSide"].notna() & (neurons["somaSide"] != ""), neurons["rootSide"])
+        body_ids = neurons.index.to_list()
+        return (dict(zip(body_ids, neurons["type"].astype(str))), dict(zip(body_ids, sides.astype(str))),
+                dict(zip(body_ids, neurons["predictedNt"].astype(str))))
+
+    def _fetch_neuprint(self, neuron_ids, limiter):
+        neuprint, client = clients.neuprint_api(), clients.neuprint_client()
+        frames = []
+        for i in range(0, len(neuron_ids), self.chunk_size):
+            throttle(limiter)
+            with instrumentation.timed("neuprint.fetch_neurons", neurons=len(neuron_ids[i:i+self.chunk_size])) as timer:
+                neurons, _ = neuprint.fetch_neurons(neuron_ids[i:i+self.chunk_size], client=client)
+                timer.set(neurons)
+            frames.append(neurons.reindex(columns=["bodyId"]+COLUMNS))
+        neurons = pd.concat(frames).drop_duplicates("bodyId").set_index("bodyId")
+        # neurons neuprint does not return are kept as empty rows so they are not asked for again
+        neurons = neurons.reindex(pd.Index(neuron_ids, dtype="int64", name="bodyId"))
+        neurons["post"] = neurons["post"].astype("Int64")
+        return neurons.astype(object).where(neurons.notna(), None)
+
+    def _add(self, neurons):
+        # called with the lock held; threads that fetched the same neurons at once add each of them only once
+        neurons = neurons.loc[~neurons.index.duplicated() & ~neurons.index.isin(self._known.index), COLUMNS]
+        if len(neurons):
+            self._known = pd.concat([self._known, neurons]) if len(self._known) else neurons
+
+    def _read_cache(self, neuron_ids):
+        rows = []
+        for i in range(0, len(neuron_ids), 500):
+            chunk = neuron_ids[i:i+500]
+            rows += self._db.execute("SELECT bodyId, "+", ".join(COLUMNS)+" FROM neurons WHERE version=? AND bodyId IN ("
+                                     +",".join("?"*len(chunk))+")", [self.version]+chunk).fetchall()
+        neurons = pd.DataFrame(rows, columns=["bodyId"]+COLUMNS, dtype=object).set_index("bodyId")
+        neurons.index = neurons.index.astype("int64")
+        neurons["somaLocation"] = [None if x is None else json.loads(x) for x in neurons["somaLocation"]]
+        return neurons
+
+    def _write_cache(self, neurons):
+        if self._db is None:
+            return
+        rows = [(self.version, int(body_id), row.type, row.somaSide, row.rootSide, row.predictedNt,
+                 None if row.somaLocation is None else json.dumps([float(x) for x in row.somaLocation]),
+                 None if row.post is None else int(row.post))
+                for body_id, row in zip(neurons.index, neurons.itertuples(index=False))]
+        self._db.executemany("INSERT OR REPLACE INTO neurons VALUES (?,?,?,?,?,?,?,?)", rows)
+        self._db.commit()
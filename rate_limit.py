@@ -0,0 +1,39 @@
+import threading
+import time
+
+class TokenBucket:
+    """Token-bucket rate limiter that can be shared between threads. Each request takes one token,
+    tokens refill at a steady rate and up to capacity tokens can be saved up for a burst.
+
+    Parameters
+    ----------
+    rate :              float
+                        number of tokens added per second
+    capacity :          int
+                        maximum number of tokens held at once. Defaults to one second's worth of tokens.
+
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(rate, 1))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """Block until the tokens are available, then take them."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated)*self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens)/self.rate
+            time.sleep(wait)
+
+def throttle(limiter):
+    # wait for the limiter if one is being used
+    if limiter is not None:
+        limiter.acquire()
@@ -0,0 +1,267 @@
+import hashlib
+import os
+import numpy as np
+import pandas as pd
+import atomic_file
+import clients
+import id_arrays
+import instrumentation
+
+POSITION_COLUMNS = ["pre_pt_position_x", "pre_pt_position_y", "pre_pt_position_z"]
+# folder that indexes built by SynapseIndex.from_neurons are saved in
+INDEX_CACHE = os.path.join(clients.CACHE_FOLDER, "spatial_index_cache")
+# rays for mesh containment are cast in a direction that is not parallel to any axis, so they rarely
+# pass exactly through mesh edges or vertices
+_RAY = np.array([1.0, 0.0001234, 0.0000567])/np.linalg.norm([1.0, 0.0001234, 0.0000567])
+
+class SynapseIndex:
+    """A voxel grid over synapse positions, answering box, y slab and mesh containment queries for every
+    synapse at once. Synapses in voxels wholly inside or outside a region are decided per voxel, so only
+    synapses near a region's boundary are tested one by one.
+
+    The synapses are held in voxel order in table, and every query returns a boolean array aligned with
+    it. Mesh containment results are kept with the index, and saved with it, so repeated region breakdowns
+    of the same neurons are not recomputed.
+
+    Parameters
+    ----------
+    synapses :          pandas DataFrame
+                        DataFrame with pre_pt_position_x, pre_pt_position_y and pre_pt_position_z columns, as
+                        returned by fanc_synapses.fetch_downstream_synapses_batch or fetch_upstream_synapses.
+                        Other columns, such as the neuron and partner IDs, are kept.
+    voxel_size :        tuple
+                        (x, y, z) size of a voxel, in the units of the positions
+
+    """
+    def __init__(self, synapses, voxel_size=(4000, 4000, 400)):
+        self.voxel_size = np.asarray(voxel_size, dtype="float64")
+        positions = synapses[POSITION_COLUMNS].to_numpy(dtype="float64")
+        cells = np.floor(positions/self.voxel_size).astype("int64")
+        order = np.lexsort((cells[:,2], cells[:,1], cells[:,0]))
+        self.table = synapses.iloc[order].reset_index(drop=True)
+        self.positions = positions[order]
+        # the occupied voxels, and the first synapse and number of synapses in each
+        self.voxels, self.starts, self.counts = np.unique(cells[order], axis=0, return_index=True, return_counts=True) \
+            if len(order) else (np.zeros((0, 3), dtype="int64"), np.zeros(0, dtype="int64"), np.zeros(0, dtype="int64"))
+        self.path = None
+        self._meshes = {}
+
+    @classmethod
+    def from_neurons(cls, neuron_ids, direction="pre", client=None, chunk_size=50, cache=None,
+                     cache_folder=INDEX_CACHE, voxel_size=(4000, 4000, 400)):
+        """Build the index over the downstream ("pre") or upstream ("post") synapses of FANC neurons, or
+        load it from cache_folder if it was built for the same neurons at the same materialization version.
+        Indexes are saved in cache_folder unless it is None. client and cache are as for
+        fanc_synapses.fetch_downstream_synapses_batch."""
+        import fanc_synapses
+        if not client:
+            client = clients.cave()
+        neuron_ids = np.sort(id_arrays.as_ids(neuron_ids)).tolist()
+        path = None
+        if cache_folder:
+            key = hashlib.sha1(repr([neuron_ids, direction, client.materialize.version,
+                                     [float(x) for x in voxel_size]]).encode()).hexdigest()
+            path = os.path.join(cache_folder, key+".npz")
+            if os.path.exists(path):
+                instrumentation.record("cache", "spatial_index.load", 0.0, hit=True)
+                return cls.load(path)
+            instrumentation.record("cache", "spatial_index.load", 0.0, hit=False)
+        synapses = fanc_synapses._query_synapses(neuron_ids, direction, client, cache, chunk_size)
+        index = cls(synapses, voxel_size)
+        if path:
+            # the folder is shared, so another process may create it first
+            os.makedirs(cache_folder, exist_ok=True)
+            index.save(path)
+        return index
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            table = pd.DataFrame({column[6:]: data[column] for column in data.files if column.startswith("table:")})
+            index = cls.__new__(cls)
+            index.voxel_size = data["voxel_size"]
+            index.table = table
+            index.positions = table[POSITION_COLUMNS].to_numpy(dtype="float64")
+            index.voxels, index.starts, index.counts = data["voxels"], data["starts"], data["counts"]
+            index._meshes = {column[5:]: data[column] for column in data.files if column.startswith("mesh:")}
+        index.path = path
+        return index
+
+    def save(self, path):
+        arrays = {"table:"+column: self.table[column].to_numpy() for column in self.table}
+        arrays.update({"mesh:"+key: inside for key, inside in self._meshes.items()})
+        with atomic_file.write(path, "wb") as file:
+            np.savez_compressed(file, voxel_size=self.voxel_size, voxels=self.voxels, starts=self.starts,
+                                counts=self.counts, **arrays)
+        self.path = path
+
+    def __len__(self):
+        return len(self.table)
+
+    def box(self, lower, upper):
+        """Return a boolean array, True for synapses inside the axis-aligned box from lower to upper
+        (both (x, y, z)), boundaries included."""
+        lower = np.asarray(lower, dtype="float64")
+        upper = np.asarray(upper, dtype="float64")
+        voxel_lower = self.voxels*self.voxel_size
+        voxel_upper = voxel_lower+self.voxel_size
+        inside = ((voxel_lower >= lower) & (voxel_upper <= upper)).all(axis=1)
+        touching = ((voxel_upper >= lower) & (voxel_lower <= upper)).all(axis=1) & ~inside
+        return self._resolve(inside, touching,
+                             lambda points: ((points >= lower) & (points <= upper)).all(axis=1))
+
+    def slabs(self, y_slabs):
+        """Return a boolean array, True for synapses in any of a list of (anterior, posterior) y ranges."""
+        mask = np.zeros(len(self), dtype=bool)
+        for anterior, posterior in y_slabs:
+            mask |= self.box((-np.inf, anterior, -np.inf), (np.inf, posterior, np.inf))
+        return mask
+
+    def mesh(self, mesh):
+        """Return a boolean array, True for synapses inside a closed triangle mesh such as a neuromere.
+        mesh is a (vertices, faces) pair or an object with vertices and faces attributes, see load_mesh.
+        The result is kept, and saved with the index if it was loaded from or saved to a file."""
+        vertices, faces = _mesh_arrays(mesh)
+        key = hashlib.sha1(vertices.tobytes()+faces.tobytes()).hexdigest()
+        if key in self._meshes:
+            instrumentation.record("cache", "spatial_index.mesh", 0.0, hit=True)
+            return self._meshes[key].copy()
+        instrumentation.record("cache", "spatial_index.mesh", 0.0, hit=False)
+        triangles = vertices[faces]
+        # voxels no triangle passes near are wholly inside or outside, decided by their centre
+        near = np.isin(_linear(self.voxels), _linear(_covered_voxels(triangles, self.voxel_size)))
+        centres = (self.voxels+0.5)*self.voxel_size
+        inside = np.zeros(len(self.voxels), dtype=bool)
+        inside[~near] = _in_triangles(centres[~near], triangles)
+        result = self._resolve(inside, near, lambda points: _in_triangles(points, triangles))
+        self._meshes[key] = result
+        if self.path:
+            self.save(self.path)
+        return result.copy()
+
+    def mask(self, box=None, y_slabs=None, mesh=None):
+        """Return a boolean array, True for synapses inside every region passed, with the arguments of
+        fanc_synapses.spatial_filter."""
+        mask = np.ones(len(self), dtype=bool)
+        if box is not None:
+            mask &= self.box(*box)
+        if y_slabs is not None:
+            mask &= self.slabs(y_slabs)
+        if mesh is not None:
+            mask &= self.mesh(mesh)
+        return mask
+
+    def breakdown(self, regions, by="pre_pt_root_id"):
+        """Count the synapses of each neuron in each region.
+
+        Parameters
+        ----------
+        regions :           dict
+                            dictionary of region name:dict of keyword arguments for mask, for example
+                            {"T1": {"mesh": t1_mesh}, "anterior": {"y_slabs": [(0, 50000)]}}
+        by :                str
+                            column of table to count by, such as pre_pt_root_id or post_pt_root_id
+
+        Returns
+        -------
+        pandas DataFrame
+                            DataFrame indexed by neuron ID with one column of synapse counts per region
+
+        """
+        ids = self.table[by].to_numpy()
+        counts = {name: pd.Series(ids[self.mask(**region)]).value_counts() for name, region in regions.items()}
+        neurons = pd.Index(pd.unique(ids), name=by)
+        return pd.DataFrame({name: count.reindex(neurons, fill_value=0) for name, count in counts.items()},
+                            index=neurons)
+
+    def _resolve(self, inside, touching, test):
+        # expand per-voxel decisions to synapses, testing the synapses of touching voxels one by one
+        mask = np.repeat(inside, self.counts)
+        check = np.repeat(touching, self.counts)
+        if check.any():
+            mask[check] = test(self.positions[check])
+        return mask
+
+def in_mesh(points, mesh):
+    """Return a boolean array, True for the Nx3 points inside a closed triangle mesh, given as for
+    SynapseIndex.mesh. A ray is cast from each point and its crossings with the triangles are counted, an
+    odd count being inside."""
+    vertices, faces = _mesh_arrays(mesh)
+    return _in_triangles(points, vertices[faces])
+
+def _in_triangles(points, triangles, chunk_size=2000000):
+    # in_mesh for an Nx3x3 array of triangles. Points are processed in chunks so that at most chunk_size
+    # point-triangle pairs are held at once
+    points = np.asarray(points, dtype="float64")
+    triangles = np.asarray(triangles, dtype="float64")
+    if not len(points) or not len(triangles):
+        return np.zeros(len(points), dtype=bool)
+    # Moller-Trumbore with a fixed ray direction, where every term is a dot product of (point - v0)
+    # with a per-triangle vector
+    v0 = triangles[:,0]
+    edge1 = triangles[:,1]-v0
+    edge2 = triangles[:,2]-v0
+    h = np.cross(_RAY, edge2)
+    determinant = np.einsum("ij,ij->i", edge1, h)
+    valid = np.abs(determinant) > 1e-12
+    v0, edge1, edge2, h, determinant = v0[valid], edge1[valid], edge2[valid], h[valid], determinant[valid]
+    g = np.cross(edge1, _RAY)
+    n = np.cross(edge1, edge2)
+    vectors = np.stack([h, g, n])/determinant[None,:,None]
+    offsets = np.einsum("ij,kij->ki", v0, vectors)
+    inside = np.zeros(len(points), dtype=bool)
+    step = max(1, chunk_size//len(v0))
+    for start in range(0, len(points), step):
+        chunk = points[start:start+step]
+        u = chunk @ vectors[0].T-offsets[0]
+        v = chunk @ vectors[1].T-offsets[1]
+        t = chunk @ vectors[2].T-offsets[2]
+        hits = (u >= 0) & (v >= 0) & (u+v <= 1) & (t > 0)
+        inside[start:start+step] = hits.sum(axis=1) % 2 == 1
+    return inside
+
+def load_mesh(path):
+    """Read a triangle mesh, such as a FANC neuromere, from a Wavefront .obj file, returning
+    (vertices, faces). Other formats are read with trimesh if it is installed."""
+    if not path.endswith(".obj"):
+        import trimesh
+        mesh = trimesh.load(path, force="mesh")
+        return np.asarray(mesh.vertices, dtype="float64"), np.asarray(mesh.faces, dtype="int64")
+    vertices, faces = [], []
+    with open(path) as file:
+        for line in file:
+            parts = line.split()
+            if not parts:
+                continue
+            if parts[0] == "v":
+                vertices.append([float(x) for x in parts[1:4]])
+            elif parts[0] == "f":
+                # faces may be polygons and may carry texture and normal indices, as in "f 1/1/1 2/2/2 3/3/3"
+                corners = [int(x.split("/")[0])-1 for x in parts[1:]]
+                faces += [[corners[0], corners[i], corners[i+1]] for i in range(1, len(corners)-1)]
+    return np.asarray(vertices, dtype="float64").reshape(-1, 3), np.asarray(faces, dtype="int64").reshape(-1, 3)
+
+def _mesh_arrays(mesh):
+    if hasattr(mesh, "vertices") and hasattr(mesh, "faces"):
+        vertices, faces = mesh.vertices, mesh.faces
+    else:
+        vertices, faces = mesh
+    return np.asarray(vertices, dtype="float64"), np.asarray(faces, dtype="int64")
+
+def _covered_voxels(triangles, voxel_size):
+    # every voxel overlapping the bounding box of any triangle
+    lower = np.floor(triangles.min(axis=1)/voxel_size).astype("int64")
+    extent = np.floor(triangles.max(axis=1)/voxel_size).astype("int64")-lower+1
+    voxels = []
+    for dx in range(extent[:,0].max(initial=0)):
+        for dy in range(extent[:,1].max(initial=0)):
+            for dz in range(extent[:,2].max(initial=0)):
+                offset = np.array([dx, dy, dz])
+                covered = (extent > offset).all(axis=1)
+                voxels.append(lower[covered]+offset)
+    return np.unique(np.concatenate(voxels), axis=0) if voxels else np.zeros((0, 3), dtype="int64")
+
+def _linear(voxels):
+    # one integer per voxel, so that sets of voxels can be compared with np.isin
+    voxels = np.asarray(voxels, dtype="int64")+2**20
+    return (voxels[:,0] << 42) | (voxels[:,1] << 21) | voxels[:,2]
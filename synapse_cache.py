@@ -0,0 +1,216 @@
+import io
+import os
+import sqlite3
+import threading
+import time
+import numpy as np
+import clients
+import id_arrays
+import instrumentation
+
+# synapse database shared by every working directory
+SYNAPSE_CACHE = os.path.join(clients.CACHE_FOLDER, "synapse_cache.sqlite")
+
+class SynapseCache:
+    """On-disk cache of FANC synapse tables, stored in SQLite with one row per (root_id, direction,
+    materialization version). The partner IDs and presynapse positions of each entry are stored as
+    separate NumPy columns so they can be loaded without parsing.
+
+    Parameters
+    ----------
+    path :              str
+                        filepath of the SQLite database, created if it does not exist. By default it is in
+                        clients.CACHE_FOLDER.
+    max_bytes :         int
+                        maximum total size of the stored synapse data. The least recently used entries are
+                        removed when it is exceeded.
+
+    """
+    def __init__(self, path=SYNAPSE_CACHE, max_bytes=2*1024**3):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS synapses (
+            root_id INTEGER, direction TEXT, version INTEGER, n_rows INTEGER, nbytes INTEGER,
+            last_access REAL, partners BLOB, positions BLOB,
+            PRIMARY KEY (root_id, direction, version))""")
+        # per materialization version, its timestamp and when the cache was last checked for superseded IDs
+        self._db.execute("""CREATE TABLE IF NOT EXISTS versions (
+            version INTEGER PRIMARY KEY, timestamp REAL, checked REAL)""")
+        self._db.commit()
+
+    def get(self, root_id, direction, version):
+        """Return the cached synapses of a neuron.
+
+        Parameters
+        ----------
+        root_id :           int
+                            FANC root ID
+        direction :         str
+                            "pre" for synapses where the neuron is presynaptic (its downstream synapses)
+                            or "post" for synapses where it is postsynaptic (its upstream synapses)
+        version :           int
+                            materialization version the synapses were queried at
+
+        Returns
+        -------
+        tuple or None
+                            (partner IDs, Nx3 presynapse positions) as NumPy arrays, or None if not cached
+
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT partners, positions FROM synapses WHERE root_id=? AND direction=? AND version=?",
+                (int(root_id), direction, int(version))).fetchone()
+            if row is None:
+                return None
+            self._db.execute("UPDATE synapses SET last_access=? WHERE root_id=? AND direction=? AND version=?",
+                             (time.time(), int(root_id), direction, int(version)))
+            self._db.commit()
+        return _from_blob(row[0]), _from_blob(row[1])
+
+    def counts(self, root_ids, direction, version):
+        """Return the number of cached synapses of each neuron without loading the synapses.
+
+        Returns
+        -------
+        dict
+                            dictionary of root_id:number of synapses, for the neurons that are cached
+
+        """
+        counts = {}
+        with self._lock:
+            for chunk in id_arrays.chunks(id_arrays.as_ids(root_ids).tolist(), 500):
+                marks = ",".join("?"*len(chunk))
+                rows = self._db.execute(
+                    "SELECT root_id, n_rows FROM synapses WHERE direction=? AND version=? AND root_id IN ("+marks+")",
+                    [direction, int(version)]+chunk).fetchall()
+                counts.update(rows)
+                self._db.execute(
+                    "UPDATE synapses SET last_access=? WHERE direction=? AND version=? AND root_id IN ("+marks+")",
+                    [time.time(), direction, int(version)]+chunk)
+            self._db.commit()
+        return counts
+
+    def put(self, root_id, direction, version, partners, positions):
+        """Store the synapses of a neuron, then evict the least recently used entries if the cache is full.
+
+        Parameters
+        ----------
+        root_id :           int
+                            FANC root ID
+        direction :         str
+                            "pre" or "post", see get
+        version :           int
+                            materialization version the synapses were queried at
+        partners :          array-like
+                            IDs of the neurons on the other side of each synapse
+        positions :         array-like
+                            Nx3 presynapse positions
+
+        """
+        partners = np.asarray(partners, dtype="int64")
+        positions = np.asarray(positions).reshape(len(partners), 3)
+        partner_blob = _to_blob(partners)
+        position_blob = _to_blob(positions)
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO synapses VALUES (?,?,?,?,?,?,?,?)",
+                             (int(root_id), direction, int(version), len(partners),
+                              len(partner_blob)+len(position_blob), time.time(), partner_blob, position_blob))
+            self._evict()
+            self._db.commit()
+
+    def invalidate(self, root_ids):
+        """Remove every cached entry of the given root IDs."""
+        with self._lock:
+            for chunk in id_arrays.chunks(id_arrays.as_ids(root_ids).tolist(), 500):
+                self._db.execute("DELETE FROM synapses WHERE root_id IN ("+",".join("?"*len(chunk))+")", chunk)
+            self._db.commit()
+
+    def invalidate_superseded(self, client, chunk_size=500, version=None):
+        """Remove the entries of every cached root ID that has been superseded by proofreading. It is
+        called at the start of fanc_synapses.cascade_csvs and refresh_cascade.
+
+        Entries hold the synapses of a root ID at a materialization version, which proofreading does not
+        change, so with version passed the check is skipped if it was already made at that version. A
+        cascade rerun at the same version, such as a threshold sweep, then makes no chunkedgraph requests.
+
+        Parameters
+        ----------
+        client :            caveclient.frameworkclient.CAVEclientFull
+                            CAVEclient used to check which root IDs are still the latest
+        chunk_size :        int
+                            maximum number of root IDs checked in a single chunkedgraph request
+        version :           int
+                            materialization version the caller queries at. If None every cached root ID is
+                            checked.
+
+        Returns
+        -------
+        list
+                            the root IDs that were removed
+
+        """
+        with self._lock:
+            if version is not None and self._db.execute("SELECT checked FROM versions WHERE version=? "
+                                                        "AND checked IS NOT NULL", (int(version),)).fetchone():
+                return []
+            root_ids = [x for (x,) in self._db.execute("SELECT DISTINCT root_id FROM synapses").fetchall()]
+        superseded = []
+        for chunk in id_arrays.chunks(root_ids, chunk_size):
+            with instrumentation.timed("cave.is_latest_roots", neurons=len(chunk)) as timer:
+                latest = client.chunkedgraph.is_latest_roots(chunk)
+                timer.set(latest)
+            superseded.extend([x for x, is_latest in zip(chunk, latest) if not is_latest])
+        self.invalidate(superseded)
+        if version is not None:
+            with self._lock:
+                self._db.execute("INSERT INTO versions (version, checked) VALUES (?, ?) ON CONFLICT(version) "
+                                 "DO UPDATE SET checked=excluded.checked", (int(version), time.time()))
+                self._db.commit()
+        return superseded
+
+    def materialization_timestamp(self, client, version):
+        """Return the timestamp of a materialization version as seconds since the epoch, asking CAVE only
+        the first time."""
+        with self._lock:
+            row = self._db.execute("SELECT timestamp FROM versions WHERE version=? AND timestamp IS NOT NULL",
+                                   (int(version),)).fetchone()
+        if row:
+            return row[0]
+        with instrumentation.timed("cave.get_timestamp") as timer:
+            timestamp = client.materialize.get_timestamp(version).timestamp()
+        with self._lock:
+            self._db.execute("INSERT INTO versions (version, timestamp) VALUES (?, ?) ON CONFLICT(version) "
+                             "DO UPDATE SET timestamp=excluded.timestamp", (int(version), timestamp))
+            self._db.commit()
+        return timestamp
+
+    def size(self):
+        """Return the total size in bytes of the stored synapse data."""
+        with self._lock:
+            return self._db.execute("SELECT COALESCE(SUM(nbytes), 0) FROM synapses").fetchone()[0]
+
+    def _evict(self):
+        total = self._db.execute("SELECT COALESCE(SUM(nbytes), 0) FROM synapses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self._db.execute("SELECT root_id, direction, version, nbytes FROM synapses ORDER BY last_access").fetchall()
+        for root_id, direction, version, nbytes in rows:
+            if total <= self.max_bytes:
+                break
+            self._db.execute("DELETE FROM synapses WHERE root_id=? AND direction=? AND version=?",
+                             (root_id, direction, version))
+            total -= nbytes
+
+def _to_blob(array):
+    buffer = io.BytesIO()
+    np.save(buffer, array, allow_pickle=False)
+    return buffer.getvalue()
+
+def _from_blob(blob):
+    return np.load(io.BytesIO(blob), allow_pickle=False)
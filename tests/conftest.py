@@ -0,0 +1,18 @@
+import os
+import sys
+import pytest
+
+# the analysis modules are imported from the repository root, as when running a script there
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.standins import SyntheticConnectome, install
+
+@pytest.fixture(scope="session")
+def connectome():
+    return SyntheticConnectome(300, seed=0)
+
+@pytest.fixture
+def services(connectome, tmp_path, monkeypatch):
+    # fresh stand-in clients, with every file the code under test writes kept in a temporary folder
+    monkeypatch.chdir(tmp_path)
+    return install(connectome)
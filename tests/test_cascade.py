@@ -0,0 +1,109 @@
+import datetime
+import json
+import os
+import pandas as pd
+import pytest
+import cascade
+import clients
+import fanc_synapses
+import id_arrays
+from benchmarks.standins import MATERIALIZED
+
+class Interrupted(Exception):
+    pass
+
+def _expander(graph, folder, expanded, fail_after=None):
+    # expand_layer for a small graph given as neuron_id:partners, saving a .csv file for each neuron with
+    # partners as the real cascades do
+    def expand_layer(neuron_ids, layer):
+        if fail_after is not None and len(expanded) >= fail_after:
+            raise Interrupted()
+        expanded.extend(neuron_ids)
+        for neuron_id in neuron_ids:
+            if graph.get(neuron_id):
+                partners = pd.DataFrame({"weight": 10}, index=pd.Index(graph[neuron_id], name="bodyId"))
+                partners.to_csv(os.path.join(folder, str(neuron_id)+"_downstreampartners.csv"))
+        return {neuron_id: graph.get(neuron_id, []) for neuron_id in neuron_ids}
+    return expand_layer
+
+def test_interrupted_cascade_resumes_without_querying_finished_neurons(tmp_path):
+    graph = {1: [2, 3, 4], 2: [5], 3: [5, 6], 4: [7]}
+    folder = str(tmp_path)
+    expanded = []
+    with pytest.raises(Interrupted):
+        cascade.run_cascade(1, folder, _expander(graph, folder, expanded, fail_after=3), layers=2, batch_size=2)
+    assert expanded == [1, 2, 3]
+    state = cascade.load_checkpoint(folder)
+    assert state["done"] == [1, 2, 3]
+
+    resumed = []
+    depth = cascade.run_cascade(1, folder, _expander(graph, folder, resumed), layers=2, batch_size=2)
+    assert resumed == [4]
+    assert depth == {1: 0, 2: 1, 3: 1, 4: 1, 5: 2, 6: 2, 7: 2}
+    assert cascade.load_checkpoint(folder)["frontier"] == [5, 6, 7]
+
+def _partners(folder, neuron_id):
+    return id_arrays.read_table(os.path.join(folder, str(neuron_id)+"_downstreampartners.csv")).index.to_list()
+
+def test_refresh_follows_edits_made_after_the_materialization(services, connectome):
+    start = connectome.fanc_id(0)
+    fanc_synapses.cascade_csvs(start, layers=2)
+    folder = str(start)+"-1"
+    state = cascade.load_checkpoint(folder)
+    assert state["timestamp"] == MATERIALIZED.timestamp()
+
+    # proofreading between the materialization and the cascade run, which the materialized synapse
+    # table the cascade was made from does not know about
+    old_id = _partners(folder, start)[0]
+    new_id = connectome.fanc_id(connectome.n_neurons)
+    clients.cave().chunkedgraph.edit(old_id, new_id, MATERIALIZED+datetime.timedelta(hours=1))
+    assert os.path.exists(os.path.join(folder, str(old_id)+"_downstreampartners.csv"))
+
+    assert fanc_synapses.refresh_cascade(start) == {old_id: new_id}
+    assert not os.path.exists(os.path.join(folder, str(old_id)+"_downstreampartners.csv"))
+    assert os.path.exists(os.path.join(folder, str(new_id)+"_downstreampartners.csv"))
+    assert new_id in _partners(folder, start)
+    assert old_id not in _partners(folder, start)
+    state = cascade.load_checkpoint(folder)
+    assert new_id in state["depth"] and old_id not in state["depth"]
+    assert state["timestamp"] > MATERIALIZED.timestamp()
+
+    # nothing has changed since the refresh, so a second one queries nothing
+    services.reset()
+    assert fanc_synapses.refresh_cascade(start) == {}
+    assert "cave.synapse_query" not in services.counts
+
+def test_refresh_keeps_the_shallowest_layer_of_merged_neurons(services, connectome):
+    start = connectome.fanc_id(0)
+    fanc_synapses.cascade_csvs(start, layers=2)
+    folder = str(start)+"-1"
+    depth = cascade.load_checkpoint(folder)["depth"]
+    first = _partners(folder, start)[0]
+    # changed IDs are handled in order, so a merge keeping the last layer would put the merged neuron at 2
+    second = min(x for x, layer in depth.items() if layer == 2 and x > first)
+    merged = connectome.fanc_id(connectome.n_neurons)
+    clients.cave().chunkedgraph.edit(first, merged)
+    clients.cave().chunkedgraph.edit(second, merged)
+
+    assert fanc_synapses.refresh_cascade(start) == {first: merged, second: merged}
+    state = cascade.load_checkpoint(folder)
+    assert state["depth"][merged] == 1
+    assert merged not in state["frontier"]
+    assert os.path.exists(os.path.join(folder, str(merged)+"_downstreampartners.csv"))
+    with open(os.path.join(folder, cascade.REPORT)) as file:
+        report = json.load(file)
+    assert "cave.get_delta_roots" in report["calls"]
+    assert "0" in report["layers"]
+
+def test_fanc_cascade_report_breaks_queries_down_by_neuron(services, connectome):
+    start = connectome.fanc_id(0)
+    fanc_synapses.cascade_csvs(start, layers=2)
+    with open(os.path.join(str(start)+"-1", cascade.REPORT)) as file:
+        report = json.load(file)
+    share = report["neurons"][str(start)]["cave.synapse_query.neuron_share"]
+    assert share["rows"] == int((connectome.synapses["pre_pt_root_id"] == start).sum())
+    assert share["bytes"] > 0
+    assert "fanc_synapses.get_percent_input" in report["neurons"][str(start)]
+    # the shares of a layer add up to the rows of its batched queries
+    layer = report["layers"]["1"]
+    assert layer["cave.synapse_query.neuron_share"]["rows"] <= layer["cave.synapse_query"]["rows"]
@@ -0,0 +1,30 @@
+import numpy as np
+import pandas as pd
+import pytest
+import compare_cascades
+
+def _edges(rows):
+    return pd.DataFrame(rows, columns=["pre", "post", "percent"])
+
+def test_compare_edges_aligns_partners_through_their_matches():
+    # MANC 4 has no FANC match, FANC 105 has no MANC counterpart, and MANC 7 is not matched at all
+    manc = _edges([(1, 2, 60.0), (1, 3, 30.0), (1, 4, 10.0), (7, 2, 50.0)])
+    fanc = _edges([(101, 102, 60.0), (101, 105, 40.0)])
+    matches = pd.Series([101, 102, 103], index=[1, 2, 3], dtype="int64")
+    table = compare_cascades.compare_edges(fanc, manc, matches)
+    assert list(table.columns) == compare_cascades.SUMMARY_COLUMNS
+    assert len(table) == 1
+    row = table.iloc[0]
+    assert (row["manc_id"], row["fanc_id"]) == (1, 101)
+    # aligned vectors over (-4, 102, 103, 105) are (10, 60, 30, 0) and (0, 60, 0, 40)
+    assert row["cosine"] == pytest.approx(3600/np.sqrt(4600*5200))
+    assert (row["overlap"], row["manc_partners"], row["fanc_partners"]) == (1, 3, 2)
+    assert row["manc_unmatched"] == pytest.approx(40)
+    assert row["fanc_unmatched"] == pytest.approx(40)
+    assert row["manc_no_match"] == pytest.approx(10)
+
+def test_compare_edges_without_matched_sources_is_empty():
+    table = compare_cascades.compare_edges(_edges([(101, 102, 1.0)]), _edges([(1, 2, 1.0)]),
+                                           pd.Series([], dtype="int64"))
+    assert table.empty
+    assert list(table.columns) == compare_cascades.SUMMARY_COLUMNS
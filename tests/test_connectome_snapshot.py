@@ -0,0 +1,35 @@
+import numpy as np
+import pandas as pd
+import pytest
+import connectome_snapshot
+import manc_synapses
+
+def _manc_snapshot(connectome):
+    # the stand-in neuprint serves the same edges and neuron table under MANC body IDs
+    edges = connectome.edges.assign(pre=connectome.edges["pre"]+connectome.manc_id(0),
+                                    post=connectome.edges["post"]+connectome.manc_id(0))
+    neurons = connectome.neurons[["post", "soma", "excluded"]].set_index(
+        connectome.manc_id(0)+np.arange(connectome.n_neurons))
+    return connectome_snapshot.ConnectomeSnapshot(edges, neurons, "manc")
+
+def test_snapshot_percent_inputs_match_the_live_path(connectome, services):
+    snapshot = _manc_snapshot(connectome)
+    for neuron in [0, 1, 5]:
+        neuron_id = connectome.manc_id(neuron)
+        live = manc_synapses.get_percent_input(neuron_id)
+        offline = manc_synapses.get_percent_input(neuron_id, snapshot=snapshot)
+        assert len(live)
+        live = live.sort_index()
+        offline = offline.sort_index()
+        assert offline.index.tolist() == live.index.tolist()
+        assert offline["weight"].tolist() == live["weight"].tolist()
+        assert offline["percent"].to_numpy() == pytest.approx(live["percent"].to_numpy())
+
+def test_region_snapshot_needs_the_total_inputs():
+    edges = pd.DataFrame({"pre": [1, 1], "post": [2, 3], "weight": [4, 5]})
+    with pytest.raises(ValueError):
+        connectome_snapshot.ConnectomeSnapshot(edges, pd.DataFrame({"post": [10]}, index=[2]), "fanc")
+    snapshot = connectome_snapshot.ConnectomeSnapshot(edges, pd.DataFrame({"post": [10, 20]}, index=[2, 3]), "fanc")
+    inputs = snapshot.inputs([2, 3, 9])
+    assert inputs.loc[[2, 3]].tolist() == [10, 20]
+    assert np.isnan(inputs.loc[9])
@@ -0,0 +1,68 @@
+import pandas as pd
+import pytest
+import clients
+import fanc_synapses
+import synapse_cache
+
+def _cached_counts(connectome, neuron_ids, tmp_path):
+    # counts from the cached path, which downloads every synapse and counts them locally
+    cache = synapse_cache.SynapseCache(str(tmp_path/"cache.sqlite"))
+    synapses = fanc_synapses.fetch_downstream_synapses_batch(neuron_ids, cache=cache)
+    return synapses.groupby(["pre_pt_root_id", "post_pt_root_id"]).size().rename("count")
+
+def _sorted(counts):
+    return counts.sort_index()
+
+def test_split_queries_count_the_same_as_the_cached_path(services, connectome, tmp_path):
+    neuron_ids = [connectome.fanc_id(x) for x in range(40)]
+    expected = _sorted(_cached_counts(connectome, neuron_ids, tmp_path))
+    counts = fanc_synapses.stream_synapse_counts(neuron_ids, chunk_size=20)
+    pd.testing.assert_series_equal(_sorted(counts), expected)
+    services.reset()
+    # small enough that chunks of neurons, and then single neurons, have to be split
+    split = fanc_synapses.stream_synapse_counts(neuron_ids, chunk_size=20, page_size=300)
+    pd.testing.assert_series_equal(_sorted(split), expected)
+    assert services.counts["cave.synapse_query"] > 2
+
+def test_partner_chunks_are_split_before_the_volume(services, connectome, tmp_path):
+    neuron_ids = [connectome.fanc_id(0)]
+    partners = [connectome.fanc_id(x) for x in range(connectome.n_neurons)]
+    expected = _sorted(_cached_counts(connectome, neuron_ids, tmp_path))
+    counts = fanc_synapses.stream_synapse_counts(neuron_ids, partner_ids=partners, chunk_size=connectome.n_neurons,
+                                                 page_size=60)
+    pd.testing.assert_series_equal(_sorted(counts), expected)
+
+def test_a_neuron_above_page_size_is_split_spatially(services, connectome, tmp_path, monkeypatch):
+    hub = connectome.fanc_id(0)
+    n_synapses = int((connectome.synapses["pre_pt_root_id"] == hub).sum())
+    page_size = n_synapses//8
+    expected = _sorted(_cached_counts(connectome, [hub], tmp_path))
+    materialize = clients.cave().materialize
+    query = materialize.synapse_query
+    rows = []
+    def counting_query(**kwargs):
+        result = query(**kwargs)
+        rows.append(len(result))
+        return result
+    monkeypatch.setattr(materialize, "synapse_query", counting_query)
+    counts = fanc_synapses.stream_synapse_counts([hub], page_size=page_size)
+    pd.testing.assert_series_equal(_sorted(counts), expected)
+    assert max(rows) <= page_size
+
+    # the public callers take page_size, and give the same table as the cached path
+    table = fanc_synapses.downstream_of(hub, page_size=page_size)
+    cached = fanc_synapses.downstream_of(hub, cache=synapse_cache.SynapseCache(str(tmp_path/"other.sqlite")))
+    pd.testing.assert_frame_equal(table.sort_index(), cached.sort_index(), check_dtype=False)
+
+def test_synapses_at_one_position_above_page_size_raise():
+    with pytest.raises(ValueError):
+        fanc_synapses._split_box(((5, 5, 5), (5, 5, 5)), 10)
+
+def test_tables_are_ordered_by_percent_then_count_then_id(services, connectome, tmp_path):
+    hub = connectome.fanc_id(0)
+    streamed = fanc_synapses.downstream_of(hub, threshold=1)
+    cached = fanc_synapses.downstream_of(hub, threshold=1, cache=synapse_cache.SynapseCache(str(tmp_path/"c.sqlite")))
+    assert streamed.index.equals(cached.index)
+    expected = streamed.assign(id=streamed.index).sort_values(["percent", "count", "id"],
+                                                              ascending=[False, False, True]).index
+    assert streamed.index.equals(expected)
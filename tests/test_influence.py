@@ -0,0 +1,33 @@
+import numpy as np
+import pandas as pd
+import pytest
+import influence
+
+def _edges():
+    # 1 -> 2 -> 4 and 1 -> 3 -> 4, with 4 -> 5 too weak to pass the threshold
+    return pd.DataFrame({"pre": [1, 1, 2, 3, 4], "post": [2, 3, 4, 4, 5], "percent": [50.0, 10.0, 20.0, 40.0, 1.0]})
+
+def test_influence_sums_paths_and_records_the_first_hop():
+    table = influence.influence_from_edges(_edges(), 1, hops=3, threshold=0.05)
+    assert table.loc[2, "hop_1"] == pytest.approx(0.5)
+    assert table.loc[3, "hop_1"] == pytest.approx(0.1)
+    # both two-hop paths reach 4: 0.5*0.2 + 0.1*0.4
+    assert table.loc[4, "hop_2"] == pytest.approx(0.14)
+    assert table.loc[4, "influence"] == pytest.approx(0.14)
+    assert table.loc[[2, 3, 4], "first_hop"].tolist() == [1, 1, 2]
+    assert table.index.tolist() == [2, 4, 3]
+
+def test_influence_below_the_threshold_is_pruned_at_each_hop():
+    # 0.14*0.01 at hop 3 is below the threshold, so 5 is never reached
+    table = influence.influence_from_edges(_edges(), 1, hops=3, threshold=0.05)
+    assert 5 not in table.index
+    assert (table["hop_3"] == 0).all()
+    kept = influence.influence_from_edges(_edges(), 1, hops=3, threshold=0.001)
+    assert kept.loc[5, "hop_3"] == pytest.approx(0.0014)
+    assert kept.loc[5, "first_hop"] == 3
+
+def test_start_neuron_missing_from_the_matrix_reaches_nothing():
+    ids = np.array([1, 2], dtype="int64")
+    table = influence.propagate(np.array([[0, 1.0], [0, 0]]), ids, 7, hops=2)
+    assert table.empty
+    assert list(table.columns) == ["influence", "hop_1", "hop_2", "first_hop"]
@@ -0,0 +1,34 @@
+import threading
+import time
+import clients
+import lineage
+
+def test_superseded_ids_are_looked_up_together(services, connectome):
+    chunkedgraph = clients.cave().chunkedgraph
+    old_ids = [connectome.fanc_id(x) for x in range(10)]
+    for i, old_id in enumerate(old_ids):
+        chunkedgraph.edit(old_id, connectome.fanc_id(connectome.n_neurons+i))
+    kept = connectome.fanc_id(20)
+    suggest = chunkedgraph.suggest_latest_roots
+    running, most = [0], [0]
+    lock = threading.Lock()
+    def slow_suggest(root_id, **kwargs):
+        with lock:
+            running[0] += 1
+            most[0] = max(most[0], running[0])
+        time.sleep(0.02)
+        with lock:
+            running[0] -= 1
+        return suggest(root_id, **kwargs)
+    chunkedgraph.suggest_latest_roots = slow_suggest
+
+    resolver = lineage.LineageResolver(workers=4)
+    latest = resolver.latest_roots(old_ids+[kept])
+    assert latest.tolist() == [connectome.fanc_id(connectome.n_neurons+i) for i in range(10)]+[kept]
+    assert services.counts["cave.is_latest_roots"] == 1
+    assert 1 < most[0] <= 4
+
+    # remembered answers cost one batched check when they must be checked again
+    services.reset()
+    assert resolver.latest_roots(old_ids, max_age=0).tolist() == latest[:10].tolist()
+    assert dict(services.counts) == {"cave.is_latest_roots": 1}
@@ -0,0 +1,43 @@
+import pandas as pd
+import clients
+import match_index
+
+def _index(connectome):
+    F = connectome.fanc_id
+    rows = [(1, F(1), F(2), F(3), ["No"]),
+            (2, None, F(2), F(2), ["No"]),
+            (3, None, F(3), F(4), ["Yes"]),
+            (4, None, F(4), F(5), [])]
+    return match_index.MatchIndex(pd.DataFrame(
+        [(str(connectome.manc_id(m)), None if a is None else str(a), str(n), str(c), flip) for m, a, n, c, flip in rows],
+        columns=["queryID", "manualAssignment", "nBlastMatchID", "conMatchID", "check_L_R"]))
+
+def test_manual_assignment_wins_over_nblast(connectome, services):
+    index = _index(connectome)
+    M, F = connectome.manc_id, connectome.fanc_id
+    assert index.fanc_match(M(1)) == F(1)
+    assert index.fanc_match(M(2)) == F(2)
+    matches = index.fanc_matches([M(1), M(2), M(3), M(4)])
+    assert matches.loc[[M(1), M(2)]].tolist() == [F(1), F(2)]
+    assert matches.loc[[M(3), M(4)]].isna().all()
+    assert index.manc_match(F(1)) == M(1)
+
+def test_disagreeing_matches_report_a_possible_flip(connectome, services, capsys):
+    index = _index(connectome)
+    M, F = connectome.manc_id, connectome.fanc_id
+    assert index.fanc_match(M(3)) == ("nblast:", F(3), "connectivity:", F(4))
+    flipped = capsys.readouterr().out
+    assert str(M(3)) in flipped and "left/right flipped" in flipped
+    index.fanc_match(M(4))
+    assert "flipped" not in capsys.readouterr().out
+    index.fanc_matches([M(3), M(4)])
+    lines = capsys.readouterr().out.splitlines()
+    assert len(lines) == 2
+    assert "flipped" in lines[0] and "flipped" not in lines[1]
+
+def test_matches_follow_edited_fanc_ids(connectome, services):
+    index = _index(connectome)
+    new_id = connectome.fanc_id(connectome.n_neurons+1)
+    clients.cave().chunkedgraph.edit(connectome.fanc_id(1), new_id)
+    assert index.fanc_match(connectome.manc_id(1)) == new_id
+    assert index.fanc_matches([connectome.manc_id(1)]).tolist() == [new_id]
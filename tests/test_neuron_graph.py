@@ -0,0 +1,26 @@
+import neuron_graph
+
+def test_match_lookup_leaves_unparseable_matches_unmatched(tmp_path):
+    path = tmp_path/"matches.csv"
+    path.write_text("queryID,match\n"
+                    "10001,648518346400000001\n"
+                    "10002,\"[648518346400000002, 648518346400000003]\"\n"
+                    "10003,6.48e+17\n"
+                    "10004,NotAssigned\n"
+                    "10005,648518346400000005.0\n")
+    assert neuron_graph.match_lookup(str(path)) == {648518346400000001: 10001, 648518346400000005: 10005}
+
+def _contracted(how):
+    # neurons 1 and 2 are of type A, 3 and 4 of type B, and 5 has no type to collapse
+    types = {1: "A", 2: "A", 3: "B", 4: "B", 5: "No type"}
+    edges = [(1, 3, 10), (2, 3, 20), (1, 4, 30), (3, 1, 5), (4, 5, 7)]
+    return neuron_graph.contract_by_type([1, 2, 3, 4, 5], edges, types, ["A", "B"], how)
+
+def test_contract_by_type_combines_parallel_edges():
+    for how, weight in [("mean", 20), ("sum", 60), ("max", 30)]:
+        G, sizes = _contracted(how)
+        assert set(G.nodes) == {1, 3, 5}
+        assert G.edges[1, 3]["weight"] == weight
+        assert G.edges[3, 1]["weight"] == 5
+        assert G.edges[3, 5]["weight"] == 7
+        assert sizes == {1: 2, 3: 2, 5: 1}
@@ -0,0 +1,52 @@
+import numpy as np
+import pandas as pd
+import fanc_synapses
+import spatial_index
+
+LOWER = np.array([10000.0, 10000.0, 1000.0])
+UPPER = np.array([30000.0, 30000.0, 3000.0])
+
+def _cube(lower=LOWER, upper=UPPER):
+    # closed triangle mesh of an axis-aligned box, two triangles per side
+    vertices = np.array([[x, y, z] for x in (lower[0], upper[0]) for y in (lower[1], upper[1])
+                         for z in (lower[2], upper[2])])
+    faces = np.array([[0, 1, 3], [0, 3, 2], [4, 6, 7], [4, 7, 5], [0, 4, 5], [0, 5, 1],
+                      [2, 3, 7], [2, 7, 6], [0, 2, 6], [0, 6, 4], [1, 5, 7], [1, 7, 3]])
+    return vertices, faces
+
+def _synapses(n=5000, seed=0):
+    positions = np.random.default_rng(seed).uniform([0, 0, 0], [40000, 40000, 4000], size=(n, 3))
+    synapses = pd.DataFrame(positions, columns=fanc_synapses.POSITION_COLUMNS)
+    synapses["pre_pt_root_id"] = np.arange(n) % 7
+    return synapses
+
+def _in_box(points):
+    return ((points > LOWER) & (points < UPPER)).all(axis=1)
+
+def test_in_mesh_matches_the_box_the_mesh_encloses():
+    points = _synapses()[fanc_synapses.POSITION_COLUMNS].to_numpy()
+    inside = spatial_index.in_mesh(points, _cube())
+    assert inside.any() and not inside.all()
+    assert (inside == _in_box(points)).all()
+
+def test_index_mesh_query_matches_point_by_point_containment(tmp_path):
+    index = spatial_index.SynapseIndex(_synapses())
+    inside = index.mesh(_cube())
+    assert (inside == _in_box(index.positions)).all()
+    assert (index.mesh(_cube()) == inside).all()
+
+    path = str(tmp_path/"index.npz")
+    index.save(path)
+    loaded = spatial_index.SynapseIndex.load(path)
+    assert len(loaded._meshes) == 1
+    assert (loaded.mesh(_cube()) == inside).all()
+
+def test_spatial_filter_keeps_synapses_inside_a_mesh_read_from_obj(tmp_path):
+    vertices, faces = _cube()
+    path = tmp_path/"box.obj"
+    path.write_text("".join("v %f %f %f\n" % tuple(v) for v in vertices)
+                    +"".join("f %d %d %d\n" % tuple(f+1) for f in faces))
+    synapses = _synapses()
+    kept = fanc_synapses.spatial_filter(synapses, mesh=spatial_index.load_mesh(str(path)))
+    points = synapses[fanc_synapses.POSITION_COLUMNS].to_numpy()
+    assert kept.index.equals(synapses.index[_in_box(points)])
@@ -0,0 +1,53 @@
+import types
+import numpy as np
+import clients
+import fanc_synapses
+import synapse_cache
+
+def _positions(n):
+    return np.arange(3*n, dtype="int64").reshape(n, 3)
+
+def test_least_recently_used_entries_are_evicted(tmp_path, monkeypatch):
+    # a clock that ticks on every call, so that each access is later than the one before
+    now = iter(range(1, 1000))
+    monkeypatch.setattr(synapse_cache, "time", types.SimpleNamespace(time=lambda: next(now)))
+    cache = synapse_cache.SynapseCache(str(tmp_path/"cache.sqlite"))
+    cache.put(1, "pre", 1, np.arange(10), _positions(10))
+    # room for two entries of the same size
+    cache.max_bytes = 2*cache.size()
+    cache.put(2, "pre", 1, np.arange(10), _positions(10))
+    assert cache.get(1, "pre", 1) is not None
+    cache.put(3, "pre", 1, np.arange(10), _positions(10))
+    assert cache.get(2, "pre", 1) is None
+    assert cache.get(1, "pre", 1) is not None
+    assert cache.get(3, "pre", 1) is not None
+    assert cache.size() <= cache.max_bytes
+
+def test_entries_round_trip(tmp_path):
+    cache = synapse_cache.SynapseCache(str(tmp_path/"cache.sqlite"))
+    partners = np.array([2**62, 5, 7])
+    cache.put(1, "post", 3, partners, _positions(3))
+    cached_partners, positions = cache.get(1, "post", 3)
+    assert cached_partners.tolist() == partners.tolist()
+    assert positions.tolist() == _positions(3).tolist()
+    assert cache.get(1, "pre", 3) is None
+    assert cache.counts([1, 2], "post", 3) == {1: 3}
+
+def test_superseded_entries_are_invalidated(services, connectome, tmp_path):
+    cache = synapse_cache.SynapseCache(str(tmp_path/"cache.sqlite"))
+    old_id, kept_id = connectome.fanc_id(1), connectome.fanc_id(2)
+    for root_id in (old_id, kept_id):
+        cache.put(root_id, "pre", 1, np.arange(4), _positions(4))
+    clients.cave().chunkedgraph.edit(old_id, connectome.fanc_id(connectome.n_neurons))
+    assert cache.invalidate_superseded(clients.cave()) == [old_id]
+    assert cache.get(old_id, "pre", 1) is None
+    assert cache.get(kept_id, "pre", 1) is not None
+    assert services.counts["cave.is_latest_roots"] == 1
+
+def test_threshold_sweep_over_a_cached_cascade_makes_no_requests(services, connectome, tmp_path):
+    cache = synapse_cache.SynapseCache(str(tmp_path/"cache.sqlite"))
+    start = connectome.fanc_id(0)
+    fanc_synapses.cascade_csvs(start, 1, layers=2, cache=cache)
+    services.reset()
+    fanc_synapses.cascade_csvs(start, 2, layers=2, cache=cache)
+    assert services.total() == 0